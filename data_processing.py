@@ -1,37 +1,24 @@
 import argparse
 import os
+import re
+import json
 import asyncio
 import pandas as pd
 import logging
-from gensim.parsing.preprocessing import remove_stopwords
-from gensim.parsing.porter import PorterStemmer
 from tasks.utils import OpenAIPromptHandler
-from tasks.prompts import CLEANING_SYSTEM, CLEANING_PROMPT, CLASSIF_PROMPT, CLASSIF_SYSTEM
-from nltk.tokenize import RegexpTokenizer
-from gensim import corpora, models, similarities
-from smart_open import smart_open
-import tiktoken
+from tasks.prompts import CLEANING_SYSTEM, CLEANING_PROMPT, CLEANING_SPANS_PROMPT, CLASSIF_PROMPT, CLASSIF_SYSTEM
+from tasks.chunking import DEFAULT_CHUNK_TOKENS, DEFAULT_CHUNK_OVERLAP
+from tasks.spans import numbered_document, span_cleaning_rows
+from tasks.tokens import token_counter
+from scraper.dedup import drop_near_duplicates, NEAR_DUPLICATE_THRESHOLD
+from scraper.text_processing import iter_preprocessed, COMPOSITE_TERMS
+from scraper.tfidf_index import TfidfIndex, score_documents, serialize_corpus
+from gensim import corpora, models
+import numpy as np
 
 logging.basicConfig(format='%(asctime)s : %(levelname)s : %(message)s', level=logging.INFO)
 
 
-COMPOSITE_TERMS = [
-    "market abuse", "payment system", "anti money laundering", "know your customer",
-    "capital requirement", "financial service", "banking law", "securities regulation",
-    "corporate governance", "fiduciary duty", "disclosure requirements", "risk management",
-    "financial stability", "consumer protection", "data protection", "financial crime",
-    "fraud prevention", "insider trading", "conflict of interest", "reporting obligation",
-    "whistleblower protection", "ethical standards", "financial oversight", "investment guideline",
-    "tax law", "fiscal policy", "monetary policy", "currency regulation", "exchange control",
-    "credit regulation", "insurance regulation", "pension regulation", "financial instrument",
-    "financial market infrastructure", "clearing and settlement", "digital currency",
-    "blockchain", "cryptocurrency", "initial coin offering", "electronic money", "payment service",
-    "crowdfunding", "peer to peer lending", "robo advisory", "virtual asset", "financial innovation","user interface", "user experience", "hamburger menu", "footer menu", "social media links", 
-"privacy policy", "terms of use", "disclaimer", "FAQ", "frequently asked questions", "search bar", 
-"login form", "sign up", "account settings", "site map", "accessibility", "mobile menu", "responsive design", "click here", "more info", "gallery", "portfolio", "legal notice", "back to top", "scroll to", "navigation bar", "menu item", 
-"site navigation", "page layout", "web development", "web design", "web service", "secure connection", "domain name", "web hosting", "cloud hosting", "content management system"
-]
-
 POS_QUERY = """Regulation, law, statute, council, commission, article, compliance, directive, guideline, standard,
 legislation, regulatory framework, policy, decree, act, provision, rule, amendment, enforcement, 
 supervisory authority, financial conduct, oversight, legal framework, code of practice, 
@@ -65,103 +52,277 @@ NEG_QUERY = """"cookies", "submenu", "toggle", "contact", "help", "home", "about
 "page layout", "layout", "theme", "template", "CSS", "HTML", "JavaScript"
 """
 
+# Input of the coherence check, also the corpus its pre-classifier is calibrated on
+COHERENCE_DATA = "downloads/eurlex.csv"
+
+# Local pre-classifier of the coherence check: documents clearly on either side of these limits are answered without
+# an API call, the rest go to the LLM. Scores are the positive minus negative query similarity of tfidf_score_data.
+# A local "No" needs at least min_junk_signals of: low score, low alpha share, boilerplate lines, tokens per word.
+PREFILTER_THRESHOLDS = {
+    "max_junk_score": -0.05,
+    "min_alpha_share": 0.5,
+    "max_boilerplate_ratio": 0.8,
+    "max_tokens_per_word": 2.5,
+    "min_junk_signals": 2,
+    "min_keep_score": 0.15,
+    "min_keep_tokens": 1000,
+    "min_keep_alpha_share": 0.75,
+    "max_keep_boilerplate_ratio": 0.2,
+}
+# Thresholds fitted by `calibrate_prefilter` on the LLM labels, used instead of the defaults once written
+PREFILTER_CALIBRATION_FILE = "calibration.json"
+# Agreement with the LLM labels the local "Yes" and "No" answers must each reach in calibration
+MIN_PREFILTER_AGREEMENT = 0.95
+# Lines this short count as boilerplate unless they are structure (numbering, headings), lines up to
+# BOILERPLATE_PHRASE_MAX_WORDS long count when they match BOILERPLATE_LINE (longer ones are text mentioning it)
+BOILERPLATE_MAX_WORDS = 3
+BOILERPLATE_PHRASE_MAX_WORDS = 25
+BOILERPLATE_LINE = re.compile(r"\b(cookies?|log ?in|sign (up|in)|subscribe|share on|follow us|back to top|skip to|privacy policy|terms of use|all rights reserved|menu)\b", re.IGNORECASE)
+# "1.", "(a)", "iv)", "2.3", "Article 5", "ANNEX II", "For the Council", "Whereas:"
+STRUCTURAL_LINE = re.compile(r"^(\(?(\d+(\.\d+)*|[ivxlc]+|[a-z])[.)]?\)?|(article|chapter|section|annex|title|part|appendix)\s+\S+\.?|for the .+|whereas:?|done at .+)$", re.IGNORECASE)
+
 
 
 def load_data(filepath):
     return pd.read_csv(filepath)
 
-def encode_text(df, encoding):
-    def num_tokens_from_string(string):
-        return len(encoding.encode(string))
-    df = df.assign(num_tokens=df["content"].apply(num_tokens_from_string))
+def encode_text(df, tokens):
+    # Counts come from the shared token counter, documents counted before (by an earlier run or stage) are not encoded again
+    df = df.assign(num_tokens=tokens.count_many(df["content"]))
     return df
 
-def preprocess_text(text):
-    p = PorterStemmer()
-    tokenizer = RegexpTokenizer(r'\w+')
-    text = text.strip().lower()
-    doc_sw = remove_stopwords(text)
-    doc_stem = p.stem_sentence(doc_sw)
-    return tokenizer.tokenize(doc_stem)
-
-def preprocess_composite_terms(text, composite_terms):
-    for term in composite_terms:
-        new_text = text.replace(term, term.replace(" ", ""))
-        if text != new_text:
-            text = new_text
-    return text
-
-def create_corpus_file(df, composite_terms, corpus_file_path):
-    with open(corpus_file_path, 'w', encoding='utf-8') as corpus_file:
-        for row in df.iterrows():
-            content = row[1].content
-            content = preprocess_composite_terms(content, composite_terms)
-            content_without_newlines = content.replace('\n', '')
-            encoded_content = content_without_newlines.encode('utf-8', errors='ignore').decode('utf-8')
-            corpus_file.write(encoded_content + '\n')
-
-def build_dictionary_and_corpus(df, corpus_file_path):
-    dictionary = corpora.Dictionary(df['preproc_text'].tolist())
-    dictionary.save("midict.dict")
-    class MyCorpus(object):
-        def __iter__(self):
-            for line in smart_open(corpus_file_path, "rb"):
-                yield dictionary.doc2bow(preprocess_text(line))
-    corpus_memory_friendly = MyCorpus()
-    corpora.MmCorpus.serialize("corpus.mm", corpus_memory_friendly)
-    return dictionary, corpora.MmCorpus("corpus.mm")
+def build_dictionary_and_corpus(texts, composite_terms, dictionary_path="midict.dict", mm_path="corpus.mm"):
+    # Single pass: every document is tokenized once, as a line of the corpus, and its bag of words is streamed to the
+    # MmCorpus while the dictionary grows, so no tokenized documents are held in memory. The features are the tokens of
+    # the raw texts, as when the dictionary was built from them (see `serialize_corpus`)
+    dictionary = corpora.Dictionary()
+    serialize_corpus(iter_preprocessed(texts, composite_terms=composite_terms), dictionary, mm_path, vocabulary=set())
+    dictionary.save(dictionary_path)
+    return dictionary, corpora.MmCorpus(mm_path)
 
 def build_tfidf_model(corpus):
     return models.TfidfModel(corpus)
 
-def retrieve_and_rank_documents(tfidf, dictionary, corpus, pos_query, neg_query):
-    index = similarities.MatrixSimilarity(tfidf[corpus])
-    query_pos_doc_bow = dictionary.doc2bow(preprocess_text(pos_query))
-    query_neg_doc_bow = dictionary.doc2bow(preprocess_text(neg_query))
-    sims_pos = index[tfidf[query_pos_doc_bow]]
-    sims_neg = index[tfidf[query_neg_doc_bow]]
-    final_scores = [(index, pos_score - neg_score) for index, (pos_score, neg_score) in enumerate(zip(sims_pos, sims_neg))]
-    sorted_scores = sorted(final_scores, key=lambda x: x[1], reverse=True)
-    return sorted_scores
-
 def filter_thru_thresh(df:pd.DataFrame, thresh:float= 0.8):
+    # Keeps the <thresh> share of best-scored rows, in increasing score order; only the kept rows are gathered
+    threshold = int(len(df) * thresh)
+    order = np.argsort(df['score'].to_numpy(), kind="quicksort")
+    return df.iloc[order[len(order) - threshold:]] if threshold else df.iloc[:0]
+
+
+def tfidf_score_data(df, artifacts_dir="", scoring="sparse"):
+    """
+    Adds to <df> (with a fresh index) the positive minus negative query similarity of every document as 'score',
+    from a TF-IDF model over <df> alone whose dictionary and MmCorpus are written to <artifacts_dir>.
+    <scoring> is "sparse" or "dense", see `score_documents`.
+    """
+    if artifacts_dir:
+        os.makedirs(artifacts_dir, exist_ok=True)
+    dictionary, corpus = build_dictionary_and_corpus(df['content'], COMPOSITE_TERMS,
+                                                     dictionary_path=os.path.join(artifacts_dir, "midict.dict"),
+                                                     mm_path=os.path.join(artifacts_dir, "corpus.mm"))
+    tfidf = build_tfidf_model(corpus)
 
-    df_sorted = df.sort_values(by='score', ascending=True)
-    threshold = int(len(df_sorted) * thresh)
-    return df_sorted.tail(threshold)
-
+    df['index'] = df.index
+    return df.assign(score=score_documents(tfidf, dictionary, corpus, POS_QUERY, NEG_QUERY, scoring=scoring))
 
-def tfidf_filter_data():
+def tfidf_filter_data(near_duplicate_threshold:float=NEAR_DUPLICATE_THRESHOLD, scoring:str="sparse", rebuild_index:bool=False):
     df = load_data("recursive_data/total/total_cleaned.csv")
     df_osi = load_data("osi.csv")
 
     df = pd.concat([df,df_osi],ignore_index=True)
-
-    encoding = tiktoken.encoding_for_model("gpt-4o-mini")
-    df = encode_text(df, encoding)
+    # Only documents the TF-IDF index has not seen yet are processed, so a crawl delta costs time proportional to it
+    index = TfidfIndex.rebuild() if rebuild_index else TfidfIndex()
+    first_batch = len(index) == 0
+    df = index.new_documents(df)
+    logging.info(f"{len(df)} documents not in the TF-IDF index at {index.directory} yet")
+    # Near duplicates of pages kept by earlier runs are dropped too, the LSH index is stored with the TF-IDF index
+    near_duplicates = index.near_duplicate_index(near_duplicate_threshold)
+    deduplicated = drop_near_duplicates(df, threshold=near_duplicate_threshold, index=near_duplicates)
+    index.skip(df.drop(deduplicated.index))
+    df = deduplicated.reset_index(drop=True)
+
+    df = encode_text(df, token_counter("gpt-4o-mini"))
 
     logging.info(f"len before drop: {len(df)}")
+    index.skip(df[df.num_tokens <= 500])
     df = df[df.num_tokens > 500].reset_index(drop=True)
     logging.info(f"len after drop: {len(df)}")
 
-    df['preproc_text'] = df['content'].apply(preprocess_text)
-    corpus_file_path = "mycorpusGensim.txt"
-    create_corpus_file(df, COMPOSITE_TERMS, corpus_file_path)
-    dictionary, corpus = build_dictionary_and_corpus(df, corpus_file_path)
-    tfidf = build_tfidf_model(corpus)
-
-    ranking = retrieve_and_rank_documents(tfidf, dictionary, corpus, POS_QUERY, NEG_QUERY)
-    ranking_df = pd.DataFrame(ranking, columns=['index', 'score'])
+    df = index.add(df, POS_QUERY, NEG_QUERY, scoring=scoring)
+    index.save_near_duplicate_index(near_duplicates)
     df['index'] = df.index
-    df = pd.merge(df, ranking_df, on='index', how='left')
     df.loc[df['source'] == 'OSI', 'score'] = float(0.3)
+    df.to_csv("recursive_data/total/scored_delta.csv",index=False)
 
     logging.info(f"Len before TFIDF filtering: {len(df)}")
-    df_filt = filter_thru_thresh(df=df, thresh= 0.8)
-    logging.info(f"len after TFIDF filtering: {len(df_filt)}")
-    df_filt.to_csv("recursive_data/total/refined_data.csv",index=False)
-
-async def text_cleaning_task(handler: OpenAIPromptHandler):
+    if first_batch:
+        df_filt = filter_thru_thresh(df=df, thresh= 0.8)
+        logging.info(f"len after TFIDF filtering: {len(df_filt)}")
+        df_filt.to_csv("recursive_data/total/refined_data.csv",index=False)
+        return
+
+    # New documents are held to the cut of the whole index, and the ones above it appended to the refined data.
+    # Earlier scores were computed with the IDF of their own run; --rebuild-index rescores everything on the current one
+    indexed = index.scores().dropna(subset=["score"])
+    indexed.loc[indexed['source'] == 'OSI', 'score'] = float(0.3)
+    cutoff = filter_thru_thresh(df=indexed, thresh= 0.8)['score'].min()
+    df_filt = df[df.score >= cutoff]
+    logging.info(f"len after TFIDF filtering: {len(df_filt)} (score >= {cutoff:.4f})")
+    df_filt.to_csv("recursive_data/total/refined_data.csv",index=False, mode="a", header=not os.path.exists("recursive_data/total/refined_data.csv"))
+
+def document_features(text:str, num_tokens:int) -> dict:
+    """
+    Cheap quality signals of a document: share of alphabetic characters, share of words in boilerplate lines
+    (navigation, cookie banners, short fragments that are not numbering or headings) and tokens per word,
+    which grows for OCR noise and glued words
+    """
+    text = str(text)
+    characters = [c for c in text if not c.isspace()]
+    lines = [line.strip() for line in text.split("\n") if line.strip()]
+    boilerplate = [line for line in lines
+                   if (len(line.split()) <= BOILERPLATE_PHRASE_MAX_WORDS and BOILERPLATE_LINE.search(line))
+                   or (len(line.split()) <= BOILERPLATE_MAX_WORDS and not (STRUCTURAL_LINE.match(line) or line.isupper()))]
+    words = text.split()
+    # Weighted by words, so a menu of many one-word lines does not outweigh the long lines holding the text
+    return {"alpha_share": sum(c.isalpha() for c in characters) / max(len(characters), 1),
+            "boilerplate_ratio": sum(len(line.split()) for line in boilerplate) / max(len(words), 1),
+            "tokens_per_word": num_tokens / max(len(words), 1)}
+
+def prefilter_decisions(data:pd.DataFrame, thresholds:dict=PREFILTER_THRESHOLDS) -> pd.Series:
+    """
+    "Yes"/"No" for the documents of <data> (score, num_tokens and `document_features` columns) the local signals settle
+    with confidence, None for the ones left to the LLM check
+    """
+    junk_signals = ((data["score"] <= thresholds["max_junk_score"]).astype(int)
+                    + (data["alpha_share"] < thresholds["min_alpha_share"])
+                    + (data["boilerplate_ratio"] > thresholds["max_boilerplate_ratio"])
+                    + (data["tokens_per_word"] > thresholds["max_tokens_per_word"]))
+    keep = ((data["score"] >= thresholds["min_keep_score"])
+            & (data["num_tokens"] >= thresholds["min_keep_tokens"])
+            & (data["alpha_share"] >= thresholds["min_keep_alpha_share"])
+            & (data["boilerplate_ratio"] <= thresholds["max_keep_boilerplate_ratio"]))
+    decisions = pd.Series(None, index=data.index, dtype=object)
+    decisions[keep] = "Yes"
+    decisions[junk_signals >= thresholds["min_junk_signals"]] = "No"
+    return decisions
+
+def prefilter_features(data:pd.DataFrame, artifacts_dir:str) -> pd.DataFrame:
+    """
+    <data> (with num_tokens) with its TF-IDF score and `document_features` columns
+    """
+    data = tfidf_score_data(data.reset_index(drop=True), artifacts_dir=artifacts_dir)
+    features = pd.DataFrame([document_features(content, num_tokens) for content, num_tokens in zip(data["content"], data["num_tokens"])],
+                            index=data.index)
+    return data.join(features)
+
+def prefilter_thresholds(artifacts_dir:str) -> dict:
+    """
+    Thresholds written by `calibrate_prefilter` to <artifacts_dir>, PREFILTER_THRESHOLDS when there are none
+    """
+    path = os.path.join(artifacts_dir, PREFILTER_CALIBRATION_FILE)
+    if not os.path.exists(path):
+        return dict(PREFILTER_THRESHOLDS)
+    with open(path, "r", encoding="utf-8") as f:
+        calibration = json.load(f)
+    logging.info(f"Pre-classifier thresholds calibrated on {calibration['labels']} LLM labels, read from {path}")
+    return {**PREFILTER_THRESHOLDS, **calibration["thresholds"]}
+
+def prefilter_agreement(decisions:pd.Series, labels:pd.Series) -> dict:
+    """
+    Share of the documents settled locally and how often each local answer matches the LLM label, among the local
+    answers with a label (<labels> is missing for documents the LLM never classified)
+    """
+    report = {"decided": float(decisions.notna().mean()) if len(decisions) else 0.0}
+    for answer in ("Yes", "No"):
+        local = decisions == answer
+        measured = local & labels.notna()
+        report[f"{answer.lower()}_answers"] = int(local.sum())
+        report[f"{answer.lower()}_labelled"] = int(measured.sum())
+        report[f"{answer.lower()}_agreement"] = float((labels[measured] == answer).mean()) if measured.any() else None
+    return report
+
+def calibrate_prefilter(labels_path:str, documents:pd.DataFrame, artifacts_dir:str, min_agreement:float=MIN_PREFILTER_AGREEMENT) -> dict:
+    """
+    Fits the pre-classifier thresholds on the documents the LLM already classified in <labels_path>: among a grid
+    around the defaults, the thresholds settling the most documents locally while both local answers agree with the
+    LLM at least <min_agreement> of the time. Features are computed over <documents>, the whole input of the check
+    (see `coherence_documents`), so scores come from the same TF-IDF model as in `prefilter_coherence`; the labels are
+    joined to them. Reports the agreement of the defaults and of the fit, and writes the fit to
+    <artifacts_dir>/PREFILTER_CALIBRATION_FILE for `prefilter_coherence`.
+    """
+    labels = pd.read_csv(labels_path)
+    # Rows answered by the pre-classifier itself are stored with no tokens, they are not labels
+    labels = labels[(labels.total_tokens > 0) & labels.content.notna()]
+    labels = labels.assign(url=labels.url.astype(str), label=labels.generated_text.astype(str).str.strip().str.strip(".").str.capitalize())
+    labels = labels[labels.label.isin(["Yes", "No"])].drop_duplicates(subset=["url", "content"], keep="last")
+    data = prefilter_features(documents, artifacts_dir)
+    data = data.assign(url=data.url.astype(str)).merge(labels[["url", "content", "label"]], on=["url", "content"], how="left")
+
+    # Agreement can only be measured where the LLM answered; after prefiltered runs that is the uncertain band alone
+    labelled = data[data.label.notna()]
+    if labelled.empty:
+        raise ValueError(f"None of the documents of the check have an LLM label in {labels_path}")
+    low, high = labelled.score.min(), labelled.score.max()
+    logging.info(f"{len(labelled)}/{len(data)} documents have an LLM label, their scores span [{low:.4f}, {high:.4f}] "
+                 f"of [{data.score.min():.4f}, {data.score.max():.4f}], covering {data.score.between(low, high).mean():.1%} of the documents")
+
+    baseline = prefilter_agreement(prefilter_decisions(data, PREFILTER_THRESHOLDS), data.label)
+    best, best_report = dict(PREFILTER_THRESHOLDS), None
+    for max_junk_score in np.quantile(data.score, [0.02, 0.05, 0.1, 0.15, 0.2, 0.3]):
+        for min_keep_score in np.quantile(data.score, [0.5, 0.6, 0.7, 0.8, 0.9]):
+            for max_boilerplate_ratio in (0.6, 0.7, 0.8, 0.9):
+                for min_junk_signals in (1, 2, 3):
+                    thresholds = {**PREFILTER_THRESHOLDS, "max_junk_score": float(max_junk_score), "min_keep_score": float(min_keep_score),
+                                  "max_boilerplate_ratio": max_boilerplate_ratio, "min_junk_signals": min_junk_signals}
+                    report = prefilter_agreement(prefilter_decisions(data, thresholds), data.label)
+                    # Local answers none of which the LLM labelled cannot be checked, the thresholds are not taken
+                    if any(report[f"{answer}_answers"] and (report[f"{answer}_agreement"] is None or report[f"{answer}_agreement"] < min_agreement)
+                           for answer in ("yes", "no")):
+                        continue
+                    if best_report is None or report["decided"] > best_report["decided"]:
+                        best, best_report = thresholds, report
+
+    logging.info(f"Pre-classifier on {len(labelled)} LLM labels, default thresholds: {baseline}")
+    if best_report is None:
+        logging.warning(f"No thresholds reach {min_agreement:.0%} agreement with the LLM labels, keeping the defaults")
+        best_report = baseline
+    else:
+        logging.info(f"Calibrated thresholds: {best_report}")
+    unmeasured = sum(best_report[f"{answer}_answers"] - best_report[f"{answer}_labelled"] for answer in ("yes", "no"))
+    if unmeasured:
+        logging.warning(f"{unmeasured} documents settled locally have no LLM label, their agreement is not measured "
+                        f"(run the check with --no-prefilter to label the whole score range)")
+    calibration = {"labels": len(labelled), "documents": len(data), "labelled_score_range": [float(low), float(high)], "min_agreement": min_agreement, "default": baseline, "calibrated": best_report, "thresholds": best}
+    os.makedirs(artifacts_dir, exist_ok=True)
+    with open(os.path.join(artifacts_dir, PREFILTER_CALIBRATION_FILE), "w", encoding="utf-8") as f:
+        json.dump(calibration, f, indent=2)
+    return calibration
+
+def prefilter_coherence(data:pd.DataFrame, artifacts_dir:str) -> tuple:
+    """
+    Splits the documents of the coherence check into the ones answered locally and the uncertain ones for the LLM
+
+    Returns:
+        tuple: (rows of the decided documents in the results schema, documents left for the LLM)
+    """
+    data = prefilter_features(data, artifacts_dir)
+    data = data.assign(prefilter=prefilter_decisions(data, prefilter_thresholds(artifacts_dir)))
+    decided = data[data.prefilter.notna()]
+    counts = decided.prefilter.value_counts()
+    logging.info(f"Local pre-classifier settled {len(decided)}/{len(data)} documents ({len(decided) / max(len(data), 1):.1%} of the LLM calls avoided): "
+                 f"{counts.get('Yes', 0)} kept, {counts.get('No', 0)} discarded, {len(data) - len(decided)} left to the LLM")
+    rows = pd.DataFrame({"url": decided["url"],
+                         "source": decided["source"],
+                         "content": decided["content"],
+                         "task": "coherence",
+                         "total_tokens": 0,
+                         "generated_text": decided["prefilter"],
+                         "costs": 0.0})
+    undecided = data[data.prefilter.isna()].drop(columns=["index", "score", "prefilter", "alpha_share", "boilerplate_ratio", "tokens_per_word"])
+    return rows, undecided.reset_index(drop=True)
+
+async def text_cleaning_task(handler: OpenAIPromptHandler, dry_run:bool=False, retry_failed:bool=False, mode:str="rewrite"):
     logging.info("Running cleaning coroutine")
     output_path = "results/cleaning_eurlex"
     task_name = "cleaning"
@@ -172,40 +333,92 @@ async def text_cleaning_task(handler: OpenAIPromptHandler):
     data = data[data.generated_text.isin(["Yes","yes"])].reset_index(drop=True)
     logging.info(f"len of df to process: {len(data)}")
 
-    results = await handler.execute_task(results_dir=output_path,
-                                         data=data,
-                                         task=task_name,
-                                         task_prompt=CLEANING_PROMPT,
-                                         system_prompt=CLEANING_SYSTEM,
-                                         batch_size=25)
+    # "spans" mode only asks for the numbers of the lines to drop and rebuilds the text locally (tasks/spans.py),
+    # generating a small fraction of the tokens of a rewrite; both modes write the same cleaning.csv
+    if mode == "spans":
+        # Span answers are kept in their own results directory, the numbered documents are what the journal tracks
+        results_dir, run_task, task_prompt = os.path.join(output_path, "spans"), "cleaning_spans", CLEANING_SPANS_PROMPT
+        run_data = data.assign(content=data.content.map(numbered_document))
+        chunk_overlap = DEFAULT_CHUNK_OVERLAP
+    else:
+        results_dir, run_task, task_prompt, run_data = output_path, task_name, CLEANING_PROMPT, data
+        # Long documents are rewritten window by window and stitched back, windows must not overlap to avoid repeated text
+        chunk_overlap = 0
+
+    if dry_run:
+        handler.plan_task(results_dir=results_dir, data=run_data, task=run_task,
+                          task_prompt=task_prompt, system_prompt=CLEANING_SYSTEM,
+                          chunk_tokens=DEFAULT_CHUNK_TOKENS, chunk_overlap=chunk_overlap)
+        return
+
+    run = handler.retry_failed if retry_failed else handler.execute_task
+    results = await run(results_dir=results_dir,
+                        data=run_data,
+                        task=run_task,
+                        task_prompt=task_prompt,
+                        system_prompt=CLEANING_SYSTEM,
+                        batch_size=25,
+                        chunk_tokens=DEFAULT_CHUNK_TOKENS,
+                        chunk_overlap=chunk_overlap)
     
     results = pd.concat(results,ignore_index=True).dropna()
+    if mode == "spans":
+        results = span_cleaning_rows(results, data, task=task_name)
     results.to_csv(os.path.join(output_path,f"{task_name}.csv"),index=False)
 
 
-async def coherence_check(handler: OpenAIPromptHandler):
+def coherence_documents(load_dir:str, tokens) -> pd.DataFrame:
+    """
+    Documents of <load_dir> the coherence check classifies, with their num_tokens
+    """
+    data = pd.read_csv(load_dir)
+    logging.info(f"len before filtering for documents too short to classify: {len(data)}")
+    data = encode_text(data, tokens) ## Not really meant to be here but whatever
+    # Documents over the context window are no longer dropped, they are classified by chunks and the chunk votes merged
+    data = data[data.num_tokens > 500].reset_index(drop=True)
+    logging.info(f"len of df to process: {len(data)}")
+    return data
+
+async def coherence_check(handler: OpenAIPromptHandler, dry_run:bool=False, retry_failed:bool=False, prefilter:bool=True):
     logging.info("Running coherence check coroutine")
     output_path = "results/coherence_eurlex"
     task_name = "coherence"
     
     #load_dir = "recursive_data/total/refined_data.csv"
-    load_dir = "downloads/eurlex.csv"
-    data = pd.read_csv(load_dir)
-    logging.info(f"len before filtering for documents exceeding context window: {len(data)}")
-    encoding = tiktoken.encoding_for_model("gpt-4o-mini") #Same as below
-    data = encode_text(data, encoding) ## Not really meant to be here but whatever
-    data = data[(data.num_tokens > 500) & (data.num_tokens < 123e3)].reset_index(drop=True)
-    logging.info(f"len of df to process: {len(data)}")
-
-    results = await handler.execute_task(results_dir=output_path,
-                                         data=data,
-                                         task=task_name,
-                                         task_prompt=CLASSIF_PROMPT,
-                                         system_prompt=CLASSIF_SYSTEM,
-                                         batch_size=25)
-    
-
-    handler.store_total_result(results,output_path, task_name)
+    load_dir = COHERENCE_DATA
+    data = coherence_documents(load_dir, handler.tokens)
+
+    documents = data
+    decided = pd.DataFrame()
+    if prefilter:
+        # Obvious keeps and obvious junk are answered locally, only the uncertain band reaches the LLM
+        decided, data = prefilter_coherence(data, artifacts_dir=os.path.join(output_path, "prefilter"))
+
+    if dry_run:
+        handler.plan_task(results_dir=output_path, data=data, task=task_name,
+                          task_prompt=CLASSIF_PROMPT, system_prompt=CLASSIF_SYSTEM,
+                          chunk_tokens=DEFAULT_CHUNK_TOKENS, chunk_overlap=DEFAULT_CHUNK_OVERLAP)
+        return
+
+    run = handler.retry_failed if retry_failed else handler.execute_task
+    await run(results_dir=output_path,
+              data=data,
+              task=task_name,
+              task_prompt=CLASSIF_PROMPT,
+              system_prompt=CLASSIF_SYSTEM,
+              batch_size=25,
+              chunk_tokens=DEFAULT_CHUNK_TOKENS,
+              chunk_overlap=DEFAULT_CHUNK_OVERLAP)
+
+    # LLM answers are read back against every document of the check, not only the ones sent this run, so documents
+    # answered in an earlier run and settled locally now (e.g. after `calibrate`) keep their answer and their content.
+    # Answers for documents no longer in the input have no content to clean and are left out.
+    answered = handler.load_existing_data(os.path.join(output_path, "processed"), data=documents)
+    answered = answered[answered.content.notna()] if len(answered) else answered
+    if len(decided) and len(answered):
+        keys = set(zip(answered.url.astype(str), answered.content))
+        decided = decided[[(str(url), content) not in keys for url, content in zip(decided.url, decided.content)]]
+    handler.store_total_result([answered, decided], output_path, task_name)
 
 
 def create_corpus():
@@ -223,25 +436,51 @@ def create_corpus():
 
 
 
-def main(task):
+async def run_with_handler(job, **kwargs):
+    """
+    Runs the coroutine function <job> with a new handler, releasing its connections and response cache once it is done
+    """
+    handler = OpenAIPromptHandler()
+    try:
+        await job(handler=handler, **kwargs)
+    finally:
+        await handler.close()
+
+
+def main(task, dry_run=False, retry_failed=False, cleaning_mode="rewrite", prefilter=True, near_duplicate_threshold=NEAR_DUPLICATE_THRESHOLD, scoring="sparse",
+         rebuild_index=False):
     if task == "filtering":
-        tfidf_filter_data()
+        tfidf_filter_data(near_duplicate_threshold=near_duplicate_threshold, scoring=scoring, rebuild_index=rebuild_index)
 
     elif task == "corpus":
         create_corpus()
 
+    elif task == "calibrate":
+        calibrate_prefilter("results/coherence_eurlex/coherence.csv", documents=coherence_documents(COHERENCE_DATA, token_counter("gpt-4o-mini")),
+                            artifacts_dir="results/coherence_eurlex/prefilter")
+
     elif task == "check":
-        handler = OpenAIPromptHandler()
-        asyncio.run(coherence_check(handler=handler))
+        asyncio.run(run_with_handler(coherence_check, dry_run=dry_run, retry_failed=retry_failed, prefilter=prefilter))
 
     elif task == "cleaning":
-        handler = OpenAIPromptHandler()
-        asyncio.run(text_cleaning_task(handler=handler))
+        asyncio.run(run_with_handler(text_cleaning_task, dry_run=dry_run, retry_failed=retry_failed, mode=cleaning_mode))
 
         
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Process some integers.")
-    parser.add_argument('task', choices=['filtering', 'check', 'cleaning','corpus'], help='Task to perform: filtering or cleaning')
+    parser.add_argument('task', choices=['filtering', 'check', 'cleaning','corpus','calibrate'],
+                        help='Task to perform: filtering or cleaning, calibrate fits the check pre-classifier on its LLM labels')
+    parser.add_argument('--dry-run', action='store_true', help='Only project tokens, cost and time of the check/cleaning tasks')
+    parser.add_argument('--retry-failed', action='store_true', help='Only send again the check/cleaning documents in the dead-letter store')
+    parser.add_argument('--cleaning-mode', choices=['rewrite', 'spans'], default='rewrite',
+                        help="'rewrite' has the model return the cleaned text, 'spans' only the line ranges to drop, rebuilding the text locally")
+    parser.add_argument('--no-prefilter', action='store_true', help='Send every document of the check task to the LLM, skipping the local pre-classifier')
+    parser.add_argument('--near-duplicate-threshold', type=float, default=NEAR_DUPLICATE_THRESHOLD,
+                        help='Estimated Jaccard similarity above which the filtering task keeps only the first of two documents')
+    parser.add_argument('--scoring', choices=['sparse', 'dense'], default='sparse',
+                        help="'sparse' scores the filtering task's documents with a CSR matrix product, 'dense' with the MatrixSimilarity index")
+    parser.add_argument('--rebuild-index', action='store_true', help='Index and filter the whole crawl again instead of only the documents new to the TF-IDF index')
     args = parser.parse_args()
-    main(args.task)
\ No newline at end of file
+    main(args.task, dry_run=args.dry_run, retry_failed=args.retry_failed, cleaning_mode=args.cleaning_mode, prefilter=not args.no_prefilter,
+         near_duplicate_threshold=args.near_duplicate_threshold, scoring=args.scoring, rebuild_index=args.rebuild_index)
\ No newline at end of file
@@ -4,6 +4,7 @@ import re
 import json
 import argparse
 from typing import Dict
+from tasks.sink import iter_results
 
 # Define the path to the directory containing the data files
 FOLDER_PATH = "results/allresults/"
@@ -26,6 +27,21 @@ def parse(raw_text: str) -> Dict[str, str]:
             abbs_dict[abbr] = expanded.strip()
     return abbs_dict
 
+def iter_generated(file_stem: str, chunk_rows: int = 10_000):
+    """
+    Yields the url/generated_text columns of a task's results in chunks, reading <file_stem>.jsonl (a results sink
+    copied from results/<task>/processed) when present and <file_stem>.csv otherwise.
+
+    Args:
+        file_stem (str): Name of the results file in FOLDER_PATH, without extension.
+        chunk_rows (int): Rows per yielded DataFrame.
+    """
+    jsonl_file = os.path.join(FOLDER_PATH, f"{file_stem}.jsonl")
+    if os.path.exists(jsonl_file):
+        yield from iter_results(jsonl_file, chunk_rows=chunk_rows, columns=["url", "generated_text"])
+    else:
+        yield from pd.read_csv(os.path.join(FOLDER_PATH, f"{file_stem}.csv"), usecols=["url", "generated_text"], chunksize=chunk_rows)
+
 def save_json(data, file_name: str):
     """
     Save data to a JSON file.
@@ -40,35 +56,29 @@ def save_json(data, file_name: str):
     print(f"Data saved to '{output_file}'.")
 
 def process_link_retrieval():
-    csv_file = os.path.join(FOLDER_PATH, "links.csv")
-    df = pd.read_csv(csv_file)
-
     output_data = []
     law_pattern = r"^\d+\.\s*(.+)$"
 
-    for _, row in df.iterrows():
-        content, url = row['generated_text'], row['url']
-        if pd.notna(content):
-            laws = re.findall(law_pattern, content, re.MULTILINE)
-            for law in laws:
-                prompt = {
-                    "instruction": "Provide a link for {} law.",
-                    "input": law,
-                    "output": f"{law}: {url}" if url else f"{law}: Not able to find a link for the law"
-                }
-                output_data.append(prompt)
+    for df in iter_generated("links"):
+        for content, url in zip(df['generated_text'], df['url']):
+            if pd.notna(content):
+                laws = re.findall(law_pattern, content, re.MULTILINE)
+                for law in laws:
+                    prompt = {
+                        "instruction": "Provide a link for {} law.",
+                        "input": law,
+                        "output": f"{law}: {url}" if url else f"{law}: Not able to find a link for the law"
+                    }
+                    output_data.append(prompt)
 
     save_json(output_data, "link_retrieval_prompts.json")
 
 def process_abbreviation_recognition(task_type: str):
-    csv_file = os.path.join(FOLDER_PATH, f"{task_type}.csv")
-    df = pd.read_csv(csv_file)
-
     abbreviation_dict = {}
-    for _, row in df.iterrows():
-        abbreviations = row['generated_text']
-        if pd.notna(abbreviations) and abbreviations:
-            abbreviation_dict.update(parse(abbreviations))
+    for df in iter_generated(task_type):
+        for abbreviations in df['generated_text']:
+            if pd.notna(abbreviations) and abbreviations:
+                abbreviation_dict.update(parse(abbreviations))
 
     output_data = [
         {
@@ -89,14 +99,11 @@ def process_task(instruction_prompt: str, csv_file_suffix: str):
         instruction_prompt (str): Instruction template for each prompt, using '{}' as a placeholder for the term/question.
         csv_file_suffix (str): Suffix for the CSV file name to load (e.g., 'definitions' or 'qa').
     """
-    csv_file = os.path.join(FOLDER_PATH, f"{csv_file_suffix}.csv")
-    df = pd.read_csv(csv_file)
-
     result_dict = {}
-    for _, row in df.iterrows():
-        result = row['generated_text']
-        if pd.notna(result) and result:
-            result_dict.update(parse(result))
+    for df in iter_generated(csv_file_suffix):
+        for result in df['generated_text']:
+            if pd.notna(result) and result:
+                result_dict.update(parse(result))
 
     output_data = [
         {
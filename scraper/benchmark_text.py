@@ -0,0 +1,72 @@
+import time
+import logging
+import argparse
+import pandas as pd
+from text_processing import COMPOSITE_TERMS, merge_composite_terms, preprocess_texts
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# Terms sharing a word, which the str.replace passes merge into one word, checked on top of the documents
+CHAINED_TERMS = ["site navigation bar", "footer menu item", "mobile menu item", "hamburger menu item",
+                 "Home | site navigation bar | footer menu item | mobile menu item | hamburger menu item"]
+
+
+def replace_composite_terms(text:str, composite_terms:list) -> str:
+    """
+    Reference rewrite: one str.replace pass over the text per term, as the corpus file used to be written
+    """
+    for term in composite_terms:
+        new_text = text.replace(term, term.replace(" ", ""))
+        if text != new_text:
+            text = new_text
+    return text
+
+
+def timed(function, texts:list, repeat:int) -> tuple:
+    best, output = float("inf"), None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        output = [function(text) for text in texts]
+        best = min(best, time.perf_counter() - start)
+    return best, output
+
+
+def run_benchmark(args) -> dict:
+    texts = pd.read_csv(args.data, usecols=["content"])["content"].dropna().astype(str).tolist()
+    if args.documents:
+        texts = texts[:args.documents]
+    megabytes = sum(map(len, texts)) / 1e6
+
+    reference_seconds, reference = timed(lambda text: replace_composite_terms(text, COMPOSITE_TERMS), texts, args.repeat)
+    matcher_seconds, merged = timed(merge_composite_terms, texts, args.repeat)
+    mismatches = sum(a != b for a, b in zip(reference, merged))
+    chained = [text for text in CHAINED_TERMS if replace_composite_terms(text, COMPOSITE_TERMS) != merge_composite_terms(text)]
+    if chained:
+        logging.warning(f"[composite terms] the matcher differs from str.replace on {chained}")
+    mismatches += len(chained)
+    report = {"documents": len(texts),
+              "megabytes": megabytes,
+              "replace_seconds": reference_seconds,
+              "matcher_seconds": matcher_seconds,
+              "speedup": reference_seconds / max(matcher_seconds, 1e-9),
+              "mismatches": mismatches}
+    logging.info(f"[composite terms] {len(texts)} documents ({megabytes:.1f} MB): {len(COMPOSITE_TERMS)} str.replace passes "
+                 f"{reference_seconds:.2f}s, compiled matcher {matcher_seconds:.2f}s ({report['speedup']:.1f}x), "
+                 f"{mismatches} documents differ ({len(CHAINED_TERMS)} chained-term inputs included)")
+
+    if args.preprocess:
+        start = time.perf_counter()
+        preprocess_texts(merged, processes=args.processes)
+        report["preprocess_seconds"] = time.perf_counter() - start
+        logging.info(f"[preprocess] {len(texts)} documents in {report['preprocess_seconds']:.2f}s")
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark of the corpus text preprocessing of the TF-IDF pipeline")
+    parser.add_argument("--data", type=str, default="recursive_data/total/total_cleaned.csv", help="CSV with a content column")
+    parser.add_argument("--documents", type=int, default=None, help="Only use the first documents of the file")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per method, the fastest is reported")
+    parser.add_argument("--preprocess", action="store_true", help="Also time preprocess_texts over the rewritten documents")
+    parser.add_argument("--processes", type=int, default=None, help="Worker processes of preprocess_texts, all cores by default")
+    run_benchmark(parser.parse_args())
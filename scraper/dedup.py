@@ -0,0 +1,213 @@
+import os
+import re
+import zlib
+import logging
+import numpy as np
+import pandas as pd
+
+# Estimated Jaccard similarity of word shingles above which two documents are the same page
+NEAR_DUPLICATE_THRESHOLD = 0.8
+NUM_PERM = 128
+SHINGLE_SIZE = 5
+# Documents hashed and looked up together, and index entries buffered before they are merged into the sorted arrays
+BATCH_SIZE = 10_000
+FLUSH_ENTRIES = 200_000
+# Candidate pairs are verified on their signatures, so the banding favours finding pairs over skipping dissimilar ones
+FALSE_POSITIVE_WEIGHT = 0.1
+
+_MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+_MAX_HASH = np.uint64((1 << 32) - 1)
+# Odd multiplier of the rolling hashes combining tokens into shingles and signature rows into band keys
+_MIX = np.uint64(0x9E3779B97F4A7C15)
+_WORD = re.compile(r"\w+")
+
+
+def lsh_params(threshold:float, num_perm:int, false_positive_weight:float=FALSE_POSITIVE_WEIGHT) -> tuple:
+    """
+    (bands, rows) of the LSH banding whose collision curve best separates pairs above and below <threshold>,
+    weighing candidate pairs below the threshold by <false_positive_weight> and missed pairs by the rest
+    """
+    similarity = np.linspace(0, 1, 1001)
+    below, above = similarity < threshold, similarity >= threshold
+    best, best_error = (1, num_perm), float("inf")
+    for bands in range(1, num_perm + 1):
+        rows = num_perm // bands
+        collision = 1 - (1 - similarity ** rows) ** bands
+        error = (false_positive_weight * collision[below].sum() + (1 - false_positive_weight) * (1 - collision[above]).sum()) / 1000
+        if error < best_error:
+            best, best_error = (bands, rows), error
+    return best
+
+
+def shingle_hashes(text:str, shingle_size:int=SHINGLE_SIZE) -> np.ndarray:
+    """
+    Distinct 32-bit hashes of the <shingle_size>-word shingles of <text>, case and punctuation ignored
+    """
+    words = _WORD.findall(str(text).lower())
+    if not words:
+        return np.empty(0, dtype=np.uint64)
+    tokens = np.fromiter((zlib.crc32(word.encode("utf-8")) for word in words), dtype=np.uint64, count=len(words))
+    width = min(shingle_size, len(tokens))
+    hashes = np.zeros(len(tokens) - width + 1, dtype=np.uint64)
+    for offset in range(width):
+        hashes = hashes * _MIX + tokens[offset:len(tokens) - width + 1 + offset]
+    return np.unique(hashes >> np.uint64(32))
+
+
+class NearDuplicateIndex:
+    """
+    MinHash/LSH index of the documents seen so far, answering which earlier document a new one nearly duplicates.
+    Only the first document of every cluster (its representative) is indexed: its MinHash signature, kept to check
+    LSH candidates against <threshold>, and one key per band. Keys live in sorted numpy arrays, so memory stays at
+    about 4 * num_perm + 16 * bands bytes per representative and does not depend on document lengths.
+    """
+    def __init__(self, threshold:float=NEAR_DUPLICATE_THRESHOLD, num_perm:int=NUM_PERM, shingle_size:int=SHINGLE_SIZE,
+                 seed:int=1, flush_entries:int=FLUSH_ENTRIES):
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.shingle_size = shingle_size
+        self.bands, self.rows = lsh_params(threshold, num_perm)
+        self.flush_entries = flush_entries
+        self.seed = seed
+        generator = np.random.RandomState(seed)
+        self._a = generator.randint(1, 1 << 61, size=num_perm, dtype=np.uint64)[:, None]
+        self._b = generator.randint(0, 1 << 61, size=num_perm, dtype=np.uint64)[:, None]
+        # Per band: sorted keys and the representative ordinal owning each key, plus the keys added since the last merge
+        self._keys = [np.empty(0, dtype=np.uint64) for _ in range(self.bands)]
+        self._owners = [np.empty(0, dtype=np.int64) for _ in range(self.bands)]
+        self._recent = [{} for _ in range(self.bands)]
+        self._signatures = np.empty((1024, num_perm), dtype=np.uint32)
+        self._positions = np.empty(1024, dtype=np.int64)
+        self.representatives = 0
+        self.documents = 0
+
+    def signature(self, text:str) -> np.ndarray:
+        """
+        MinHash signature of the shingles of <text>
+        """
+        hashes = shingle_hashes(text, self.shingle_size)
+        signature = np.full(self.num_perm, _MAX_HASH, dtype=np.uint64)
+        for start in range(0, len(hashes), 4096):
+            block = hashes[None, start:start + 4096]
+            signature = np.minimum(signature, (((self._a * block + self._b) % _MERSENNE_PRIME) & _MAX_HASH).min(axis=1))
+        return signature.astype(np.uint32)
+
+    def band_keys(self, signatures:np.ndarray) -> np.ndarray:
+        """
+        One key per band of every signature in <signatures> (documents x num_perm), as a documents x bands array
+        """
+        rows = signatures[:, :self.bands * self.rows].astype(np.uint64).reshape(len(signatures), self.bands, self.rows)
+        keys = np.zeros((len(signatures), self.bands), dtype=np.uint64)
+        for row in range(self.rows):
+            keys = keys * _MIX + rows[:, :, row]
+        return keys
+
+    def add(self, texts:list) -> np.ndarray:
+        """
+        Indexes a batch of documents, in order after every document added before.
+
+        Returns:
+            np.ndarray: For every document, the stream position of the representative of its cluster
+            (its own position when it is not a near duplicate of an earlier document).
+        """
+        if not len(texts):
+            return np.empty(0, dtype=np.int64)
+        signatures = np.stack([self.signature(text) for text in texts])
+        keys = self.band_keys(signatures)
+        # Candidates among the merged keys are looked up for the whole batch at once
+        merged = np.full((len(texts), self.bands), -1, dtype=np.int64)
+        for band in range(self.bands):
+            if len(self._keys[band]):
+                found = np.minimum(np.searchsorted(self._keys[band], keys[:, band]), len(self._keys[band]) - 1)
+                hit = self._keys[band][found] == keys[:, band]
+                merged[hit, band] = self._owners[band][found[hit]]
+
+        representatives = np.empty(len(texts), dtype=np.int64)
+        for i, signature in enumerate(signatures):
+            candidates = {owner for owner in merged[i] if owner >= 0}
+            candidates.update(self._recent[band][key] for band, key in enumerate(keys[i].tolist()) if key in self._recent[band])
+            owner = self._best_match(signature, candidates)
+            if owner is None:
+                owner = self._insert(signature, keys[i], merged[i], self.documents + i)
+            representatives[i] = self._positions[owner]
+        self.documents += len(texts)
+        if sum(map(len, self._recent)) >= self.flush_entries:
+            self._merge()
+        return representatives
+
+    def _best_match(self, signature:np.ndarray, candidates:set):
+        best, best_similarity = None, self.threshold
+        for owner in sorted(candidates):
+            similarity = np.count_nonzero(self._signatures[owner] == signature) / self.num_perm
+            if similarity >= best_similarity:
+                best, best_similarity = owner, similarity
+        return best
+
+    def _insert(self, signature:np.ndarray, keys:np.ndarray, merged:np.ndarray, position:int) -> int:
+        owner = self.representatives
+        if owner == len(self._positions):
+            self._signatures = np.concatenate([self._signatures, np.empty_like(self._signatures)])
+            self._positions = np.concatenate([self._positions, np.empty_like(self._positions)])
+        self._signatures[owner] = signature
+        self._positions[owner] = position
+        self.representatives += 1
+        # A band key already owned by an earlier representative keeps pointing to it
+        for band, key in enumerate(keys.tolist()):
+            if merged[band] < 0:
+                self._recent[band].setdefault(key, owner)
+        return owner
+
+    def save(self, path:str) -> None:
+        """
+        Writes the index to the .npz file <path> (replaced atomically), see `load`
+        """
+        self._merge()
+        arrays = {f"keys_{band}": keys for band, keys in enumerate(self._keys)}
+        arrays.update({f"owners_{band}": owners for band, owners in enumerate(self._owners)})
+        with open(path + ".tmp", "wb") as f:
+            np.savez(f, params=np.array([self.threshold, self.num_perm, self.shingle_size, self.seed, self.documents], dtype=np.float64),
+                     signatures=self._signatures[:self.representatives], positions=self._positions[:self.representatives], **arrays)
+        os.replace(path + ".tmp", path)
+
+    @classmethod
+    def load(cls, path:str, flush_entries:int=FLUSH_ENTRIES) -> "NearDuplicateIndex":
+        """
+        Index written by `save`, which keeps deduplicating where it stopped
+        """
+        with np.load(path) as arrays:
+            threshold, num_perm, shingle_size, seed, documents = arrays["params"].tolist()
+            index = cls(threshold=threshold, num_perm=int(num_perm), shingle_size=int(shingle_size), seed=int(seed), flush_entries=flush_entries)
+            index._keys = [arrays[f"keys_{band}"] for band in range(index.bands)]
+            index._owners = [arrays[f"owners_{band}"] for band in range(index.bands)]
+            index.representatives = len(arrays["positions"])
+            index._signatures = np.concatenate([arrays["signatures"], np.empty((1024, index.num_perm), dtype=np.uint32)])
+            index._positions = np.concatenate([arrays["positions"], np.empty(1024, dtype=np.int64)])
+            index.documents = int(documents)
+        return index
+
+    def _merge(self):
+        for band in range(self.bands):
+            if not self._recent[band]:
+                continue
+            keys = np.concatenate([self._keys[band], np.fromiter(self._recent[band].keys(), dtype=np.uint64)])
+            owners = np.concatenate([self._owners[band], np.fromiter(self._recent[band].values(), dtype=np.int64)])
+            order = np.argsort(keys, kind="stable")
+            self._keys[band], self._owners[band] = keys[order], owners[order]
+            self._recent[band] = {}
+
+
+def drop_near_duplicates(df:pd.DataFrame, threshold:float=NEAR_DUPLICATE_THRESHOLD, index:NearDuplicateIndex=None,
+                         column:str="content", batch_size:int=BATCH_SIZE) -> pd.DataFrame:
+    """
+    Keeps the first document of every cluster of near duplicates of <df> (Jaccard similarity of word shingles
+    estimated at <threshold> or more). Passing the same <index> over successive chunks of a larger dataset
+    deduplicates across chunks as well.
+    """
+    index = index or NearDuplicateIndex(threshold=threshold)
+    start = index.documents
+    contents = df[column].fillna("").astype(str).tolist()
+    representatives = np.concatenate([index.add(contents[i:i + batch_size]) for i in range(0, len(contents), batch_size)] or
+                                     [np.empty(0, dtype=np.int64)])
+    keep = representatives == np.arange(start, start + len(contents))
+    logging.info(f"Near-duplicate filter (Jaccard >= {index.threshold}): dropped {len(df) - keep.sum()} of {len(df)} documents")
+    return df[keep]
@@ -6,8 +6,8 @@ import logging
 import traceback
 import random
 import requests
-import tiktoken
 import os
+import sys
 import re
 import numpy as np
 import time
@@ -15,8 +15,16 @@ from gensim import corpora, models, similarities
 from gensim.parsing.porter import PorterStemmer
 from nltk.tokenize import RegexpTokenizer
 from gensim.parsing.preprocessing import remove_stopwords
+from dedup import drop_near_duplicates
+try:
+    from tasks.tokens import token_counter
+except ModuleNotFoundError:
+    # Run as a script from the scraper directory, the tasks package sits next to it
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from tasks.tokens import token_counter
 
-encoding = tiktoken.encoding_for_model("gpt-4o-mini")
+# Token counts are memoized by content hash, so documents already counted by another stage are not encoded again
+tokens = token_counter("gpt-4o-mini")
 
 
 
@@ -81,9 +89,9 @@ def preprocess_text(text: str):
     doc_stem = p.stem_sentence(doc_sw)
     return tokenizer.tokenize(doc_stem)
 
-def num_tokens_from_string(string, encoding) -> int:
+def num_tokens_from_string(string, tokens) -> int:
     """Returns the number of tokens in a text string."""
-    num_tokens = len(encoding.encode(string))
+    num_tokens = tokens.count(string)
     return num_tokens
 
 def score_new_document(text_input, pos_query=pos_query, neg_query=neg_query):
@@ -123,28 +131,6 @@ def score_new_document(text_input, pos_query=pos_query, neg_query=neg_query):
     return final_score
 
 
-def truncate_text(text, tokenizer, max_tokens=128000, target_tokens=115000):
-    """
-    Truncates the text to a target token count if it exceeds the maximum allowed tokens.
-
-    Args:
-    text (str): The text to be processed.
-    tokenizer: The tokenizer instance used to tokenize the text.
-    max_tokens (int): The maximum number of tokens allowed before truncation.
-    target_tokens (int): The target number of tokens for truncation.
-
-    Returns:
-    str: The processed text.
-    """
-    # Tokenize the text and check the number of tokens
-    tokens = tokenizer.encode(text)
-    if len(tokens) > max_tokens:
-        # Truncate the tokens to the target number and decode back to text
-        truncated_tokens = tokens[:target_tokens]
-        return tokenizer.decode(truncated_tokens)
-    return text
-
-
 if __name__ == "__main__":
     # url = "https://cdm.finos.org/docs/home"
     # response = requests.get(url)
@@ -166,7 +152,7 @@ if __name__ == "__main__":
     #         logging.error(f"Could not get information for page {link}. Error: {traceback.print_exc()}")
 
 
-    # logging.info(f"Scraped document has {num_tokens_from_string(text, encoding)} tokens")
+    # logging.info(f"Scraped document has {num_tokens_from_string(text, tokens)} tokens")
 
     # df = (pd.DataFrame()
     #  .assign(url= ["CDM docs"])
@@ -185,14 +171,14 @@ if __name__ == "__main__":
 
     df1 = (df1
            .assign(task = "")
-           .assign(total_tokens = df1["content"].apply(lambda x: num_tokens_from_string(x,encoding)))
+           .assign(total_tokens = tokens.count_many(df1["content"]))
            .assign(generated_text = "")
            .assign(costs = 0)
            )
     
     df2 = (df2
            .assign(task = "")
-           .assign(total_tokens = df2["content"].apply(lambda x: num_tokens_from_string(x,encoding)))
+           .assign(total_tokens = tokens.count_many(df2["content"]))
            .assign(generated_text = "")
            .assign(costs = 0)
            )
@@ -200,7 +186,7 @@ if __name__ == "__main__":
     df3 = (df3
            .dropna()
            .assign(task = "")
-           .assign(total_tokens = df3["content"].apply(lambda x: num_tokens_from_string(x,encoding)))
+           .assign(total_tokens = tokens.count_many(df3["content"]))
            .assign(generated_text = "")
            .assign(costs = 0)
            )
@@ -208,7 +194,7 @@ if __name__ == "__main__":
     df4 = (df4
            .dropna()
            .assign(task = "")
-           .assign(total_tokens = df4["content"].apply(lambda x: num_tokens_from_string(x,encoding)))
+           .assign(total_tokens = tokens.count_many(df4["content"]))
            .assign(generated_text = "")
            .assign(costs = 0)
            )
@@ -216,13 +202,15 @@ if __name__ == "__main__":
     df5 = (df5
            .dropna()
            .assign(task = "")
-           .assign(total_tokens = df5["content"].apply(lambda x: num_tokens_from_string(x,encoding)))
+           .assign(total_tokens = tokens.count_many(df5["content"]))
            .assign(generated_text = "")
            .assign(costs = 0)
            )
 
 
     total_df = pd.concat([df,df1,df2,df3,df4, df5],ignore_index=True)
-    total_df = total_df.assign(content = total_df["content"].apply(lambda x: truncate_text(x, encoding, max_tokens=120000)))
+    # Documents are kept whole, the handler splits the ones over the context window into chunks (tasks/chunking.py)
     total_df = total_df.drop_duplicates()
+    # The same page crawled under several urls (query strings, print views) is sent to the LLM tasks only once
+    total_df = drop_near_duplicates(total_df)
     total_df.to_csv("results/cleaning/cleaning.csv",index=False)
@@ -1,8 +1,14 @@
 import requests
 import os
+import sys
 import pypdf
 import pandas as pd
-import tiktoken
+try:
+    from tasks.tokens import token_counter
+except ModuleNotFoundError:
+    # Run as a script from the scraper directory, the tasks package sits next to it
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from tasks.tokens import token_counter
 
 def download_file(link, download_dir="downloads"):
     try:
@@ -29,8 +35,8 @@ def extract_text_from_pdf(pdf_path):
         print(f"Error occurred while reading PDF: {e}")
         return None
 
-def create_token_chunks(text, encoding, chunk_size=123000, overlap=400):
-    tokens = encoding.encode(text)
+def create_token_chunks(text, counter, chunk_size=123000, overlap=400):
+    tokens = counter.encode(text)
     chunks = []
     num_tokens = len(tokens)
     chunk_number = 0
@@ -43,7 +49,7 @@ def create_token_chunks(text, encoding, chunk_size=123000, overlap=400):
         end = start + chunk_size
         if end > num_tokens:
             end = num_tokens
-        chunks.append((chunk_number, encoding.decode(tokens[start:end])))
+        chunks.append((chunk_number, counter.decode(tokens[start:end])))
         chunk_number += 1
 
     return chunks
@@ -56,8 +62,7 @@ def main():
     if pdf_path:
         text = extract_text_from_pdf(pdf_path)
         if text:
-            encoding = tiktoken.encoding_for_model("gpt-4o-mini")
-            chunks = create_token_chunks(text, encoding)
+            chunks = create_token_chunks(text, token_counter("gpt-4o-mini"))
             for i, chunk in enumerate(chunks):
                 content.append((f"chunk_{i}", chunk))
 
@@ -0,0 +1,205 @@
+import os
+import re
+from functools import lru_cache, partial
+from itertools import chain, islice
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from gensim import utils
+from gensim.parsing.porter import PorterStemmer
+from gensim.parsing.preprocessing import STOPWORDS
+from nltk.tokenize import RegexpTokenizer
+
+# Distinct words whose tokens are memoized per process; crawls have a long tail of one-off strings past this
+STEM_CACHE_SIZE = 1_000_000
+# Documents sent to a worker at a time, and inputs under which the pool costs more than it saves
+CHUNK_SIZE = 64
+MIN_PARALLEL_DOCUMENTS = 256
+
+# Multi-word terms written as one word in the TF-IDF corpus, so they count as a single feature
+COMPOSITE_TERMS = [
+    "market abuse", "payment system", "anti money laundering", "know your customer",
+    "capital requirement", "financial service", "banking law", "securities regulation",
+    "corporate governance", "fiduciary duty", "disclosure requirements", "risk management",
+    "financial stability", "consumer protection", "data protection", "financial crime",
+    "fraud prevention", "insider trading", "conflict of interest", "reporting obligation",
+    "whistleblower protection", "ethical standards", "financial oversight", "investment guideline",
+    "tax law", "fiscal policy", "monetary policy", "currency regulation", "exchange control",
+    "credit regulation", "insurance regulation", "pension regulation", "financial instrument",
+    "financial market infrastructure", "clearing and settlement", "digital currency",
+    "blockchain", "cryptocurrency", "initial coin offering", "electronic money", "payment service",
+    "crowdfunding", "peer to peer lending", "robo advisory", "virtual asset", "financial innovation","user interface", "user experience", "hamburger menu", "footer menu", "social media links", 
+"privacy policy", "terms of use", "disclaimer", "FAQ", "frequently asked questions", "search bar", 
+"login form", "sign up", "account settings", "site map", "accessibility", "mobile menu", "responsive design", "click here", "more info", "gallery", "portfolio", "legal notice", "back to top", "scroll to", "navigation bar", "menu item", 
+"site navigation", "page layout", "web development", "web design", "web service", "secure connection", "domain name", "web hosting", "cloud hosting", "content management system"
+]
+
+
+class TextPreprocessor:
+    """
+    Lowercasing, gensim stopword removal, Porter stemming and nltk \\w+ tokenization of documents, with one stemmer
+    and tokenizer for all calls and the tokens of every word memoized. Stemming and tokenization work word by word,
+    so caching them per word gives the same tokens as stemming the whole document and tokenizing the result.
+    """
+    def __init__(self, cache_size:int=STEM_CACHE_SIZE):
+        self.stemmer = PorterStemmer()
+        # nltk matches \w with the regex module, which also counts combining marks as word characters
+        self.tokenizer = RegexpTokenizer(r'\w+')
+        self.cache_size = cache_size
+        self._tokens = {}
+
+    def word_tokens(self, word:str) -> tuple:
+        tokens = self._tokens.get(word)
+        if tokens is None:
+            tokens = tuple(self.tokenizer.tokenize(self.stemmer.stem(word)))
+            if len(self._tokens) < self.cache_size:
+                self._tokens[word] = tokens
+        return tokens
+
+    def preprocess(self, text) -> list:
+        """
+        Tokens of <text> (str, or bytes as read from a corpus file)
+        """
+        text = utils.to_unicode(text.strip().lower())
+        tokens = []
+        for word in text.split():
+            if word not in STOPWORDS:
+                tokens.extend(self.word_tokens(word))
+        return tokens
+
+
+_preprocessor = TextPreprocessor()
+
+
+def preprocess_text(text) -> list:
+    """
+    Tokens of <text> with the preprocessor shared by the calls of this process
+    """
+    return _preprocessor.preprocess(text)
+
+
+def _preprocess_chunk(texts:list, composite_terms:tuple=None) -> list:
+    if composite_terms is None:
+        return [_preprocessor.preprocess(text) for text in texts]
+    return [corpus_tokens(text, composite_terms) for text in texts]
+
+
+def corpus_tokens(text, composite_terms:tuple) -> tuple:
+    """
+    (tokens of the corpus line of <text> (see `corpus_text`), distinct tokens of its raw text). The dictionary used to
+    be built from the raw texts, so tokens only corpus lines have (merged composite terms, words glued across lines)
+    are only features when some document's raw text has them as well, see `tfidf_index.serialize_corpus`.
+    """
+    return _preprocessor.preprocess(corpus_text(text, composite_terms)), set(_preprocessor.preprocess(text))
+
+
+def iter_preprocessed(texts, processes:int=None, chunk_size:int=CHUNK_SIZE, composite_terms:list=None):
+    """
+    Yields the tokens of every document of the iterable <texts>, in order, spread in chunks of <chunk_size> documents
+    over <processes> worker processes (all cores by default). At most two chunks per worker are in flight, so memory
+    does not grow with the input. Small inputs or processes=1 run in this process.
+    With <composite_terms>, yields the (corpus line tokens, raw text tokens) of every document instead, see `corpus_tokens`.
+    """
+    work = partial(_preprocess_chunk, composite_terms=tuple(composite_terms) if composite_terms is not None else None)
+    texts = iter(texts)
+    processes = processes or os.cpu_count() or 1
+    head = list(islice(texts, MIN_PARALLEL_DOCUMENTS))
+    if processes == 1 or len(head) < MIN_PARALLEL_DOCUMENTS:
+        yield from work(head)
+        for text in texts:
+            yield from work([text])
+        return
+    texts = chain(head, texts)
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        pending = deque()
+        while True:
+            while len(pending) < 2 * processes:
+                chunk = list(islice(texts, chunk_size))
+                if not chunk:
+                    break
+                pending.append(pool.submit(work, chunk))
+            if not pending:
+                return
+            yield from pending.popleft().result()
+
+
+def preprocess_texts(texts:list, processes:int=None, chunk_size:int=CHUNK_SIZE) -> list:
+    """
+    Tokens of every document of <texts>, see `iter_preprocessed`
+    """
+    return list(iter_preprocessed(texts, processes=processes, chunk_size=chunk_size))
+
+
+class CompositeTermMatcher:
+    """
+    Rewrites every occurrence of the multi-word <terms> without their spaces in a single scan of the text.
+    The pattern is anchored at the first space of a term and branches over a trie of what follows it, so the regex
+    engine only wakes up at spaces; lookbehinds at the trie leaves check the word before the space. At every
+    position the longest term wins, and a term whose first word ends a term just merged extends that merge
+    ("site navigation bar" becomes "sitenavigationbar"), as the later of the str.replace passes it replaces would.
+    Terms without spaces would be left as they are and are not matched.
+    """
+    def __init__(self, terms:list):
+        self._heads = {}
+        for term in sorted(set(terms), key=len, reverse=True):
+            if " " in term:
+                head, tail = term.split(" ", 1)
+                self._heads.setdefault(tail, []).append(head)
+        trie = {}
+        for tail in self._heads:
+            node = trie
+            for character in tail:
+                node = node.setdefault(character, {})
+            node[None] = tail
+        self._pattern = re.compile(" " + self._branch(trie)) if trie else None
+
+    def _branch(self, node:dict) -> str:
+        alternatives = [re.escape(character) + self._branch(child) for character, child in sorted((k, v) for k, v in node.items() if k is not None)]
+        if None in node:
+            # Tried after the longer tails, and only accepted when one of the head words precedes the space
+            tail = node[None]
+            alternatives.append("(?:" + "|".join(f"(?<={re.escape(head + ' ' + tail)})" for head in self._heads[tail]) + ")")
+        return alternatives[0] if len(alternatives) == 1 else "(?:" + "|".join(alternatives) + ")"
+
+    def merge(self, text:str) -> str:
+        if self._pattern is None:
+            return text
+        pieces, last = [], 0
+        for match in self._pattern.finditer(text):
+            tail, space = match.group(0)[1:], match.start()
+            head = next((head for head in self._heads[tail] if text.startswith(head, space - len(head))
+                         and (space - len(head) >= last or space == last)), None)
+            if head is None:
+                continue
+            if space - len(head) < last:
+                # The head ends a term merged just before ("site navigation" + "navigation bar"): the merge is
+                # extended, as the str.replace pass of the later term would find it in the merged text
+                pieces.append(tail.replace(" ", ""))
+            else:
+                pieces.append(text[last:space - len(head)])
+                pieces.append(head + tail.replace(" ", ""))
+            last = match.end()
+        if not pieces:
+            return text
+        pieces.append(text[last:])
+        return "".join(pieces)
+
+
+@lru_cache(maxsize=8)
+def composite_matcher(terms:tuple) -> CompositeTermMatcher:
+    return CompositeTermMatcher(list(terms))
+
+
+def merge_composite_terms(text:str, terms:list=COMPOSITE_TERMS) -> str:
+    """
+    <text> with the composite <terms> written without spaces, as in the TF-IDF corpus file
+    """
+    return composite_matcher(tuple(terms)).merge(text)
+
+
+def corpus_text(text:str, composite_terms:list=COMPOSITE_TERMS) -> str:
+    """
+    <text> as one line of the TF-IDF corpus: composite terms merged, newlines removed and characters utf-8
+    cannot encode dropped
+    """
+    text = merge_composite_terms(text, composite_terms).replace('\n', '')
+    return text.encode('utf-8', errors='ignore').decode('utf-8')
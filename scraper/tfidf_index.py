@@ -0,0 +1,192 @@
+import os
+import json
+import shutil
+import logging
+import numpy as np
+import pandas as pd
+from gensim import corpora, models, similarities, matutils
+from scipy import sparse
+from tasks.journal import content_hash
+from scraper.text_processing import preprocess_text, iter_preprocessed, COMPOSITE_TERMS
+from scraper.dedup import NearDuplicateIndex
+
+# Kept apart from the midict.dict/corpus.mm/similmatrix.index that scraper_recursive.py loads from the working directory
+TFIDF_INDEX_DIR = "recursive_data/tfidf_index"
+DICTIONARY_FILE = "dictionary.dict"
+DOCUMENTS_FILE = "documents.jsonl"
+SHARDS_DIR = "shards"
+NEAR_DUPLICATES_FILE = "near_duplicates.npz"
+VOCABULARY_FILE = "vocabulary.txt"
+
+
+def score_documents(tfidf, dictionary, corpus, pos_query:str, neg_query:str, scoring:str="sparse") -> np.ndarray:
+    """
+    Positive minus negative query cosine similarity of every document of <corpus>, in corpus order.
+    "sparse" keeps the unit-length tfidf rows as a CSR matrix and multiplies it by both queries at once;
+    "dense" goes through a MatrixSimilarity index, which needs memory for every document x vocabulary cell.
+    """
+    query_vectors = [tfidf[dictionary.doc2bow(preprocess_text(query))] for query in (pos_query, neg_query)]
+    if scoring == "dense":
+        index = similarities.MatrixSimilarity(tfidf[corpus], num_features=len(dictionary))
+        return index[query_vectors[0]] - index[query_vectors[1]]
+    matrix = matutils.corpus2csc(tfidf[corpus], num_terms=len(dictionary), dtype=np.float32).T.tocsr()
+    norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1), dtype=np.float32)).ravel()
+    matrix = sparse.diags(np.divide(1, norms, out=np.zeros_like(norms), where=norms > 0)) @ matrix
+    queries = np.stack([matutils.sparse2full(matutils.unitvec(vector), len(dictionary)) for vector in query_vectors], axis=1)
+    sims = matrix @ queries
+    return sims[:, 0] - sims[:, 1]
+
+
+def serialize_corpus(documents, dictionary:corpora.Dictionary, mm_path:str, vocabulary:set) -> None:
+    """
+    Writes the bags of words of <documents>, the (corpus tokens, raw tokens) of `iter_preprocessed`, to the MmCorpus
+    at <mm_path>, adding them to <dictionary>. Only tokens in the raw text of some document are kept, as when the
+    dictionary was built from the raw texts: <vocabulary> holds the raw tokens of the documents written before and is
+    updated with these. The documents go through a scratch corpus next to <mm_path>, streamed into the final one once
+    every raw text has been read, so they are tokenized once and not held in memory.
+    """
+    scratch, scratch_path = corpora.Dictionary(), mm_path + ".scratch"
+
+    def scratch_bows():
+        for tokens, raw_tokens in documents:
+            vocabulary.update(raw_tokens)
+            yield scratch.doc2bow(tokens, allow_update=True)
+    corpora.MmCorpus.serialize(scratch_path, scratch_bows())
+
+    features = {term_id: token for token, term_id in scratch.token2id.items() if token in vocabulary}
+    bows = (dictionary.doc2bow([features[term_id] for term_id, count in bow if term_id in features for _ in range(int(count))], allow_update=True)
+            for bow in corpora.MmCorpus(scratch_path))
+    corpora.MmCorpus.serialize(mm_path, bows)
+    for path in (scratch_path, scratch_path + ".index"):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+class TfidfIndex:
+    """
+    TF-IDF index that grows with every crawl batch instead of being rebuilt.
+    The dictionary holds the document frequencies of every document added so far, each batch's bags of words are
+    appended as one MmCorpus shard, and documents.jsonl records the (url, content hash) and score of every indexed
+    document. IDF weights are recomputed from the dictionary alone, so adding a batch costs time proportional to the
+    batch, and its scores are the ones a full rebuild over all the documents, in the same order, would give them.
+    Earlier batches keep the scores they got with the IDF of their time and are not rescored, so scores of different
+    batches drift apart as the document frequencies change; `rebuild` puts them all on the current IDF again.
+    The MinHash/LSH index of the documents seen is kept next to it (see `near_duplicate_index`), so a page crawled
+    again under another URL is caught in a later batch as well.
+    The raw-text vocabulary of the documents added is kept as well (see `serialize_corpus`); a word glued across lines
+    in an earlier batch that only appears in the raw text of a later one is only a feature of the later batches.
+    """
+    def __init__(self, directory:str=TFIDF_INDEX_DIR, composite_terms:list=COMPOSITE_TERMS):
+        self.directory = directory
+        self.composite_terms = composite_terms
+        os.makedirs(os.path.join(directory, SHARDS_DIR), exist_ok=True)
+        dictionary_path = os.path.join(directory, DICTIONARY_FILE)
+        self.dictionary = corpora.Dictionary.load(dictionary_path) if os.path.exists(dictionary_path) else corpora.Dictionary()
+        vocabulary_path = os.path.join(directory, VOCABULARY_FILE)
+        if os.path.exists(vocabulary_path):
+            with open(vocabulary_path, "r", encoding="utf-8") as f:
+                self.vocabulary = set(f.read().split("\n")) - {""}
+        else:
+            # Indexes written before the vocabulary was kept take their dictionary as it
+            self.vocabulary = set(self.dictionary.token2id)
+        self._keys = set()
+        documents_path = os.path.join(directory, DOCUMENTS_FILE)
+        if os.path.exists(documents_path):
+            with open(documents_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    if line.strip():
+                        entry = json.loads(line)
+                        self._keys.add((entry["url"], entry["content_hash"]))
+
+    @classmethod
+    def rebuild(cls, directory:str=TFIDF_INDEX_DIR, composite_terms:list=COMPOSITE_TERMS) -> "TfidfIndex":
+        """
+        Empty index at <directory>, dropping whatever was indexed there
+        """
+        shutil.rmtree(directory, ignore_errors=True)
+        return cls(directory, composite_terms)
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def new_documents(self, df:pd.DataFrame) -> pd.DataFrame:
+        """
+        Rows of <df> whose (url, content) is not indexed yet
+        """
+        return df[[(str(url), content_hash(content)) not in self._keys for url, content in zip(df["url"], df["content"])]]
+
+    def near_duplicate_index(self, threshold:float) -> NearDuplicateIndex:
+        """
+        Near-duplicate index of every document seen by earlier batches, a new one when there is none yet
+        or it was built for another threshold
+        """
+        path = os.path.join(self.directory, NEAR_DUPLICATES_FILE)
+        if os.path.exists(path):
+            index = NearDuplicateIndex.load(path)
+            if index.threshold == threshold:
+                return index
+            logging.warning(f"Near-duplicate index at {path} was built for threshold {index.threshold}, starting a new one")
+        return NearDuplicateIndex(threshold=threshold)
+
+    def save_near_duplicate_index(self, index:NearDuplicateIndex) -> None:
+        index.save(os.path.join(self.directory, NEAR_DUPLICATES_FILE))
+
+    def tfidf(self) -> models.TfidfModel:
+        return models.TfidfModel(dictionary=self.dictionary)
+
+    def shards(self) -> list:
+        shards_dir = os.path.join(self.directory, SHARDS_DIR)
+        return sorted(os.path.join(shards_dir, name) for name in os.listdir(shards_dir) if name.endswith(".mm"))
+
+    def add(self, df:pd.DataFrame, pos_query:str, neg_query:str, scoring:str="sparse") -> pd.DataFrame:
+        """
+        Indexes the documents of <df> (all assumed new, see `new_documents`) and scores them against the queries
+        with the IDF of the updated index.
+
+        Returns:
+            pd.DataFrame: <df> with a 'score' column.
+        """
+        if df.empty:
+            return df.assign(score=pd.Series(dtype=np.float32))
+        shard_path = os.path.join(self.directory, SHARDS_DIR, f"corpus_{len(self.shards()):05d}.mm")
+        # One tokenization of the batch: bags of words written to the shard, document frequencies updated on the way
+        serialize_corpus(iter_preprocessed(df["content"], composite_terms=self.composite_terms), self.dictionary, shard_path, self.vocabulary)
+        scores = score_documents(self.tfidf(), self.dictionary, corpora.MmCorpus(shard_path), pos_query, neg_query, scoring)
+
+        dictionary_path = os.path.join(self.directory, DICTIONARY_FILE)
+        self.dictionary.save(dictionary_path + ".tmp")
+        os.replace(dictionary_path + ".tmp", dictionary_path)
+        vocabulary_path = os.path.join(self.directory, VOCABULARY_FILE)
+        with open(vocabulary_path + ".tmp", "w", encoding="utf-8") as f:
+            f.write("\n".join(sorted(self.vocabulary)))
+        os.replace(vocabulary_path + ".tmp", vocabulary_path)
+        scored = df.assign(score=scores)
+        with open(os.path.join(self.directory, DOCUMENTS_FILE), "a", encoding="utf-8") as f:
+            for url, content, source, score in zip(scored["url"], scored["content"], scored["source"], scored["score"]):
+                key = (str(url), content_hash(content))
+                self._keys.add(key)
+                f.write(json.dumps({"url": key[0], "content_hash": key[1], "source": source, "score": float(score)}) + "\n")
+        logging.info(f"TF-IDF index at {self.directory}: added {len(df)} documents, {len(self)} distinct documents seen, "
+                     f"{len(self.dictionary)} terms")
+        return scored
+
+    def skip(self, df:pd.DataFrame) -> None:
+        """
+        Records the documents of <df> as seen without indexing them (too short, near duplicates), so later batches
+        do not pick them up as new
+        """
+        with open(os.path.join(self.directory, DOCUMENTS_FILE), "a", encoding="utf-8") as f:
+            for url, content, source in zip(df["url"], df["content"], df["source"]):
+                key = (str(url), content_hash(content))
+                self._keys.add(key)
+                f.write(json.dumps({"url": key[0], "content_hash": key[1], "source": source, "score": None}) + "\n")
+
+    def scores(self) -> pd.DataFrame:
+        """
+        Source and score of every document seen, each scored with the IDF of the index when it was added
+        (missing for skipped documents), so scores of batches far apart are only roughly comparable
+        """
+        documents_path = os.path.join(self.directory, DOCUMENTS_FILE)
+        if not os.path.exists(documents_path):
+            return pd.DataFrame(columns=["url", "content_hash", "source", "score"])
+        return pd.read_json(documents_path, lines=True, dtype={"url": str, "content_hash": str})
@@ -0,0 +1,80 @@
+import os
+import glob
+import json
+import logging
+
+# Azure OpenAI global batch endpoint for chat completions
+BATCH_URL = "/chat/completions"
+# Batch jobs are billed at half the price of the equivalent live calls
+BATCH_DISCOUNT = 0.5
+# Provider limits per input file
+MAX_REQUESTS_PER_SHARD = 100_000
+MAX_BYTES_PER_SHARD = 190 * 1024 * 1024
+
+
+def batch_request(custom_id:str, deployment_name:str, messages:list, temperature:float) -> dict:
+    """
+    One line of a batch input file
+    """
+    return {"custom_id": custom_id,
+            "method": "POST",
+            "url": BATCH_URL,
+            "body": {"model": deployment_name, "messages": messages, "temperature": temperature}}
+
+
+def write_request_shards(requests, batch_dir:str, max_requests:int=MAX_REQUESTS_PER_SHARD, max_bytes:int=MAX_BYTES_PER_SHARD) -> list:
+    """
+    Writes batch request dicts into requests_<n>.jsonl files that stay under the provider's per-file limits.
+
+    Returns:
+        list: Paths of the written shards.
+    """
+    os.makedirs(batch_dir, exist_ok=True)
+    # Shards from a previous preparation would otherwise be uploaded again
+    for stale_path in glob.glob(os.path.join(batch_dir, "requests_*.jsonl")):
+        os.remove(stale_path)
+    shard_paths = []
+    shard = None
+    shard_requests = shard_bytes = 0
+    for request in requests:
+        line = (json.dumps(request, ensure_ascii=False) + "\n").encode("utf-8")
+        if shard is None or shard_requests >= max_requests or shard_bytes + len(line) > max_bytes:
+            if shard is not None:
+                shard.close()
+            shard_paths.append(os.path.join(batch_dir, f"requests_{len(shard_paths):03d}.jsonl"))
+            shard = open(shard_paths[-1], "wb")
+            shard_requests = shard_bytes = 0
+        shard.write(line)
+        shard_requests += 1
+        shard_bytes += len(line)
+    if shard is not None:
+        shard.close()
+    return shard_paths
+
+
+def read_batch_results(result_paths:list):
+    """
+    Iterates over batch output files.
+
+    Yields:
+        tuple: (custom_id, chat completion body or None, error message or None)
+    """
+    for path in result_paths:
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                result = json.loads(line)
+                response = result.get("response") or {}
+                if result.get("error") or response.get("status_code") != 200:
+                    error = result.get("error") or response.get("body", {}).get("error")
+                    yield result["custom_id"], None, json.dumps(error)
+                else:
+                    yield result["custom_id"], response["body"], None
+
+
+def find_result_files(batch_dir:str) -> list:
+    result_paths = sorted(glob.glob(os.path.join(batch_dir, "results_*.jsonl")))
+    if not result_paths:
+        logging.warning(f"No results_*.jsonl files found in {batch_dir}")
+    return result_paths
@@ -0,0 +1,89 @@
+import os
+import time
+import asyncio
+import logging
+import argparse
+import tempfile
+import pandas as pd
+from mock_server import start_mock_server, add_config_arguments, config_from_args
+from prompts import PROMPT_ABBREV, PROMPT_DEFS, PROMPT_LINKS, SYSTEM_PROMPT_GENERAL, QA_SYSTEM, PROMPT_QA_TASK, CDM_SYSTEM, PROMPT_CDM_TASK, PROMPT_NER
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+BENCHMARK_TASKS = {
+    "abbrev": (PROMPT_ABBREV, SYSTEM_PROMPT_GENERAL),
+    "definitions": (PROMPT_DEFS, SYSTEM_PROMPT_GENERAL),
+    "links": (PROMPT_LINKS, SYSTEM_PROMPT_GENERAL),
+    "qa_task": (PROMPT_QA_TASK, QA_SYSTEM),
+    "cdm_task": (PROMPT_CDM_TASK, CDM_SYSTEM),
+    "ner_task": (PROMPT_NER, SYSTEM_PROMPT_GENERAL),
+}
+
+
+def synthetic_corpus(documents:int, mean_words:int) -> pd.DataFrame:
+    """
+    Documents with a long-tailed length distribution, similar to the cleaned crawl
+    """
+    lengths = [max(50, int(mean_words * (0.2 + (i % 10) ** 2 / 30))) for i in range(documents)]
+    return pd.DataFrame({"url": [f"https://mock.local/doc/{i}" for i in range(documents)],
+                         "source": "MOCK",
+                         "content": [f"Document {i}. " + " ".join(["regulation"] * length) for i, length in enumerate(lengths)]})
+
+
+async def run_benchmark(args) -> dict:
+    server = start_mock_server(config_from_args(args))
+    os.environ["AZURE_OPENAI_ENDPOINT"] = f"http://127.0.0.1:{server.server_address[1]}"
+    os.environ["AZURE_OPENAI_API_KEY"] = "mock"
+    os.environ["AZURE_OPENAI_CHAT_DEPLOYMENT_NAME"] = "mock"
+    os.environ.pop("AZURE_OPENAI_DEPLOYMENTS", None)
+    from utils import OpenAIPromptHandler
+
+    handler = OpenAIPromptHandler(requests_per_minute=args.rpm, tokens_per_minute=args.tpm_limit,
+                                  transport=args.transport, cache_path="",
+                                  deadline_scale=args.deadline_scale, hedge_quantile=args.hedge_quantile,
+                                  prompt_layout=args.prompt_layout)
+    data = pd.read_csv(args.data).head(args.documents) if args.data else synthetic_corpus(args.documents, args.mean_words)
+
+    start = time.monotonic()
+    with tempfile.TemporaryDirectory() as results_root:
+        jobs = [{"results_dir": os.path.join(results_root, task),
+                 "data": data,
+                 "task": task,
+                 "task_prompt": BENCHMARK_TASKS[task][0],
+                 "system_prompt": BENCHMARK_TASKS[task][1],
+                 "batch_size": args.batch_size} for task in args.tasks]
+        if args.sequential:
+            for job in jobs:
+                await handler.execute_task(**job)
+        else:
+            await handler.execute_tasks(jobs)
+    wall_clock = time.monotonic() - start
+    await handler.close()
+    server.shutdown()
+
+    report = handler.stats.summary()
+    report["wall_clock_seconds"] = wall_clock
+    logging.info(f"[benchmark] {report['requests']} requests ({report['errors']} errors) in {wall_clock:.1f}s: "
+                 f"{report['requests_per_second']:.2f} req/s, p50 {report['p50_latency']:.2f}s, p95 {report['p95_latency']:.2f}s, "
+                 f"p99 {report['p99_latency']:.2f}s, {report['hedges']} hedged ({report['hedge_wins']} won), "
+                 f"{report['timeouts']} timed out, {report['cached_prompt_share']:.0%} of prompt tokens cached, "
+                 f"idle {report['idle_seconds']:.1f}s")
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Throughput benchmark of the prompt pipeline against a local mock endpoint")
+    parser.add_argument("--tasks", nargs="+", choices=list(BENCHMARK_TASKS), default=["abbrev"])
+    parser.add_argument("--documents", type=int, default=200)
+    parser.add_argument("--mean-words", type=int, default=2000, help="Mean length of the synthetic documents")
+    parser.add_argument("--data", type=str, default=None, help="CSV with url/source/content columns to use instead of synthetic documents")
+    parser.add_argument("--batch-size", type=int, default=30)
+    parser.add_argument("--rpm", type=int, default=6000, help="Handler requests-per-minute limit")
+    parser.add_argument("--tpm-limit", type=int, default=10_000_000, help="Handler tokens-per-minute limit")
+    parser.add_argument("--transport", choices=["async", "thread"], default="async")
+    parser.add_argument("--deadline-scale", type=float, default=1.0, help="Multiplier of the per-request deadlines")
+    parser.add_argument("--hedge-quantile", type=float, default=95, help="Latency percentile after which requests are hedged, 0 disables hedging")
+    parser.add_argument("--prompt-layout", choices=["template", "document-first"], default="template")
+    parser.add_argument("--sequential", action="store_true", help="Run the tasks one after the other instead of through a single scheduler")
+    add_config_arguments(parser)
+    asyncio.run(run_benchmark(parser.parse_args()))
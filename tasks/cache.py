@@ -0,0 +1,110 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+
+# Puts between two sweeps of expired entries; eviction for size runs as soon as the running total goes over the cap
+EVICT_EVERY = 1000
+
+
+class ResponseCache:
+    """
+    Persistent, content-addressed cache of chat completions stored in SQLite.
+    Entries are keyed by a hash of everything that determines the answer (deployment, system prompt,
+    rendered prompt and temperature) and evicted by age and by total stored size. The stored size is kept as a running
+    total, so a put costs one insert rather than a scan of the table.
+    """
+    def __init__(self, path:str, max_size_mb:float=2048, max_age_days:float=90):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.path = path
+        self.max_size_bytes = int(max_size_mb * 1024 * 1024)
+        self.max_age_seconds = max_age_days * 24 * 3600
+        self.hits = 0
+        self.misses = 0
+        self._puts = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            )""")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_accessed_at ON responses (accessed_at)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_created_at ON responses (created_at)")
+        self._conn.commit()
+        self._total_size = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        self.evict()
+
+    @staticmethod
+    def make_key(deployment:str, system_prompt:str, prompt:str, temperature:float) -> str:
+        payload = json.dumps([deployment, system_prompt, prompt, temperature], ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key:str):
+        """
+        Returns the stored value for <key> or None, updating the hit/miss counters
+        """
+        with self._lock:
+            row = self._conn.execute("SELECT value, created_at FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None or time.time() - row[1] > self.max_age_seconds:
+                self.misses += 1
+                return None
+            self._conn.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (time.time(), key))
+            self._conn.commit()
+            self.hits += 1
+            return row[0]
+
+    def put(self, key:str, value:str) -> None:
+        now = time.time()
+        size = len(value.encode("utf-8"))
+        with self._lock:
+            replaced = self._conn.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            self._conn.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)", (key, value, size, now, now))
+            self._conn.commit()
+            self._total_size += size - (replaced[0] if replaced else 0)
+            self._puts += 1
+            due = self._total_size > self.max_size_bytes or self._puts % EVICT_EVERY == 0
+        if due:
+            self.evict()
+
+    def evict(self) -> None:
+        """
+        Drops expired entries, then the least recently used ones until the cache fits <max_size_bytes>
+        """
+        with self._lock:
+            cutoff = time.time() - self.max_age_seconds
+            expired = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses WHERE created_at < ?", (cutoff,)).fetchone()[0]
+            if expired:
+                self._conn.execute("DELETE FROM responses WHERE created_at < ?", (cutoff,))
+                self._total_size -= expired
+            if self._total_size > self.max_size_bytes:
+                freed = 0
+                stale_keys = []
+                for key, size in self._conn.execute("SELECT key, size FROM responses ORDER BY accessed_at"):
+                    if self._total_size - freed <= self.max_size_bytes:
+                        break
+                    stale_keys.append((key,))
+                    freed += size
+                self._conn.executemany("DELETE FROM responses WHERE key = ?", stale_keys)
+                self._total_size -= freed
+            self._conn.commit()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {"hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0}
+
+    def log_stats(self) -> None:
+        stats = self.stats()
+        logging.info(f"Response cache: {stats['hits']} hits, {stats['misses']} misses ({stats['hit_rate']:.1%} hit rate)")
+
+    def close(self) -> None:
+        self._conn.close()
@@ -0,0 +1,153 @@
+import re
+import math
+from collections import Counter
+
+# Window size used for documents that do not fit comfortably in one request; smaller windows run in parallel and
+# return sooner, larger ones repeat the prompt overhead less often
+DEFAULT_CHUNK_TOKENS = 32_000
+DEFAULT_CHUNK_OVERLAP = 500
+# Numbered-list line as requested by the task prompts: "1. <item>" or "1. <term> - <expansion>"
+NUMBERED_LINE = re.compile(r"^\s*\d+\.\s*(.+?)\s*$")
+# Header line of a section in a fused answer (see PROMPT_FUSED): "### ABBREVIATIONS"
+SECTION_HEADER = re.compile(r"^\s*#{2,4}\s*([A-Z][A-Z ]*[A-Z])\s*:?\s*$")
+# Sections of a fused answer holding fixed entity slots rather than a list
+SLOT_SECTIONS = {"ENTITIES"}
+# Entity slots of PROMPT_NER, in prompt order
+NER_SLOTS = 5
+NOT_AVAILABLE = {"n/a", "na", "none", ""}
+
+# How the outputs of the chunks of one document are combined, per task
+MERGE_BY_TASK = {
+    "coherence": "vote",
+    "cleaning": "concat",
+    # Line ranges to drop, see spans.py; the ranges of every chunk are dropped
+    "cleaning_spans": "concat",
+    "ner_task": "slots",
+}
+DEFAULT_MERGE = "list"
+# Fused calls (see fused.py) are named after this prefix and merged section by section
+FUSED_PREFIX = "fused_"
+
+
+def chunk_count(document_tokens:int, chunk_tokens:int, overlap_tokens:int) -> int:
+    """
+    Number of windows `split_tokens` produces for a document of <document_tokens> tokens
+    """
+    if document_tokens <= chunk_tokens:
+        return 1
+    return 1 + math.ceil((document_tokens - chunk_tokens) / (chunk_tokens - overlap_tokens))
+
+
+def split_tokens(tokens:list, chunk_tokens:int, overlap_tokens:int) -> list:
+    """
+    Splits <tokens> into windows of at most <chunk_tokens> tokens, consecutive windows sharing <overlap_tokens>
+    tokens so that items crossing a boundary are seen whole by at least one chunk
+    """
+    if overlap_tokens >= chunk_tokens:
+        raise ValueError(f"Chunk overlap ({overlap_tokens}) must be smaller than the chunk size ({chunk_tokens})")
+    if len(tokens) <= chunk_tokens:
+        return [tokens]
+    step = chunk_tokens - overlap_tokens
+    return [tokens[start:start + chunk_tokens] for start in range(0, len(tokens) - overlap_tokens, step)]
+
+
+def split_text(text:str, encoding, chunk_tokens:int, overlap_tokens:int) -> list:
+    """
+    Token windows of <text>, decoded back to strings
+    """
+    return [encoding.decode(window) for window in split_tokens(encoding.encode(text), chunk_tokens, overlap_tokens)]
+
+
+def _normalize(item:str) -> str:
+    return " ".join(item.lower().split())
+
+
+def merge_numbered_lists(outputs:list) -> str:
+    """
+    Concatenates the numbered lists of several chunks, dropping repeated items and renumbering.
+    Items in the "<term> - <expansion>" format are deduplicated by term, keeping the first expansion,
+    which is what `instruct_data.parse` would keep anyway; other items by their whole text.
+    """
+    items, seen = [], set()
+    for output in outputs:
+        for line in (output or "").split("\n"):
+            match = NUMBERED_LINE.match(line)
+            if not match:
+                continue
+            item = match.group(1)
+            key = _normalize(item.split(" - ", 1)[0] if " - " in item else item)
+            if key in seen:
+                continue
+            seen.add(key)
+            items.append(item)
+    return "\n".join(f"{i}. {item}" for i, item in enumerate(items, start=1))
+
+
+def merge_slots(outputs:list, slots:int=NER_SLOTS) -> str:
+    """
+    Merges fixed-position lists (one line per entity type) by joining the distinct values found for every position
+    """
+    values = [[] for _ in range(slots)]
+    for output in outputs:
+        lines = [match.group(1) for match in map(NUMBERED_LINE.match, (output or "").split("\n")) if match]
+        for position, line in enumerate(lines[:slots]):
+            for value in line.split(","):
+                value = value.strip()
+                if _normalize(value) not in NOT_AVAILABLE and _normalize(value) not in map(_normalize, values[position]):
+                    values[position].append(value)
+    return "\n".join(f"{i}. {', '.join(found) if found else 'N/A'}" for i, found in enumerate(values, start=1))
+
+
+def merge_votes(outputs:list) -> str:
+    """
+    Majority answer of yes/no classifications, ties count as "Yes" so borderline documents are kept.
+    Chunks that got no answer do not vote, a document without any answer gets an empty one.
+    """
+    votes = Counter(_normalize(output).strip(".") for output in outputs if output)
+    if not votes:
+        return ""
+    return "Yes" if votes["yes"] >= votes["no"] else "No"
+
+
+def split_sections(text:str) -> dict:
+    """
+    Splits a fused answer into {header: body}, in the order the headers appear. Text before the first header is dropped.
+    """
+    sections, header = {}, None
+    for line in (text or "").split("\n"):
+        match = SECTION_HEADER.match(line)
+        if match:
+            header = match.group(1)
+            sections.setdefault(header, [])
+        elif header is not None and not line.strip().startswith("```"):
+            sections[header].append(line)
+    return {header: "\n".join(lines).strip() for header, lines in sections.items()}
+
+
+def merge_sections(outputs:list) -> str:
+    """
+    Merges fused answers section by section, as numbered lists or entity slots
+    """
+    bodies = {}
+    for output in outputs:
+        for header, body in split_sections(output).items():
+            bodies.setdefault(header, []).append(body)
+    merged = [f"### {header}\n" + (merge_slots(found) if header in SLOT_SECTIONS else merge_numbered_lists(found))
+              for header, found in bodies.items()]
+    return "\n\n".join(merged)
+
+
+def merge_outputs(task:str, outputs:list) -> str:
+    """
+    Combines the generated texts of the chunks of one document into a single answer in the task's format
+    """
+    strategy = "sections" if task.startswith(FUSED_PREFIX) else MERGE_BY_TASK.get(task, DEFAULT_MERGE)
+    if strategy == "vote":
+        return merge_votes(outputs)
+    if strategy == "concat":
+        return "\n".join(output for output in outputs if output)
+    if strategy == "slots":
+        return merge_slots(outputs)
+    if strategy == "sections":
+        return merge_sections(outputs)
+    return merge_numbered_lists(outputs)
@@ -0,0 +1,99 @@
+import os
+import json
+import time
+import logging
+import pandas as pd
+
+try:
+    from tasks.journal import content_hash
+except ModuleNotFoundError:
+    from journal import content_hash
+
+DEAD_LETTER_FILE = "dead_letter.jsonl"
+
+
+class EmptyResponse(Exception):
+    """
+    The API answered without an answer: no choices, or the text withheld by the content filter
+    """
+    pass
+
+
+class BatchRequestError(Exception):
+    """
+    A request of an offline batch job came back with an error
+    """
+    pass
+
+
+class DeadLetterStore:
+    """
+    Documents whose request failed after every retry or came back without an answer, with the error that stopped them.
+    They are never written to the results or the resume journal, so `OpenAIPromptHandler.retry_failed`
+    (or a plain re-run) can send them again. Entries are keyed by (task, url, content hash); the latest
+    failure of an item replaces the previous one and a later success removes it.
+    """
+    def __init__(self, path:str):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.path = path
+        self._entries = {}
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    if line.strip():
+                        entry = json.loads(line)
+                        self._entries[self._key(entry["task"], entry["url"], entry["content_hash"])] = entry
+
+    @staticmethod
+    def _key(task:str, url:str, hashed_content:str) -> tuple:
+        return (task, str(url), hashed_content)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def entries(self, task:str=None) -> list:
+        return [entry for entry in self._entries.values() if task is None or entry["task"] == task]
+
+    def record(self, task:str, url:str, content, error:Exception) -> None:
+        """
+        Appends a failure of the document (<url>, <content>) for <task>
+        """
+        entry = {"task": task,
+                 "url": str(url),
+                 "content_hash": content_hash(content),
+                 "error": type(error).__name__,
+                 "message": str(error)[:500],
+                 "failed_at": time.time()}
+        key = self._key(task, url, entry["content_hash"])
+        entry["failures"] = self._entries.get(key, {}).get("failures", 0) + 1
+        self._entries[key] = entry
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(entry) + "\n")
+
+    def resolve(self, items:list) -> None:
+        """
+        Drops the (task, url, content) items that have since succeeded, rewriting the store if any was present
+        """
+        keys = [self._key(task, url, content_hash(content)) for task, url, content in items]
+        if not any(key in self._entries for key in keys):
+            return
+        for key in keys:
+            self._entries.pop(key, None)
+        with open(self.path, "w", encoding="utf-8") as f:
+            for entry in self._entries.values():
+                f.write(json.dumps(entry) + "\n")
+
+    def select(self, data:pd.DataFrame, task:str) -> pd.DataFrame:
+        """
+        Documents of <data> that are in the store for <task>
+        """
+        failed = {(entry["url"], entry["content_hash"]) for entry in self.entries(task)}
+        return data[[(str(url), content_hash(content)) in failed for url, content in zip(data["url"], data["content"])]]
+
+    def log_summary(self, task:str=None) -> None:
+        entries = self.entries(task)
+        if not entries:
+            return
+        by_error = pd.Series([entry["error"] for entry in entries]).value_counts()
+        logging.warning(f"{len(entries)} documents in the dead-letter store {self.path}: "
+                        + ", ".join(f"{error} x{count}" for error, count in by_error.items()))
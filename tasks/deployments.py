@@ -0,0 +1,171 @@
+import os
+import json
+import time
+import zlib
+import random
+import asyncio
+import logging
+import concurrent.futures
+import httpx
+from openai import AzureOpenAI, AsyncAzureOpenAI, DefaultAsyncHttpxClient
+
+try:
+    from tasks.scheduling import RateLimiter, AdaptiveConcurrency
+except ModuleNotFoundError:
+    from scheduling import RateLimiter, AdaptiveConcurrency
+
+API_VERSION = "2024-02-01"
+# Longest time an endpoint is taken out of rotation after repeated failures
+MAX_UNHEALTHY_SECONDS = 120
+# A request with an affinity key stays on its preferred deployment while that one has at least this share of the best score
+AFFINITY_MIN_SCORE_SHARE = 0.5
+
+
+class Deployment:
+    """
+    One Azure OpenAI endpoint/deployment with its own clients, RPM/TPM limiter, adaptive concurrency and health state
+    """
+    def __init__(self, endpoint:str, api_key:str, deployment_name:str, requests_per_minute:int, tokens_per_minute:int,
+                 transport:str, max_connections:int, initial_concurrency:int, weight:float=1.0):
+        self.endpoint = endpoint
+        self.deployment_name = deployment_name
+        self.transport = transport
+        self.weight = weight
+        self.failures = 0
+        self.unhealthy_until = 0.0
+
+        self.client = AzureOpenAI(
+            api_key=api_key,
+            api_version=API_VERSION,
+            azure_endpoint=endpoint,
+            # Retries are handled by async_retry so that rate-limit signals reach the concurrency controller
+            max_retries=0
+        )
+        self.async_client = None
+        self.executor = None
+        if transport == "async":
+            self.async_client = AsyncAzureOpenAI(
+                api_key=api_key,
+                api_version=API_VERSION,
+                azure_endpoint=endpoint,
+                max_retries=0,
+                http_client=DefaultAsyncHttpxClient(
+                    limits=httpx.Limits(max_connections=max_connections,
+                                        max_keepalive_connections=max_connections,
+                                        keepalive_expiry=60)
+                )
+            )
+        else:
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_connections)
+        self.rate_limiter = RateLimiter(requests_per_minute=requests_per_minute, tokens_per_minute=tokens_per_minute)
+        self.concurrency = AdaptiveConcurrency(initial=initial_concurrency, maximum=max_connections)
+
+    def __repr__(self) -> str:
+        return f"Deployment({self.deployment_name} @ {self.endpoint})"
+
+    def is_healthy(self) -> bool:
+        return time.monotonic() >= self.unhealthy_until
+
+    def routing_score(self) -> float:
+        """
+        Share of the TPM budget currently available, scaled by the configured weight.
+        Deployments paused by a retry-after or out of concurrency slots score lower.
+        """
+        score = self.weight * max(self.rate_limiter.available_tokens(), 1) / self.rate_limiter.tokens_per_minute
+        if self.concurrency.is_paused():
+            score *= 0.01
+        elif self.concurrency.in_flight >= int(self.concurrency.limit):
+            score *= 0.5
+        return score
+
+    def mark_success(self) -> None:
+        self.failures = 0
+
+    def mark_failure(self) -> None:
+        """
+        Takes the deployment out of rotation for an exponentially growing period
+        """
+        self.failures += 1
+        self.unhealthy_until = time.monotonic() + min(MAX_UNHEALTHY_SECONDS, 2 ** self.failures)
+        logging.warning(f"{self} marked unhealthy for {min(MAX_UNHEALTHY_SECONDS, 2 ** self.failures)}s after {self.failures} failures")
+
+    async def create_completion(self, messages:list, temperature:float, timeout:float=None):
+        """
+        Sends one chat completion request through the configured transport.
+        Returns the raw response so rate-limit headers can be read before parsing it.
+        A request still running after <timeout> seconds is aborted with an APITimeoutError.
+        """
+        if self.transport == "async":
+            return await self.async_client.chat.completions.with_raw_response.create(
+                model=self.deployment_name,
+                messages=messages,
+                temperature=temperature,
+                timeout=timeout
+            )
+
+        # Define a function to make the request synchronously
+        def make_request():
+            chat_completion_zero = self.client.chat.completions.with_raw_response.create(
+                model=self.deployment_name,
+                messages=messages,
+                temperature=temperature,
+                timeout=timeout
+            )
+            return chat_completion_zero
+
+        # Run the request on the deployment's shared thread pool
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, make_request)
+
+    async def close(self) -> None:
+        if self.async_client is not None:
+            await self.async_client.close()
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+        self.client.close()
+
+
+def load_deployment_configs(requests_per_minute:int, tokens_per_minute:int) -> list:
+    """
+    Reads the deployment pool from AZURE_OPENAI_DEPLOYMENTS, either a path to a JSON file or the JSON itself:
+    a list of {"endpoint", "deployment", "api_key" or "api_key_env", "rpm", "tpm", "weight"} objects.
+    Without it, the single deployment of the AZURE_OPENAI_* variables is used.
+    """
+    config = os.getenv("AZURE_OPENAI_DEPLOYMENTS")
+    if not config:
+        return [{"endpoint": os.getenv("AZURE_OPENAI_ENDPOINT"),
+                 "deployment": os.getenv("AZURE_OPENAI_CHAT_DEPLOYMENT_NAME"),
+                 "api_key": os.getenv("AZURE_OPENAI_API_KEY"),
+                 "rpm": requests_per_minute,
+                 "tpm": tokens_per_minute}]
+
+    if os.path.exists(config):
+        with open(config, "r") as f:
+            entries = json.load(f)
+    else:
+        entries = json.loads(config)
+    for entry in entries:
+        if "api_key_env" in entry:
+            entry["api_key"] = os.getenv(entry["api_key_env"])
+        entry.setdefault("rpm", requests_per_minute)
+        entry.setdefault("tpm", tokens_per_minute)
+    return entries
+
+
+def choose_deployment(deployments:list, affinity:str=None) -> Deployment:
+    """
+    Picks the healthy deployment with the most headroom, with a small random jitter so that
+    concurrent requests spread over deployments with similar scores.
+    If every deployment is unhealthy, the one that recovers first is used.
+    Requests sharing an <affinity> key (e.g. the same document) go to the same deployment while it has reasonable
+    headroom, so they can reuse the provider's prompt cache, which is kept per deployment.
+    """
+    healthy = [deployment for deployment in deployments if deployment.is_healthy()]
+    if not healthy:
+        return min(deployments, key=lambda deployment: deployment.unhealthy_until)
+    best = max(healthy, key=lambda deployment: deployment.routing_score() * random.uniform(0.9, 1.0))
+    if affinity is not None and len(deployments) > 1:
+        preferred = deployments[zlib.crc32(affinity.encode("utf-8")) % len(deployments)]
+        if preferred.is_healthy() and preferred.routing_score() >= AFFINITY_MIN_SCORE_SHARE * best.routing_score():
+            return preferred
+    return best
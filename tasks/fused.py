@@ -0,0 +1,64 @@
+import pandas as pd
+
+try:
+    from tasks.prompts import PROMPT_FUSED, FUSED_SECTIONS
+    from tasks.chunking import FUSED_PREFIX, split_sections
+except ModuleNotFoundError:
+    from prompts import PROMPT_FUSED, FUSED_SECTIONS
+    from chunking import FUSED_PREFIX, split_sections
+
+
+def fused_task_name(tasks:list) -> str:
+    """
+    Task name of the fused call answering <tasks>, e.g. fused_abbrev-definitions
+    """
+    return FUSED_PREFIX + "-".join(tasks)
+
+
+def fused_subtasks(task:str) -> list:
+    """
+    Tasks answered by the fused call named <task>, or None if it is not a fused call
+    """
+    return task[len(FUSED_PREFIX):].split("-") if task.startswith(FUSED_PREFIX) else None
+
+
+def fused_prompt(tasks:list) -> str:
+    """
+    Template asking for the sections of every task in <tasks> in a single answer, with the usual {context} placeholder
+    """
+    return PROMPT_FUSED.format(context="{context}", sections="\n".join(FUSED_SECTIONS[task][1] for task in tasks))
+
+
+def split_fused_answer(text:str, tasks:list) -> dict:
+    """
+    Generated text of every task in <tasks> whose section is present in a fused answer. A missing (or renamed)
+    header leaves the task out, an empty section is an empty answer.
+    """
+    sections = split_sections(text)
+    return {task: sections[FUSED_SECTIONS[task][0]] for task in tasks if FUSED_SECTIONS[task][0] in sections}
+
+
+def fused_rows(results:pd.DataFrame, task:str, tasks:list) -> tuple:
+    """
+    Result rows of <task> taken from the fused results of <tasks>, in the schema of `OpenAIPromptHandler.result_row`.
+    Tokens and costs of each call are split evenly between the tasks it answered.
+
+    Returns:
+        tuple: (rows, missing), missing being the documents as (url, content) whose answer has no section for <task>.
+    """
+    rows, missing = [], []
+    for row in results.itertuples(index=False):
+        if pd.isna(row.content) or pd.isna(row.generated_text):
+            continue
+        answers = split_fused_answer(row.generated_text, tasks)
+        if task not in answers:
+            missing.append((row.url, row.content))
+            continue
+        rows.append({"url": row.url,
+                     "source": row.source,
+                     "content": row.content,
+                     "task": task,
+                     "total_tokens": row.total_tokens / len(tasks),
+                     "generated_text": answers[task],
+                     "costs": row.costs / len(tasks)})
+    return rows, missing
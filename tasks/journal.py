@@ -0,0 +1,60 @@
+import os
+import json
+import hashlib
+import logging
+import pandas as pd
+
+
+def content_hash(content) -> str:
+    """
+    Short, stable fingerprint of a document body
+    """
+    return hashlib.sha1(str(content).encode("utf-8", errors="ignore")).hexdigest()[:16]
+
+
+class ResumeJournal:
+    """
+    Append-only journal of completed (task, url, content hash) items.
+    Only a fixed-size digest per item is kept in memory, so checking whether a document
+    was already processed is O(1) and never requires reading the stored results back.
+    """
+    def __init__(self, path:str):
+        self.path = path
+        self._done = set()
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    if line.strip():
+                        entry = json.loads(line)
+                        self._done.add(self._digest(entry["task"], entry["url"], entry["content_hash"]))
+
+    @staticmethod
+    def _digest(task:str, url:str, hashed_content:str) -> bytes:
+        return hashlib.blake2b(f"{task}\x00{url}\x00{hashed_content}".encode("utf-8"), digest_size=12).digest()
+
+    def __len__(self) -> int:
+        return len(self._done)
+
+    def is_done(self, task:str, url:str, content) -> bool:
+        return self._digest(task, str(url), content_hash(content)) in self._done
+
+    def mark_done(self, items:list) -> None:
+        """
+        Records (task, url, content) tuples as completed
+        """
+        with open(self.path, "a", encoding="utf-8") as f:
+            for task, url, content in items:
+                hashed_content = content_hash(content)
+                self._done.add(self._digest(task, str(url), hashed_content))
+                f.write(json.dumps({"task": task, "url": str(url), "content_hash": hashed_content}) + "\n")
+
+    def bootstrap(self, results_dir:str, task:str) -> None:
+        """
+        Builds the journal from result CSVs written before it existed, reading only the url/content columns once
+        """
+        existing_files = [f for f in os.listdir(results_dir) if f.endswith('.csv')]
+        for file_name in existing_files:
+            existing = pd.read_csv(os.path.join(results_dir, file_name), usecols=["url", "content"])
+            self.mark_done([(task, url, content) for url, content in zip(existing["url"], existing["content"])])
+        if existing_files:
+            logging.info(f"Resume journal bootstrapped with {len(self)} items from {len(existing_files)} result files")
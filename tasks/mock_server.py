@@ -0,0 +1,211 @@
+import re
+import json
+import time
+import hashlib
+import random
+import logging
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class MockChatConfig:
+    """
+    Behaviour of the mock chat-completions endpoint.
+
+    Args:
+        latency (str): "fixed", "uniform" or "lognormal" distribution of the time to first token.
+        median_latency (float): Median (or fixed value) of that latency in seconds.
+        latency_sigma (float): Spread of the lognormal distribution, or half-width of the uniform one.
+        seconds_per_output_token (float): Generation time added per completion token.
+        error_rate (float): Share of requests answered with a 429 regardless of the quota.
+        tokens_per_minute (int): Simulated deployment quota, requests above it get a 429 with retry-after.
+        answer_items (int): Number of lines in the canned numbered-list answer.
+        prompt_cache (bool): Report repeated prompt prefixes as cached tokens, like the provider's prompt caching.
+    """
+    def __init__(self, latency:str="lognormal", median_latency:float=1.0, latency_sigma:float=0.5, seconds_per_output_token:float=0.002,
+                 error_rate:float=0.0, tokens_per_minute:int=None, answer_items:int=5, retry_after:float=1.0, prompt_cache:bool=True):
+        self.latency = latency
+        self.median_latency = median_latency
+        self.latency_sigma = latency_sigma
+        self.seconds_per_output_token = seconds_per_output_token
+        self.error_rate = error_rate
+        self.tokens_per_minute = tokens_per_minute
+        self.answer_items = answer_items
+        self.retry_after = retry_after
+        self.prompt_cache = prompt_cache
+
+    def sample_latency(self) -> float:
+        if self.latency == "fixed":
+            return self.median_latency
+        if self.latency == "uniform":
+            return max(0.0, random.uniform(self.median_latency - self.latency_sigma, self.median_latency + self.latency_sigma))
+        return random.lognormvariate(0, self.latency_sigma) * self.median_latency
+
+
+def canned_answer(prompt:str, items:int) -> str:
+    """
+    Answer in the numbered '1. X - Y' format parsed by instruct_data.py, Yes for classification prompts,
+    a line range for span-deletion cleaning prompts, or one such list per "### SECTION" header for fused prompts
+    """
+    if 'with "yes" or "no"' in prompt:
+        return "Yes"
+    if "lines to remove" in prompt:
+        return "1-2"
+    answer = "\n".join(f"{i}. TERM{i} - Canned expansion number {i}" for i in range(1, items + 1))
+    headers = re.findall(r"^\s*### ([A-Z ]+)$", prompt, re.MULTILINE)
+    if headers:
+        return "\n\n".join(f"### {header}\n{answer}" for header in dict.fromkeys(headers))
+    return answer
+
+
+class _QuotaWindow:
+    """
+    Sliding one-minute window of consumed tokens, shared by the server threads
+    """
+    def __init__(self, tokens_per_minute:int):
+        self.tokens_per_minute = tokens_per_minute
+        self._events = []
+        self._lock = threading.Lock()
+
+    def try_consume(self, tokens:int) -> tuple:
+        with self._lock:
+            now = time.monotonic()
+            self._events = [(t, n) for t, n in self._events if now - t < 60]
+            used = sum(n for _, n in self._events)
+            if used + tokens > self.tokens_per_minute:
+                return False, self.tokens_per_minute - used
+            self._events.append((now, tokens))
+            return True, self.tokens_per_minute - used - tokens
+
+
+class _PrefixCache:
+    """
+    Remembers prompt prefixes in fixed-size blocks; a prompt is served from cache up to the longest block boundary
+    already seen, provided that prefix is at least <min_chars> long (the provider requires 1024 tokens)
+    """
+    def __init__(self, block_chars:int=512, min_chars:int=4096, max_entries:int=200_000):
+        self.block_chars = block_chars
+        self.min_chars = min_chars
+        self.max_entries = max_entries
+        self._seen = set()
+        self._lock = threading.Lock()
+
+    def lookup_and_store(self, prompt:str) -> int:
+        digest = hashlib.sha1()
+        prefixes = []
+        for start in range(0, len(prompt) - self.block_chars + 1, self.block_chars):
+            digest.update(prompt[start:start + self.block_chars].encode("utf-8"))
+            prefixes.append(digest.copy().digest())
+        with self._lock:
+            cached_blocks = 0
+            for prefix in prefixes:
+                if prefix not in self._seen:
+                    break
+                cached_blocks += 1
+            if len(self._seen) + len(prefixes) > self.max_entries:
+                self._seen.clear()
+            self._seen.update(prefixes)
+        cached_chars = cached_blocks * self.block_chars
+        return cached_chars if cached_chars >= self.min_chars else 0
+
+
+def make_request_handler(config:MockChatConfig):
+    quota = _QuotaWindow(config.tokens_per_minute) if config.tokens_per_minute else None
+    prefix_cache = _PrefixCache() if config.prompt_cache else None
+
+    class MockChatHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def _send_json(self, status:int, body:dict, headers:dict=None):
+            payload = json.dumps(body).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, str(value))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def do_POST(self):
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            if not self.path.split("?")[0].endswith("/chat/completions"):
+                self._send_json(404, {"error": {"code": "404", "message": "Unknown path"}})
+                return
+
+            prompt = "\n".join(message.get("content", "") for message in request.get("messages", []))
+            answer = canned_answer(prompt, config.answer_items)
+            # Rough tokenizer, good enough for quota and throughput figures
+            prompt_tokens = max(1, len(prompt) // 4)
+            completion_tokens = max(1, len(answer) // 4)
+
+            remaining = None
+            if quota is not None:
+                accepted, remaining = quota.try_consume(prompt_tokens + completion_tokens)
+                if not accepted:
+                    self._send_json(429, {"error": {"code": "429", "message": "Rate limit exceeded"}},
+                                    {"retry-after": config.retry_after, "x-ratelimit-remaining-tokens": max(remaining, 0)})
+                    return
+            if random.random() < config.error_rate:
+                self._send_json(429, {"error": {"code": "429", "message": "Injected rate limit"}}, {"retry-after": config.retry_after})
+                return
+
+            cached_tokens = prefix_cache.lookup_and_store(prompt) // 4 if prefix_cache is not None else 0
+            time.sleep(config.sample_latency() + completion_tokens * config.seconds_per_output_token)
+            headers = {"x-ratelimit-remaining-tokens": remaining} if remaining is not None else {}
+            self._send_json(200, {
+                "id": f"chatcmpl-mock-{random.getrandbits(48):x}",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": request.get("model", "mock"),
+                "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": answer}}],
+                "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                          "total_tokens": prompt_tokens + completion_tokens,
+                          "prompt_tokens_details": {"cached_tokens": cached_tokens}},
+            }, headers)
+
+    return MockChatHandler
+
+
+def start_mock_server(config:MockChatConfig, host:str="127.0.0.1", port:int=0) -> ThreadingHTTPServer:
+    """
+    Serves the mock endpoint from a background thread. Port 0 picks a free port, see `server.server_address`.
+    """
+    server = ThreadingHTTPServer((host, port), make_request_handler(config))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logging.info(f"Mock chat-completions endpoint listening on http://{host}:{server.server_address[1]}")
+    return server
+
+
+def add_config_arguments(parser:argparse.ArgumentParser) -> None:
+    parser.add_argument("--latency", choices=["fixed", "uniform", "lognormal"], default="lognormal")
+    parser.add_argument("--median-latency", type=float, default=1.0, help="Median time to first token in seconds")
+    parser.add_argument("--latency-sigma", type=float, default=0.5)
+    parser.add_argument("--seconds-per-output-token", type=float, default=0.002)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of requests answered with an injected 429")
+    parser.add_argument("--tpm", type=int, default=None, help="Simulated tokens-per-minute quota")
+    parser.add_argument("--answer-items", type=int, default=5)
+    parser.add_argument("--no-prompt-cache", action="store_true", help="Do not simulate prompt prefix caching")
+
+
+def config_from_args(args) -> MockChatConfig:
+    return MockChatConfig(latency=args.latency, median_latency=args.median_latency, latency_sigma=args.latency_sigma,
+                          seconds_per_output_token=args.seconds_per_output_token, error_rate=args.error_rate,
+                          tokens_per_minute=args.tpm, answer_items=args.answer_items, prompt_cache=not args.no_prompt_cache)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Local stand-in for the Azure OpenAI chat-completions endpoint")
+    parser.add_argument("--port", type=int, default=8089)
+    add_config_arguments(parser)
+    args = parser.parse_args()
+    server = start_mock_server(config_from_args(args), port=args.port)
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
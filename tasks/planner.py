@@ -0,0 +1,134 @@
+import time
+import asyncio
+import logging
+from collections import deque
+
+try:
+    from tasks.chunking import chunk_count
+    from tasks.fused import fused_subtasks
+except ModuleNotFoundError:
+    from chunking import chunk_count
+    from fused import fused_subtasks
+
+# Typical completion length per task, used to project output tokens before a run
+OUTPUT_TOKENS_BY_TASK = {
+    "abbrev": 400,
+    "definitions": 600,
+    "links": 150,
+    "qa_task": 900,
+    "cdm_task": 900,
+    "ner_task": 200,
+    "osi_qa": 900,
+    "osi_abbrev": 400,
+    "coherence": 2,
+    "cleaning_spans": 40,
+}
+# Tasks whose output is a rewrite of the document, as a fraction of its tokens
+OUTPUT_RATIO_BY_TASK = {
+    "cleaning": 0.8,
+}
+DEFAULT_OUTPUT_TOKENS = 500
+
+
+class BudgetExceeded(Exception):
+    pass
+
+
+def estimate_output_tokens(task:str, document_tokens:int) -> int:
+    if task in OUTPUT_RATIO_BY_TASK:
+        return int(document_tokens * OUTPUT_RATIO_BY_TASK[task])
+    if fused_subtasks(task):
+        return sum(estimate_output_tokens(subtask, document_tokens) for subtask in fused_subtasks(task))
+    return OUTPUT_TOKENS_BY_TASK.get(task, DEFAULT_OUTPUT_TOKENS)
+
+
+def plan_task(contents, task:str, task_prompt:str, system_prompt:str, tokens, requests_per_minute:int, tokens_per_minute:int,
+              input_token_price:float, output_token_price:float, chunk_tokens:int=None, chunk_overlap:int=0) -> dict:
+    """
+    Projects the tokens, cost and wall-clock time of running <task_prompt> over <contents> without calling the API.
+    Prompt tokens are counted as template + system prompt + document, which matches the rendered prompt up to a few
+    tokens at the template boundaries. With <chunk_tokens>, longer documents are counted as one request per window,
+    each carrying the prompt overhead and its share of the overlap. <tokens> is the `tokens.TokenCounter` of the model,
+    so documents counted by an earlier filter or run are not encoded again.
+
+    Returns:
+        dict: Projection for the task, see `log_plan`.
+    """
+    overhead_tokens = sum(tokens.count_many([task_prompt.replace("{context}", ""), system_prompt or ""]))
+
+    documents = requests = input_tokens = output_tokens = largest_input = 0
+    for document_tokens in tokens.count_many(contents):
+        chunks = chunk_count(document_tokens, chunk_tokens, chunk_overlap) if chunk_tokens else 1
+        chunk_size = min(document_tokens, chunk_tokens) if chunk_tokens else document_tokens
+        documents += 1
+        requests += chunks
+        input_tokens += chunks * overhead_tokens + document_tokens + (chunks - 1) * chunk_overlap
+        output_tokens += chunks * estimate_output_tokens(task, document_tokens // chunks)
+        largest_input = max(largest_input, overhead_tokens + chunk_size)
+
+    minutes = max((input_tokens + output_tokens) / tokens_per_minute, requests / requests_per_minute)
+    return {"task": task,
+            "documents": documents,
+            "requests": requests,
+            "input_tokens": input_tokens,
+            "output_tokens": output_tokens,
+            "largest_input_tokens": largest_input,
+            "cost": input_tokens * input_token_price + output_tokens * output_token_price,
+            "minutes": minutes}
+
+
+def log_plan(plan:dict) -> None:
+    logging.info(f"[plan] {plan['task']}: {plan['documents']} documents ({plan['requests']} requests), {plan['input_tokens']:,} input tokens, "
+                 f"~{plan['output_tokens']:,} output tokens (largest prompt {plan['largest_input_tokens']:,}), "
+                 f"projected cost ${plan['cost']:.2f}, ~{plan['minutes']:.1f} min at the configured TPM/RPM")
+
+
+class BudgetGuard:
+    """
+    Caps the money and tokens spent on live API calls.
+    Without <window_seconds> the caps apply to the whole run and reaching one stops it. With a window they apply
+    to a rolling window, and reaching one pauses new requests until older spending leaves the window.
+    Requests already in flight still complete, so a run can overshoot a cap by at most their cost.
+    """
+    def __init__(self, max_cost:float=None, max_tokens:int=None, window_seconds:float=None):
+        self.max_cost = max_cost
+        self.max_tokens = max_tokens
+        self.window_seconds = window_seconds
+        self.spent_cost = 0.0
+        self.spent_tokens = 0
+        self.exhausted = False
+        self._window = deque()
+
+    def _over_budget(self) -> bool:
+        return ((self.max_cost is not None and self.spent_cost >= self.max_cost) or
+                (self.max_tokens is not None and self.spent_tokens >= self.max_tokens))
+
+    def _expire(self) -> None:
+        while self._window and time.monotonic() - self._window[0][0] > self.window_seconds:
+            _, cost, tokens = self._window.popleft()
+            self.spent_cost -= cost
+            self.spent_tokens -= tokens
+
+    async def check(self) -> None:
+        """
+        Raises BudgetExceeded once a total cap is reached, or waits while a windowed cap is
+        """
+        if self.window_seconds is None:
+            if self.exhausted or self._over_budget():
+                if not self.exhausted:
+                    logging.warning(f"Budget reached (${self.spent_cost:.2f}, {self.spent_tokens:,} tokens), stopping new requests")
+                self.exhausted = True
+                raise BudgetExceeded(f"spent ${self.spent_cost:.2f} and {self.spent_tokens:,} tokens")
+            return
+        self._expire()
+        while self._over_budget() and self._window:
+            wait = self.window_seconds - (time.monotonic() - self._window[0][0])
+            logging.info(f"Budget window full, pausing new requests for {wait:.0f}s")
+            await asyncio.sleep(max(wait, 0.1))
+            self._expire()
+
+    def record(self, cost:float, tokens:int) -> None:
+        self.spent_cost += cost
+        self.spent_tokens += tokens
+        if self.window_seconds is not None:
+            self._window.append((time.monotonic(), cost, tokens))
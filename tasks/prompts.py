@@ -115,6 +115,45 @@ PROMPT_NER = """
         ONLY provide this list, nothing else.
         """
 
+PROMPT_FUSED = """
+        Pay close attention to the following text:
+        ```
+        {context}
+        ```
+        Extract the information requested below. Answer with every section, in this order, each one starting
+        with its header line exactly as written (for example "### ABBREVIATIONS"), followed by its numbered list.
+        If a section has nothing to list, leave it empty below its header.
+
+{sections}
+
+        ONLY provide these sections, nothing else.
+        """
+
+# Sections of PROMPT_FUSED: header and instructions for each task it can replace
+FUSED_SECTIONS = {
+    "abbrev": ("ABBREVIATIONS", """
+        ### ABBREVIATIONS
+        All abbreviations that appear along with their expanded versions, with this format:
+        1. <abbreviation> - <expanded version>"""),
+    "definitions": ("DEFINITIONS", """
+        ### DEFINITIONS
+        Content domain specific terms being defined in the text and their definitions, with this format:
+        1. <term> - <definition>"""),
+    "links": ("LAWS", """
+        ### LAWS
+        Laws or regulations the text explains explicitly by name (ej: Regulation (EU) 2019/834), with this format:
+        1. <law>"""),
+    "ner_task": ("ENTITIES", """
+        ### ENTITIES
+        Specific Organizations, Legislations, Dates, Monetary Values, and Statistics, always 5 elements with this format
+        (N/A for an entity with no corresponding term):
+        1. <Organization>
+        2. <Legislation>
+        3. <Dates>
+        4. <Monetary Values>
+        5. <Statistics>"""),
+}
+
 PROMPT_QA_TASK = """
     Given the following text:
     ´´´
@@ -195,6 +234,23 @@ ONLY provide the cleaned text, nothing more.
 """
 
 
+CLEANING_SPANS_PROMPT = """
+Given the following text, where every line starts with its number in brackets:
+    ´´´
+    {context}
+    ´´´
+
+Examine the given document and find the lines that should be removed to clean it:
+    1. Lines involved with social media links, a site's navigation menu, html markers or other unnecessary symbols.
+    2. Incoherent text and artifacts that may come from ocr
+    3. Tabular Data
+    4. Numeric data that is not related to your domain.
+Lines with names of laws, regulations along with abbreviations and other such data MUST be kept.
+ONLY provide the numbers of the lines to remove as comma-separated ranges, for example: 1-4, 9, 15-22
+If every line should be kept, answer NONE.
+"""
+
+
 CLASSIF_SYSTEM = """
 You are an expert in financial regulation and compliance, managing knowledge from both the USA and Europe, You are also well versed in open source technologies.
 """
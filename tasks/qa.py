@@ -50,10 +50,13 @@ async def main():
     args = parser.parse_args()
 
     handler = OpenAIPromptHandler()
-    if args.task == "osi_qa":
-        await osi_qa_task(handler)
-    elif args.task == "osi_abbrev":
-        await osi_abbrev_task(handler)
+    try:
+        if args.task == "osi_qa":
+            await osi_qa_task(handler)
+        elif args.task == "osi_abbrev":
+            await osi_abbrev_task(handler)
+    finally:
+        await handler.close()
 
 if __name__ == "__main__":
     asyncio.run(main())
\ No newline at end of file
@@ -0,0 +1,250 @@
+import asyncio
+import time
+import logging
+import numpy as np
+from collections import deque
+
+# Per-request deadline: a fixed allowance plus prefill and generation time for the request's size.
+# gpt-4o-mini reads a few thousand prompt tokens and writes ~50-100 completion tokens per second.
+DEADLINE_BASE_SECONDS = 15.0
+DEADLINE_SECONDS_PER_PROMPT_TOKEN = 0.0005
+DEADLINE_SECONDS_PER_OUTPUT_TOKEN = 0.03
+
+
+def request_deadline(prompt_tokens:int, output_tokens:int, scale:float=1.0) -> float:
+    """
+    Seconds a request of this size may run before it is aborted and retried
+    """
+    return scale * (DEADLINE_BASE_SECONDS + prompt_tokens * DEADLINE_SECONDS_PER_PROMPT_TOKEN
+                    + output_tokens * DEADLINE_SECONDS_PER_OUTPUT_TOKEN)
+
+
+class RateLimiter:
+    """
+    Token bucket limiter for a requests-per-minute and a tokens-per-minute budget.
+    Both buckets refill continuously, so a request is released as soon as there is
+    budget for it instead of waiting for a batch boundary.
+    """
+    def __init__(self, requests_per_minute:int, tokens_per_minute:int):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self._request_budget = float(requests_per_minute)
+        self._token_budget = float(tokens_per_minute)
+        self._updated_at = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        elapsed = now - self._updated_at
+        self._updated_at = now
+        self._request_budget = min(self.requests_per_minute, self._request_budget + elapsed * self.requests_per_minute / 60)
+        self._token_budget = min(self.tokens_per_minute, self._token_budget + elapsed * self.tokens_per_minute / 60)
+
+    async def acquire(self, tokens:int) -> int:
+        """
+        Waits until one request and <tokens> tokens fit in the budget and reserves them.
+        Requests larger than the whole TPM budget are clamped so they can still run once the bucket is full.
+        Callers are served in arrival order, so large documents are not starved by small ones.
+
+        Returns:
+            int: The amount of tokens actually reserved, to be passed back to `settle`.
+        """
+        tokens = min(tokens, self.tokens_per_minute)
+        async with self._lock:
+            while True:
+                self._refill()
+                if self._request_budget >= 1 and self._token_budget >= tokens:
+                    self._request_budget -= 1
+                    self._token_budget -= tokens
+                    return tokens
+                request_wait = max(0.0, 1 - self._request_budget) * 60 / self.requests_per_minute
+                token_wait = max(0.0, tokens - self._token_budget) * 60 / self.tokens_per_minute
+                await asyncio.sleep(max(request_wait, token_wait))
+
+    def settle(self, reserved:int, used:int) -> None:
+        """
+        Corrects the token bucket once the real usage of a request is known.
+        """
+        self._refill()
+        self._token_budget = min(self.tokens_per_minute, self._token_budget + reserved - used)
+
+    def available_tokens(self) -> float:
+        self._refill()
+        return self._token_budget
+
+    def observe_remaining(self, remaining_requests:int=None, remaining_tokens:int=None) -> None:
+        """
+        Aligns the local buckets with the remaining quota reported by the server (x-ratelimit-remaining-* headers),
+        which also accounts for traffic sent to the same deployment by other processes.
+        """
+        self._refill()
+        if remaining_requests is not None:
+            self._request_budget = min(self._request_budget, remaining_requests)
+        if remaining_tokens is not None:
+            self._token_budget = min(self._token_budget, remaining_tokens)
+
+
+class AdaptiveConcurrency:
+    """
+    AIMD controller for the number of requests in flight.
+    Every successful request grows the limit by <increase>/limit (about +<increase> per round trip), while
+    rate-limit errors and timeouts cut it by <decrease_factor> and honour the server's retry-after delay.
+    Throughput therefore settles close to the deployment quota without tuning the concurrency by hand.
+    """
+    def __init__(self, initial:int=8, minimum:int=1, maximum:int=200, increase:float=1.0, decrease_factor:float=0.5, cooldown:float=1.0):
+        self.limit = float(min(max(initial, minimum), maximum))
+        self.minimum = minimum
+        self.maximum = maximum
+        self.increase = increase
+        self.decrease_factor = decrease_factor
+        self.cooldown = cooldown
+        self.in_flight = 0
+        self._paused_until = 0.0
+        self._last_decrease = 0.0
+        self._condition = asyncio.Condition()
+
+    async def acquire(self) -> None:
+        while True:
+            delay = self._paused_until - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+            async with self._condition:
+                await self._condition.wait_for(lambda: self.in_flight < int(self.limit))
+                if self._paused_until <= time.monotonic():
+                    self.in_flight += 1
+                    return
+
+    def is_paused(self) -> bool:
+        return self._paused_until > time.monotonic()
+
+    async def release(self) -> None:
+        async with self._condition:
+            self.in_flight -= 1
+            self._condition.notify_all()
+
+    def on_success(self) -> None:
+        self.limit = min(self.maximum, self.limit + self.increase / self.limit)
+
+    def on_overload(self, retry_after:float=None) -> None:
+        """
+        Multiplicative decrease, applied at most once per <cooldown> seconds so a burst of
+        errors caused by the same overload only cuts the limit once
+        """
+        now = time.monotonic()
+        if retry_after:
+            self._paused_until = max(self._paused_until, now + retry_after)
+        if now - self._last_decrease >= self.cooldown:
+            self._last_decrease = now
+            self.limit = max(self.minimum, self.limit * self.decrease_factor)
+
+
+class HedgingPolicy:
+    """
+    Decides when a request that is taking unusually long gets a speculative duplicate.
+    Latencies are tracked relative to each request's deadline, so that a long document is compared with
+    what is usual for its size: a request is hedged once it has run longer than the <quantile> of recent
+    requests would have, scaled to its own deadline.
+    """
+    def __init__(self, quantile:float=95, min_samples:int=20, window:int=1000):
+        self.quantile = quantile
+        self.min_samples = min_samples
+        self._ratios = deque(maxlen=window)
+
+    def observe(self, latency:float, deadline:float) -> None:
+        self._ratios.append(latency / deadline)
+
+    def delay(self, deadline:float) -> float:
+        """
+        Seconds to wait before hedging a request with <deadline>, or None while there are too few samples
+        """
+        if len(self._ratios) < self.min_samples:
+            return None
+        return float(np.percentile(self._ratios, self.quantile)) * deadline
+
+
+class RequestStats:
+    """
+    Latency and utilisation figures of the requests sent by a handler.
+    Idle time is the time, between the first request and the last response, with nothing in flight.
+    Hedged requests count the duplicates launched and how many of them answered before the original;
+    timeouts are requests aborted at their deadline.
+    """
+    def __init__(self):
+        self.latencies = []
+        self.errors = 0
+        self.timeouts = 0
+        self.cancelled = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.prompt_tokens = 0
+        self.cached_prompt_tokens = 0
+        self.in_flight = 0
+        self.idle_seconds = 0.0
+        self.first_started_at = None
+        self.last_finished_at = None
+        self._idle_since = None
+
+    def start(self) -> float:
+        now = time.monotonic()
+        if self.first_started_at is None:
+            self.first_started_at = now
+        if self.in_flight == 0 and self._idle_since is not None:
+            self.idle_seconds += now - self._idle_since
+        self.in_flight += 1
+        return now
+
+    def finish(self, started_at:float, failed:bool=False, timed_out:bool=False, cancelled:bool=False) -> None:
+        now = time.monotonic()
+        self.in_flight -= 1
+        self.last_finished_at = now
+        if cancelled:
+            self.cancelled += 1
+        elif failed or timed_out:
+            self.errors += 1
+            self.timeouts += timed_out
+        else:
+            self.latencies.append(now - started_at)
+        if self.in_flight == 0:
+            self._idle_since = now
+
+    def record_tokens(self, prompt_tokens:int, cached_prompt_tokens:int) -> None:
+        self.prompt_tokens += prompt_tokens
+        self.cached_prompt_tokens += cached_prompt_tokens
+
+    def summary(self) -> dict:
+        elapsed = (self.last_finished_at - self.first_started_at) if self.latencies else 0.0
+        return {"requests": len(self.latencies),
+                "errors": self.errors,
+                "elapsed_seconds": elapsed,
+                "requests_per_second": len(self.latencies) / elapsed if elapsed else 0.0,
+                "p50_latency": float(np.percentile(self.latencies, 50)) if self.latencies else 0.0,
+                "p95_latency": float(np.percentile(self.latencies, 95)) if self.latencies else 0.0,
+                "p99_latency": float(np.percentile(self.latencies, 99)) if self.latencies else 0.0,
+                "timeouts": self.timeouts,
+                "hedges": self.hedges,
+                "hedge_wins": self.hedge_wins,
+                "cancelled": self.cancelled,
+                "cached_prompt_share": self.cached_prompt_tokens / self.prompt_tokens if self.prompt_tokens else 0.0,
+                "idle_seconds": self.idle_seconds}
+
+    def log_stats(self) -> None:
+        stats = self.summary()
+        logging.info(f"Requests: {stats['requests']} answered ({stats['errors']} errors) in {stats['elapsed_seconds']:.1f}s, "
+                     f"p50 {stats['p50_latency']:.2f}s, p95 {stats['p95_latency']:.2f}s, p99 {stats['p99_latency']:.2f}s, "
+                     f"{stats['hedges']} hedged ({stats['hedge_wins']} won), {stats['timeouts']} timed out, "
+                     f"{stats['cached_prompt_share']:.0%} of prompt tokens cached")
+
+
+async def run_pipeline(items, worker, concurrency:int) -> None:
+    """
+    Runs <worker> over <items> keeping at most <concurrency> calls in flight.
+    A new item is started as soon as any slot frees up, so a single slow item only holds its own slot.
+    """
+    iterator = iter(items)
+
+    async def _consume():
+        for item in iterator:
+            await worker(item)
+
+    await asyncio.gather(*(_consume() for _ in range(max(1, concurrency))))
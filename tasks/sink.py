@@ -0,0 +1,91 @@
+import os
+import json
+import pandas as pd
+
+try:
+    from tasks.journal import content_hash
+except ModuleNotFoundError:
+    from journal import content_hash
+
+RESULTS_FILE = "results.jsonl"
+RESULT_COLUMNS = ["url", "source", "content", "task", "total_tokens", "generated_text", "costs"]
+
+
+class ResultSink:
+    """
+    Append-only JSONL dataset with one line per processed document.
+    Document bodies are not copied into it: each line carries the content hash of its document instead,
+    and `attach_content` joins the bodies back from the input data when a full table is needed.
+    """
+    def __init__(self, path:str):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.path = path
+
+    def write(self, rows:list) -> None:
+        """
+        Appends result rows (dicts with the RESULT_COLUMNS keys) and flushes them to disk
+        """
+        with open(self.path, "a", encoding="utf-8") as f:
+            for row in rows:
+                entry = {column: row[column] for column in RESULT_COLUMNS if column != "content"}
+                entry["content_hash"] = content_hash(row["content"])
+                f.write(json.dumps(entry, ensure_ascii=False, default=str) + "\n")
+            f.flush()
+
+
+def read_results(path:str, offset:int=0, columns:list=None) -> tuple:
+    """
+    Reads the lines appended to the sink at <path> after byte <offset>.
+    A trailing line still being written is left for the next read.
+
+    Returns:
+        tuple: (DataFrame of the new rows, offset to pass to the next call)
+    """
+    if not os.path.exists(path):
+        return pd.DataFrame(columns=columns), offset
+    entries = []
+    with open(path, "rb") as f:
+        f.seek(offset)
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+            offset += len(line)
+            if line.strip():
+                entry = json.loads(line)
+                entries.append({column: entry.get(column) for column in columns} if columns else entry)
+    return pd.DataFrame(entries, columns=columns), offset
+
+
+def iter_results(path:str, chunk_rows:int=10_000, columns:list=None):
+    """
+    Yields the sink at <path> as DataFrames of at most <chunk_rows> rows, keeping only <columns>
+    """
+    entries = []
+    if not os.path.exists(path):
+        return
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            entries.append({column: entry.get(column) for column in columns} if columns else entry)
+            if len(entries) >= chunk_rows:
+                yield pd.DataFrame(entries, columns=columns)
+                entries = []
+    if entries:
+        yield pd.DataFrame(entries, columns=columns)
+
+
+def attach_content(results:pd.DataFrame, data:pd.DataFrame) -> pd.DataFrame:
+    """
+    Restores the content column of sink rows from the input documents in <data>, matching them by url and content hash.
+    Rows whose document is no longer in <data> keep an empty content.
+    """
+    if results.empty:
+        return pd.DataFrame(columns=RESULT_COLUMNS)
+    documents = pd.DataFrame({"url": data["url"].astype(str).values,
+                              "content_hash": [content_hash(content) for content in data["content"]],
+                              "content": data["content"].values}).drop_duplicates(subset=["url", "content_hash"])
+    results = results.assign(url=results["url"].astype(str))
+    merged = results.merge(documents, on=["url", "content_hash"], how="left")
+    return merged[RESULT_COLUMNS]
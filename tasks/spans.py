@@ -0,0 +1,100 @@
+import re
+import pandas as pd
+
+try:
+    from tasks.journal import content_hash
+except ModuleNotFoundError:
+    from journal import content_hash
+
+# Lines longer than this are numbered sentence group by sentence group, so navigation text glued to a paragraph
+# by the scraper can still be dropped without losing the paragraph
+MAX_UNIT_CHARS = 1000
+SENTENCE_BREAK = re.compile(r"(?<=[.!?;:])\s+")
+# "3-7", "3 - 7", "3–7", "3 to 7" or a single "12"
+DROP_RANGE = re.compile(r"(\d+)\s*(?:-|–|to)\s*(\d+)|(\d+)")
+
+
+def text_units(text:str) -> list:
+    """
+    Splits <text> into the units numbered for the model: its non-blank lines, long lines cut at sentence
+    boundaries into pieces of about MAX_UNIT_CHARS.
+
+    Returns:
+        list: (line index, unit text) pairs, in document order.
+    """
+    units = []
+    for line_index, line in enumerate(str(text).split("\n")):
+        line = " ".join(line.split())
+        if not line:
+            continue
+        if len(line) <= MAX_UNIT_CHARS:
+            units.append((line_index, line))
+            continue
+        piece = ""
+        for sentence in SENTENCE_BREAK.split(line):
+            if piece and len(piece) + len(sentence) + 1 > MAX_UNIT_CHARS:
+                units.append((line_index, piece))
+                piece = sentence
+            else:
+                piece = f"{piece} {sentence}" if piece else sentence
+        if piece:
+            units.append((line_index, piece))
+    return units
+
+
+def numbered_document(text:str) -> str:
+    """
+    <text> with one "[n] " prefixed unit per line, as sent by the span-deletion cleaning prompt
+    """
+    return "\n".join(f"[{number}] {unit}" for number, (_, unit) in enumerate(text_units(text), start=1))
+
+
+def parse_drop_ranges(answer:str, units:int) -> set:
+    """
+    Unit numbers listed in <answer> ("1-4, 9, 15-22", one range per line, or NONE), limited to 1..<units>
+    """
+    dropped = set()
+    for start, end, single in DROP_RANGE.findall(answer or ""):
+        first, last = (int(start), int(end)) if start else (int(single), int(single))
+        dropped.update(range(max(first, 1), min(last, units) + 1))
+    return dropped
+
+
+def rebuild_text(text:str, answer:str) -> str:
+    """
+    Cleaned version of <text>: its units minus the ones the model asked to drop, pieces of one line joined back
+    by spaces and lines by newlines. Whitespace inside lines is collapsed.
+    """
+    units = text_units(text)
+    dropped = parse_drop_ranges(answer, len(units))
+    lines = {}
+    for number, (line_index, unit) in enumerate(units, start=1):
+        if number not in dropped:
+            lines.setdefault(line_index, []).append(unit)
+    return "\n".join(" ".join(pieces) for pieces in lines.values())
+
+
+def span_cleaning_rows(results:pd.DataFrame, data:pd.DataFrame, task:str="cleaning") -> pd.DataFrame:
+    """
+    Turns span-deletion results (answers over the numbered documents) into rows of the rewrite cleaning task:
+    the original document in content and its rebuilt text in generated_text. Documents that end up empty are dropped.
+    """
+    originals = {(str(url), content_hash(numbered_document(content))): content for url, content in zip(data["url"], data["content"])}
+    rows = []
+    for row in results.itertuples(index=False):
+        if pd.isna(row.content) or pd.isna(row.generated_text):
+            continue
+        original = originals.get((str(row.url), content_hash(row.content)))
+        if original is None:
+            continue
+        cleaned = rebuild_text(original, row.generated_text)
+        if not cleaned:
+            continue
+        rows.append({"url": row.url,
+                     "source": row.source,
+                     "content": original,
+                     "task": task,
+                     "total_tokens": row.total_tokens,
+                     "generated_text": cleaned,
+                     "costs": row.costs})
+    return pd.DataFrame(rows, columns=results.columns)
@@ -1,119 +1,200 @@
 from utils import OpenAIPromptHandler
+from deadletter import EmptyResponse
+from chunking import DEFAULT_CHUNK_TOKENS, DEFAULT_CHUNK_OVERLAP
+from fused import fused_prompt, fused_task_name, fused_subtasks, fused_rows
+import os
 import pandas as pd
 import asyncio
-from tqdm import tqdm 
+from tqdm import tqdm
 import logging
 import argparse
-from prompts import PROMPT_ABBREV, PROMPT_DEFS, PROMPT_LINKS, SYSTEM_PROMPT_GENERAL, QA_SYSTEM, PROMPT_QA_TASK, CDM_SYSTEM, PROMPT_CDM_TASK, PROMPT_NER
+from prompts import PROMPT_ABBREV, PROMPT_DEFS, PROMPT_LINKS, SYSTEM_PROMPT_GENERAL, QA_SYSTEM, PROMPT_QA_TASK, CDM_SYSTEM, PROMPT_CDM_TASK, PROMPT_NER, FUSED_SECTIONS
 from sources import ABBREV, LINKS, DEFS, QA_TASK, NER_TASK
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
 CLEAN_DATA = "results/cleaning/cleaning.csv"
+FUSED_OUTPUT_PATH = "results/fused"
 
-async def abbrev_task(handler: OpenAIPromptHandler):
-    output_path = "results/abbrev"
-    task_name = output_path.split('/')[-1]
-    df = pd.read_csv(CLEAN_DATA)
-    data = df[df['source'].isin(ABBREV)]
-    results = await handler.execute_task(results_dir=output_path,
-                                         data=data,
-                                         task=task_name,
-                                         task_prompt=PROMPT_ABBREV,
-                                         system_prompt=SYSTEM_PROMPT_GENERAL,
-                                         batch_size=40)
-    handler.store_total_result(results, output_path, task_name)
-
-async def definition_task(handler: OpenAIPromptHandler):
-    output_path = "results/definitions"
-    task_name = output_path.split('/')[-1]
-    df = pd.read_csv(CLEAN_DATA)
-    data = df[df['source'].isin(DEFS)]
-
-    results = await handler.execute_task(results_dir=output_path,
-                                         data=data,
-                                         task=task_name,
-                                         task_prompt=PROMPT_DEFS,
-                                         system_prompt=SYSTEM_PROMPT_GENERAL,
-                                         batch_size=30)
-    handler.store_total_result(results, output_path, task_name)
-
-async def links_task(handler: OpenAIPromptHandler):
-    output_path = "results/links"
-    task_name = output_path.split('/')[-1]
-    df = pd.read_csv(CLEAN_DATA)
-    data = df[df['source'].isin(LINKS)]
-    results = await handler.execute_task(results_dir=output_path,
-                                         data=data,
-                                         task=task_name,
-                                         task_prompt=PROMPT_LINKS,
-                                         system_prompt=SYSTEM_PROMPT_GENERAL,
-                                         batch_size=30)
-    
-
-    handler.store_total_result(results, output_path, task_name)
-
-async def qa_task(handler: OpenAIPromptHandler):
-    output_path = "results/qa_task"
-    task_name = output_path.split('/')[-1]
-    df = pd.read_csv(CLEAN_DATA)
-    data = df[df["source"].isin(QA_TASK)]
-    results = await handler.execute_task(results_dir=output_path,
-                                         data=data,
-                                         task=task_name,
-                                         task_prompt=PROMPT_QA_TASK,
-                                         system_prompt=QA_SYSTEM,
-                                         batch_size=30)
-    
-    handler.store_total_result(results, output_path, task_name)
-
-
-async def cdm_task(handler: OpenAIPromptHandler):
-    output_path = "results/cdm_task"
-    task_name = output_path.split('/')[-1]
+# Output directory, sources, prompts and save interval of every instruction-generation task
+TASKS = {
+    "abbrev": {"output_path": "results/abbrev", "sources": ABBREV,
+               "task_prompt": PROMPT_ABBREV, "system_prompt": SYSTEM_PROMPT_GENERAL, "batch_size": 40},
+    "definitions": {"output_path": "results/definitions", "sources": DEFS,
+                    "task_prompt": PROMPT_DEFS, "system_prompt": SYSTEM_PROMPT_GENERAL, "batch_size": 30},
+    "links": {"output_path": "results/links", "sources": LINKS,
+              "task_prompt": PROMPT_LINKS, "system_prompt": SYSTEM_PROMPT_GENERAL, "batch_size": 30},
+    "qa_task": {"output_path": "results/qa_task", "sources": QA_TASK,
+                "task_prompt": PROMPT_QA_TASK, "system_prompt": QA_SYSTEM, "batch_size": 30},
+    "cdm_task": {"output_path": "results/cdm_task", "sources": ["CDM"],
+                 "task_prompt": PROMPT_CDM_TASK, "system_prompt": CDM_SYSTEM, "batch_size": 30},
+    "ner_task": {"output_path": "results/ner_task", "sources": NER_TASK,
+                 "task_prompt": PROMPT_NER, "system_prompt": SYSTEM_PROMPT_GENERAL, "batch_size": 30},
+}
+
+def task_job(task:str, df:pd.DataFrame) -> dict:
+    """
+    `execute_task` arguments of <task> over the cleaned corpus <df>
+    """
+    spec = TASKS[task]
+    output_path = spec["output_path"]
+    return {"results_dir": output_path,
+            "data": df[df['source'].isin(spec["sources"])],
+            "task": output_path.split('/')[-1],
+            "task_prompt": spec["task_prompt"],
+            "system_prompt": spec["system_prompt"],
+            "batch_size": spec["batch_size"],
+            # Documents over the window are processed in chunks and their lists merged, instead of being truncated
+            "chunk_tokens": DEFAULT_CHUNK_TOKENS,
+            "chunk_overlap": DEFAULT_CHUNK_OVERLAP}
+
+def fused_jobs(tasks:list, df:pd.DataFrame) -> list:
+    """
+    `execute_task` arguments answering <tasks> with fused calls. Every document is only asked for the sections of the
+    tasks that cover its source, so there is one fused job per combination of tasks sharing sources. Sources covered
+    by a single task keep that task's own prompt and results directory.
+    """
+    tasks_by_source = {}
+    for task in tasks:
+        for source in TASKS[task]["sources"]:
+            tasks_by_source.setdefault(source, []).append(task)
+    sources_by_subset = {}
+    for source, subset in tasks_by_source.items():
+        sources_by_subset.setdefault(tuple(subset), []).append(source)
+
+    jobs = []
+    for subset, sources in sources_by_subset.items():
+        data = df[df['source'].isin(sources)]
+        if data.empty:
+            continue
+        if len(subset) == 1:
+            jobs.append(task_job(subset[0], data))
+            continue
+        name = fused_task_name(list(subset))
+        jobs.append({"results_dir": os.path.join(FUSED_OUTPUT_PATH, name),
+                     "data": data,
+                     "task": name,
+                     "task_prompt": fused_prompt(list(subset)),
+                     "system_prompt": SYSTEM_PROMPT_GENERAL,
+                     "batch_size": 30,
+                     "chunk_tokens": DEFAULT_CHUNK_TOKENS,
+                     "chunk_overlap": DEFAULT_CHUNK_OVERLAP})
+    return jobs
+
+def store_fused_sections(handler: OpenAIPromptHandler, fused_results:list, fused_task:str):
+    """
+    Splits the answers of a fused job into the processed results and journal of each task it answered,
+    skipping documents a task already has. Documents whose answer lacks a task's section go to that task's
+    dead-letter store instead, so `retry_failed` on the task asks for them on their own.
+    """
+    subset = fused_subtasks(fused_task)
+    for task in subset:
+        processed_dir = os.path.join(TASKS[task]["output_path"], "processed")
+        journal = handler.load_journal(processed_dir, task)
+        dead_letters = handler.load_dead_letters(processed_dir)
+        rows, missing = [], []
+        for results in fused_results:
+            found, absent = fused_rows(results, task, subset)
+            rows += [row for row in found if not journal.is_done(task, row["url"], row["content"])]
+            missing += [(url, content) for url, content in absent if not journal.is_done(task, url, content)]
+        if rows:
+            handler.save_results(processed_dir, journal, rows, dead_letters)
+        for url, content in missing:
+            dead_letters.record(task, url, content, EmptyResponse(f"No {task} section in the {fused_task} answer"))
+        logging.info(f"{len(rows)} new {task} results taken from {fused_task}, {len(missing)} answers without the section")
+
+async def run_fused_tasks(handler: OpenAIPromptHandler, tasks:list, df:pd.DataFrame, mode:str="live"):
+    """
+    Answers several extraction tasks with one call per document instead of one call per task and document,
+    then stores each task's results as if it had run on its own
+    """
+    jobs = fused_jobs(tasks, df)
+    if mode == "plan":
+        for job in jobs:
+            handler.plan_task(results_dir=job["results_dir"], data=job["data"], task=job["task"],
+                              task_prompt=job["task_prompt"], system_prompt=job["system_prompt"],
+                              chunk_tokens=job["chunk_tokens"], chunk_overlap=job["chunk_overlap"])
+        return
+
+    results = await handler.execute_tasks(jobs)
+    for job in jobs:
+        if fused_subtasks(job["task"]):
+            store_fused_sections(handler, results[job["task"]], job["task"])
+    for task in tasks:
+        job = task_job(task, df)
+        results = [handler.load_existing_data(os.path.join(job["results_dir"], "processed"), data=job["data"])]
+        handler.store_total_result(results, job["results_dir"], job["task"])
+
+async def run_task(handler: OpenAIPromptHandler, task:str, df:pd.DataFrame, mode:str="live", retry_policy:dict=None):
+    """
+    Runs a task live through the API, renders/ingests its offline batch files, retries its failed documents
+    with <retry_policy> (`retry_failed` arguments) or only projects its cost depending on <mode>
+    """
+    job = task_job(task, df)
+    if mode == "plan":
+        handler.plan_task(results_dir=job["results_dir"], data=job["data"], task=job["task"],
+                          task_prompt=job["task_prompt"], system_prompt=job["system_prompt"],
+                          chunk_tokens=job["chunk_tokens"], chunk_overlap=job["chunk_overlap"])
+        return
+    if mode == "batch-prepare":
+        handler.prepare_batch_files(results_dir=job["results_dir"], data=job["data"], task=job["task"],
+                                    task_prompt=job["task_prompt"], system_prompt=job["system_prompt"],
+                                    chunk_tokens=job["chunk_tokens"], chunk_overlap=job["chunk_overlap"])
+        return
+    if mode == "batch-ingest":
+        results = handler.ingest_batch_results(results_dir=job["results_dir"], data=job["data"], task=job["task"])
+    elif mode == "retry-failed":
+        results = await handler.retry_failed(**job, **(retry_policy or {}))
+    else:
+        results = await handler.execute_task(**job)
+    handler.store_total_result(results, job["results_dir"], job["task"])
+
+async def run_tasks(handler: OpenAIPromptHandler, tasks:list, mode:str="live", retry_policy:dict=None, fused:bool=False):
+    """
+    Loads the cleaned corpus once and runs every task in <tasks>. Live runs go through a single scheduler,
+    so all tasks share the handler's rate limits and progress concurrently.
+    With <fused>, the extraction tasks of FUSED_SECTIONS are answered together by one call per document.
+    """
     df = pd.read_csv(CLEAN_DATA)
-    data = df[df["source"].isin(["CDM"])]
-    results = await handler.execute_task(results_dir=output_path,
-                                         data=data,
-                                         task=task_name,
-                                         task_prompt=PROMPT_CDM_TASK,
-                                         system_prompt=CDM_SYSTEM,
-                                         batch_size=30)
-    
-    handler.store_total_result(results, output_path, task_name)
-
-async def ner_task(handler: OpenAIPromptHandler):
-    output_path = "results/ner_task"
-    task_name = output_path.split('/')[-1]
-    df = pd.read_csv(CLEAN_DATA) 
-    data = df[df["source"].isin(NER_TASK)]
-    results = await handler.execute_task(results_dir=output_path,
-                                         data=data,
-                                         task=task_name,
-                                         task_prompt=PROMPT_NER,
-                                         system_prompt=SYSTEM_PROMPT_GENERAL,
-                                         batch_size=30)
-    handler.store_total_result(results, output_path, task_name)
+    fusable = [task for task in tasks if task in FUSED_SECTIONS]
+    if fused and len(fusable) > 1 and mode in ("live", "plan"):
+        await run_fused_tasks(handler, fusable, df, mode)
+        tasks = [task for task in tasks if task not in fusable]
+        if not tasks:
+            return
+    if mode != "live" or len(tasks) == 1:
+        for task in tasks:
+            await run_task(handler, task, df, mode, retry_policy)
+        return
+
+    jobs = [task_job(task, df) for task in tasks]
+    results = await handler.execute_tasks(jobs)
+    for job in jobs:
+        handler.store_total_result(results[job["task"]], job["results_dir"], job["task"])
 
 
 async def main():
     parser = argparse.ArgumentParser(description="QA related tasks with OSI and another task")
-    parser.add_argument("task", type=str, choices=["abbrev", "definitions", "links","qa_task","cdm_task", "ner_task"], help="The task to execute: 'classif' for classification, 'cleaning' for data cleaning.")
+    parser.add_argument("task", type=str, nargs="+", choices=list(TASKS) + ["all"],
+                        help="Tasks to execute, several tasks (or 'all') run concurrently over a single load of the cleaned corpus.")
+    parser.add_argument("--mode", type=str, choices=["live", "plan", "batch-prepare", "batch-ingest", "retry-failed"], default="live",
+                        help="'live' calls the API, 'plan' projects tokens/cost/time without calling it, 'batch-prepare' writes batch request files, 'batch-ingest' stores their results, 'retry-failed' sends again only the documents in the dead-letter store.")
+    parser.add_argument("--prompt-layout", type=str, choices=["template", "document-first"], default=None,
+                        help="'document-first' puts the document ahead of the instructions and sends the tasks of a document back-to-back, so they share a cached prompt prefix.")
+    parser.add_argument("--fused", action="store_true",
+                        help="Answer abbrev/definitions/links/ner_task with one sectioned call per document, split back into each task's results (live and plan modes).")
+    parser.add_argument("--concurrency", type=int, default=8, help="Documents in flight in retry-failed mode")
+    parser.add_argument("--retries", type=int, default=6, help="Attempts per request in retry-failed mode")
+    parser.add_argument("--backoff", type=float, default=3.0, help="Exponential backoff factor in retry-failed mode")
     args = parser.parse_args()
 
-    handler = OpenAIPromptHandler()
-    if args.task == "abbrev":
-        await abbrev_task(handler)
-    elif args.task == "definitions":
-        await definition_task(handler)
-    elif args.task == "links":
-        await links_task(handler)
-    elif args.task == "qa_task":
-        await qa_task(handler)
-    elif args.task == "cdm_task":
-        await cdm_task(handler)
-    elif args.task == "ner_task":
-        await ner_task(handler)
+    tasks = list(TASKS) if "all" in args.task else list(dict.fromkeys(args.task))
+    handler = OpenAIPromptHandler(prompt_layout=args.prompt_layout)
+    retry_policy = {"concurrency": args.concurrency, "retries": args.retries, "backoff_factor": args.backoff}
+    try:
+        await run_tasks(handler, tasks, args.mode, retry_policy, fused=args.fused)
+    finally:
+        await handler.close()
 
 if __name__ == "__main__":
     asyncio.run(main())
@@ -0,0 +1,134 @@
+import os
+import sqlite3
+import logging
+import threading
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+import tiktoken
+
+try:
+    from tasks.journal import content_hash
+except ModuleNotFoundError:
+    from journal import content_hash
+
+DEFAULT_MODEL = "gpt-4o-mini"
+# On-disk token counts, set TOKEN_COUNT_CACHE_PATH to an empty string to keep them in memory only
+DEFAULT_TOKEN_CACHE_PATH = ".llm_cache/token_counts.sqlite"
+# tiktoken releases the GIL while encoding, so threads encode documents in parallel
+ENCODE_THREADS = 8
+# Documents left to encode under which the thread pool costs more than it saves
+MIN_THREADED_DOCUMENTS = 16
+# Keys per SQLite lookup, under the default limit of host parameters per statement
+LOOKUP_BATCH = 500
+
+
+class TokenCounter:
+    """
+    Token counts of documents under one tiktoken encoding, memoized by content hash in memory and in SQLite,
+    so a document is encoded once across the filters, the planner, chunking and the handler, and across runs.
+    Counts are those of `encoding.encode`, which is what the call sites used before.
+    """
+    def __init__(self, model:str=DEFAULT_MODEL, cache_path:str=DEFAULT_TOKEN_CACHE_PATH, threads:int=ENCODE_THREADS):
+        self.encoding = tiktoken.encoding_for_model(model)
+        self.threads = threads
+        self.hits = 0
+        self.misses = 0
+        self._counts = {}
+        self._lock = threading.Lock()
+        self._conn = None
+        if cache_path:
+            os.makedirs(os.path.dirname(cache_path) or ".", exist_ok=True)
+            self._conn = sqlite3.connect(cache_path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS token_counts (
+                    encoding TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    tokens INTEGER NOT NULL,
+                    PRIMARY KEY (encoding, key)
+                )""")
+            self._conn.commit()
+
+    def count(self, text:str) -> int:
+        return self.count_many([text])[0]
+
+    def count_many(self, texts) -> list:
+        """
+        Token counts of every document of <texts>, in order. Documents not seen before are encoded by
+        <threads> threads and their counts stored.
+        """
+        texts = [str(text) for text in texts]
+        keys = [content_hash(text) for text in texts]
+        with self._lock:
+            missing = {key: text for key, text in zip(keys, texts) if key not in self._counts}
+            self.hits += len(texts) - len(missing)
+            self._counts.update(self._load(list(missing)))
+        pending = [(key, text) for key, text in missing.items() if key not in self._counts]
+        if pending:
+            pending_texts = [text for _, text in pending]
+            if len(pending) < MIN_THREADED_DOCUMENTS or self.threads <= 1:
+                counts = [len(self.encoding.encode(text)) for text in pending_texts]
+            else:
+                with ThreadPoolExecutor(max_workers=self.threads) as pool:
+                    counts = list(pool.map(lambda text: len(self.encoding.encode(text)), pending_texts))
+            self._store({key: tokens for (key, _), tokens in zip(pending, counts)})
+        with self._lock:
+            self.hits += len(missing) - len(pending)
+            self.misses += len(pending)
+            return [self._counts[key] for key in keys]
+
+    def encode(self, text:str) -> list:
+        """
+        Tokens of <text>, for callers that need them (chunking), recording its count on the way
+        """
+        tokens = self.encoding.encode(text)
+        key = content_hash(text)
+        if key not in self._counts:
+            self._store({key: len(tokens)})
+        return tokens
+
+    def decode(self, tokens:list) -> str:
+        return self.encoding.decode(tokens)
+
+    def _load(self, keys:list) -> dict:
+        if self._conn is None or not keys:
+            return {}
+        found = {}
+        for start in range(0, len(keys), LOOKUP_BATCH):
+            batch = keys[start:start + LOOKUP_BATCH]
+            rows = self._conn.execute(f"SELECT key, tokens FROM token_counts WHERE encoding = ? AND key IN ({','.join('?' * len(batch))})",
+                                      [self.encoding.name, *batch])
+            found.update(rows)
+        return found
+
+    def _store(self, counts:dict) -> None:
+        with self._lock:
+            self._counts.update(counts)
+            if self._conn is not None:
+                self._conn.executemany("INSERT OR REPLACE INTO token_counts VALUES (?, ?, ?)",
+                                       [(self.encoding.name, key, tokens) for key, tokens in counts.items()])
+                self._conn.commit()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {"hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0}
+
+    def log_stats(self) -> None:
+        stats = self.stats()
+        logging.info(f"Token counts: {stats['hits']} reused, {stats['misses']} encoded ({stats['hit_rate']:.1%} reused)")
+
+    def close(self) -> None:
+        if self._conn is not None:
+            self._conn.close()
+
+
+@lru_cache(maxsize=None)
+def token_counter(model:str=DEFAULT_MODEL, cache_path:str=None) -> TokenCounter:
+    """
+    Counter shared by every call site of this process for <model>, persisted at <cache_path>
+    (TOKEN_COUNT_CACHE_PATH or DEFAULT_TOKEN_CACHE_PATH by default)
+    """
+    cache_path = cache_path if cache_path is not None else os.getenv("TOKEN_COUNT_CACHE_PATH", DEFAULT_TOKEN_CACHE_PATH)
+    return TokenCounter(model=model, cache_path=cache_path)
@@ -1,22 +1,120 @@
 import os
+import time
 import asyncio
 from dotenv import load_dotenv
 from functools import wraps
-from openai import AzureOpenAI
-import concurrent.futures
+from openai import RateLimitError, APITimeoutError, APIConnectionError, InternalServerError
+from openai.types.chat import ChatCompletion
 import logging
 import numpy as np
-import traceback
 import pandas as pd
 from tqdm import tqdm
-import time
-import random
-import uuid
+import json
+import itertools
+
+try:
+    from tasks.scheduling import RequestStats, HedgingPolicy, request_deadline, run_pipeline
+    from tasks.deployments import Deployment, load_deployment_configs, choose_deployment
+    from tasks.cache import ResponseCache
+    from tasks.journal import ResumeJournal, content_hash
+    from tasks.batch import BATCH_DISCOUNT, batch_request, write_request_shards, read_batch_results, find_result_files
+    from tasks.planner import BudgetGuard, BudgetExceeded, plan_task, log_plan, estimate_output_tokens
+    from tasks.chunking import split_text, merge_outputs
+    from tasks.sink import RESULTS_FILE, RESULT_COLUMNS, ResultSink, read_results, attach_content
+    from tasks.deadletter import DEAD_LETTER_FILE, DeadLetterStore, EmptyResponse, BatchRequestError
+    from tasks.tokens import token_counter
+except ModuleNotFoundError:
+    from scheduling import RequestStats, HedgingPolicy, request_deadline, run_pipeline
+    from deployments import Deployment, load_deployment_configs, choose_deployment
+    from cache import ResponseCache
+    from journal import ResumeJournal, content_hash
+    from batch import BATCH_DISCOUNT, batch_request, write_request_shards, read_batch_results, find_result_files
+    from planner import BudgetGuard, BudgetExceeded, plan_task, log_plan, estimate_output_tokens
+    from chunking import split_text, merge_outputs
+    from sink import RESULTS_FILE, RESULT_COLUMNS, ResultSink, read_results, attach_content
+    from deadletter import DEAD_LETTER_FILE, DeadLetterStore, EmptyResponse, BatchRequestError
+    from tokens import token_counter
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logging.getLogger("openai").setLevel(logging.ERROR)
 logging.getLogger("httpx").setLevel(logging.ERROR)
 
+INPUT_TOKEN_PRICE = 0.15e-6
+OUTPUT_TOKEN_PRICE = 0.6e-6
+# Prompt tokens served from the provider's prompt cache are billed at this share of the input price
+CACHED_INPUT_DISCOUNT = 0.5
+
+# Deployment quota used to pace requests, can be overridden through AZURE_OPENAI_RPM / AZURE_OPENAI_TPM
+DEFAULT_REQUESTS_PER_MINUTE = 300
+DEFAULT_TOKENS_PER_MINUTE = 200_000
+# Output tokens reserved per request until the real usage comes back, when the caller has no estimate for its task
+EXPECTED_OUTPUT_TOKENS = 1_000
+# Size of the shared HTTP connection pool (async transport) or worker thread pool (thread transport)
+DEFAULT_MAX_CONNECTIONS = 200
+# On-disk response cache, set AZURE_OPENAI_CACHE_PATH to an empty string to disable it
+DEFAULT_CACHE_PATH = ".llm_cache/responses.sqlite"
+# Finish reasons of answers the provider withheld, as opposed to an empty answer from the model
+FAILED_FINISH_REASONS = {"content_filter"}
+# Requests in flight when a run starts, the adaptive controller moves it between 1 and max_connections
+INITIAL_CONCURRENCY = 8
+# Errors that mean the deployment is saturated and concurrency should go down
+OVERLOAD_ERRORS = (RateLimitError, APITimeoutError, InternalServerError)
+# Errors that take a deployment out of rotation for a while
+UNHEALTHY_ERRORS = (APIConnectionError, InternalServerError)
+# Errors of requests the server turned away or never got (timeouts excepted), whose token reservation is given back
+REJECTED_ERRORS = (RateLimitError, APIConnectionError)
+# "template" renders prompts as written in prompts.py. "document-first" puts the document ahead of the task
+# instructions, so that every task run over the same document shares a cacheable prompt prefix.
+PROMPT_LAYOUTS = ("template", "document-first")
+DOCUMENT_BLOCK = "Document:\n```\n{context}\n```\n\n"
+DOCUMENT_REFERENCE = "(see the document above)"
+# System message of every task in the document-first layout, the task's own system prompt follows the document
+DOCUMENT_FIRST_SYSTEM = "You are an accurate assistant, knowledgeable in law, regulation and finance. Follow the instructions given after the document."
+# Retry policy of regular runs, `retry_failed` uses its own
+DEFAULT_RETRIES = 4
+DEFAULT_BACKOFF_FACTOR = 2.0
+
+
+def retry_after_seconds(error:Exception) -> float:
+    """
+    Reads the retry-after-ms / retry-after headers of a failed API call, if any
+    """
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    try:
+        if "retry-after-ms" in response.headers:
+            return float(response.headers["retry-after-ms"]) / 1000
+        if "retry-after" in response.headers:
+            return float(response.headers["retry-after"])
+    except ValueError:
+        pass
+    return None
+
+
+def header_int(headers, name:str) -> int:
+    try:
+        return int(headers[name]) if name in headers else None
+    except ValueError:
+        return None
+
+
+def cached_tokens(usage) -> int:
+    """
+    Prompt tokens of a response that were read from the provider's prompt cache
+    """
+    details = getattr(usage, "prompt_tokens_details", None)
+    return (getattr(details, "cached_tokens", None) or 0) if details is not None else 0
+
+
+def failed_answer(response) -> bool:
+    """
+    Whether <response> has no answer because the request failed: no choices, or the text withheld by the content
+    filter. An empty text that finished normally is an answer, some prompts ask for it when nothing is found.
+    """
+    choices = getattr(response, "choices", None)
+    return not choices or getattr(choices[0], "finish_reason", None) in FAILED_FINISH_REASONS
+
 
 def async_retry(retries=4, backoff_factor=np.exp(1)):
     def decorator(func):
@@ -26,31 +124,126 @@ def async_retry(retries=4, backoff_factor=np.exp(1)):
             while attempts <= retries:
                 try:
                     return await func(*args, **kwargs)
+                except BudgetExceeded:
+                    raise
                 except Exception as e:
                     if attempts == retries:
-                        logging.error(f"Max retries reached. Last error: {traceback.print_exc()}")
-                        return ""
+                        logging.error(f"Max retries reached. Last error: {type(e).__name__}: {e}")
+                        raise
                     attempts += 1
-                    sleep_time = backoff_factor ** attempts
+                    # The server's retry-after wins over the local backoff when it asks for a longer wait
+                    sleep_time = max(backoff_factor ** attempts, retry_after_seconds(e) or 0)
                     await asyncio.sleep(sleep_time)
         return wrapper
     return decorator
 
 
 class OpenAIPromptHandler:
-    def __init__(self):
+    def __init__(self, requests_per_minute:int=None, tokens_per_minute:int=None, transport:str=None, max_connections:int=DEFAULT_MAX_CONNECTIONS,
+                 cache_path:str=None, temperature:float=0.0, max_cost:float=None, max_tokens:int=None, budget_window_seconds:float=None,
+                 deadline_scale:float=1.0, hedge_quantile:float=95, prompt_layout:str=None):
+        """
+        Args:
+            requests_per_minute (int), tokens_per_minute (int): Quota of each deployment that does not set its own,
+                defaults to AZURE_OPENAI_RPM / AZURE_OPENAI_TPM.
+            transport (str): "async" sends requests through one AsyncAzureOpenAI client per deployment with a bounded
+                keep-alive connection pool, "thread" runs the synchronous client on a shared pool of <max_connections> threads.
+                Defaults to the AZURE_OPENAI_TRANSPORT environment variable or "async".
+            cache_path (str): SQLite file used to cache responses across runs. Defaults to the AZURE_OPENAI_CACHE_PATH
+                environment variable or DEFAULT_CACHE_PATH, an empty string disables the cache.
+            max_cost (float), max_tokens (int): Caps on live API spending (AZURE_OPENAI_MAX_COST / AZURE_OPENAI_MAX_TOKENS).
+                Reaching one stops dispatching new documents, or pauses it when <budget_window_seconds> is set.
+            deadline_scale (float): Multiplier of the per-request deadline, which grows with the prompt size
+                (see `scheduling.request_deadline`). Requests past it are aborted and retried, None disables deadlines.
+            hedge_quantile (float): Requests running longer than this latency percentile (relative to their deadline)
+                get a speculative duplicate and the first answer wins. None disables hedging.
+            prompt_layout (str): "template" or "document-first" (see PROMPT_LAYOUTS), defaults to the
+                AZURE_OPENAI_PROMPT_LAYOUT environment variable or "template". With "document-first", every task uses
+                DOCUMENT_FIRST_SYSTEM as system message and its own system prompt moves after the document, and the
+                tasks of a document are sent back-to-back to the same deployment to reuse the provider's prompt cache.
+
+        Requests are spread over the deployment pool described by AZURE_OPENAI_DEPLOYMENTS (see
+        `load_deployment_configs`), or over the single AZURE_OPENAI_ENDPOINT deployment when it is not set.
+        """
         load_dotenv()
-        self.api_endpoint = os.getenv("AZURE_OPENAI_ENDPOINT")
-        self.deployment_name = os.getenv("AZURE_OPENAI_CHAT_DEPLOYMENT_NAME")
-        self.client = AzureOpenAI(
-            api_key=os.getenv("AZURE_OPENAI_API_KEY"),
-            api_version="2024-02-01",
-            azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT")
+        self.transport = transport or os.getenv("AZURE_OPENAI_TRANSPORT", "async")
+        self.temperature = temperature
+        if self.transport not in ("async", "thread"):
+            raise ValueError(f"Unknown transport '{self.transport}', expected 'async' or 'thread'")
+        self.prompt_layout = prompt_layout or os.getenv("AZURE_OPENAI_PROMPT_LAYOUT", "template")
+        if self.prompt_layout not in PROMPT_LAYOUTS:
+            raise ValueError(f"Unknown prompt layout '{self.prompt_layout}', expected one of {PROMPT_LAYOUTS}")
+
+        configs = load_deployment_configs(
+            requests_per_minute=requests_per_minute or int(os.getenv("AZURE_OPENAI_RPM", DEFAULT_REQUESTS_PER_MINUTE)),
+            tokens_per_minute=tokens_per_minute or int(os.getenv("AZURE_OPENAI_TPM", DEFAULT_TOKENS_PER_MINUTE))
         )
+        self.deployments = [Deployment(endpoint=config["endpoint"],
+                                       api_key=config["api_key"],
+                                       deployment_name=config["deployment"],
+                                       requests_per_minute=int(config["rpm"]),
+                                       tokens_per_minute=int(config["tpm"]),
+                                       transport=self.transport,
+                                       max_connections=max_connections,
+                                       initial_concurrency=INITIAL_CONCURRENCY,
+                                       weight=float(config.get("weight", 1.0)))
+                            for config in configs]
+        # The first deployment names the model for the response cache and the offline batch files
+        self.api_endpoint = self.deployments[0].endpoint
+        self.deployment_name = self.deployments[0].deployment_name
+        self.client = self.deployments[0].client
+        # Token counts are shared with the planner and the data filters, and persisted across runs
+        self.tokens = token_counter("gpt-4o-mini")
+        self.encoding = self.tokens.encoding
+        cache_path = cache_path if cache_path is not None else os.getenv("AZURE_OPENAI_CACHE_PATH", DEFAULT_CACHE_PATH)
+        self.cache = ResponseCache(cache_path) if cache_path else None
+        max_cost = max_cost if max_cost is not None else os.getenv("AZURE_OPENAI_MAX_COST")
+        max_tokens = max_tokens if max_tokens is not None else os.getenv("AZURE_OPENAI_MAX_TOKENS")
+        self.budget = BudgetGuard(max_cost=float(max_cost) if max_cost is not None else None,
+                                  max_tokens=int(max_tokens) if max_tokens is not None else None,
+                                  window_seconds=budget_window_seconds)
+        self.stats = RequestStats()
+        self.deadline_scale = deadline_scale
+        self.hedging = HedgingPolicy(quantile=hedge_quantile) if hedge_quantile and deadline_scale else None
 
+    @property
+    def requests_per_minute(self) -> int:
+        return sum(deployment.rate_limiter.requests_per_minute for deployment in self.deployments)
 
-    def construct_prompt(self, prompt_template: str, context: str) -> str:
-        return prompt_template.format(context=context)
+    @property
+    def tokens_per_minute(self) -> int:
+        return sum(deployment.rate_limiter.tokens_per_minute for deployment in self.deployments)
+
+    @property
+    def max_concurrency(self) -> int:
+        return sum(deployment.concurrency.maximum for deployment in self.deployments)
+
+    def construct_prompt(self, prompt_template: str, context: str, system_prompt:str=None) -> tuple:
+        """
+        (prompt, system prompt) of a request for the document <context>
+        """
+        if self.prompt_layout == "document-first":
+            # System message and document are the same for every task, so they form the shared cached prefix;
+            # the task's system prompt and template follow, with the document replaced by a reference
+            instructions = f"{system_prompt.strip()}\n\n" if system_prompt else ""
+            prompt = DOCUMENT_BLOCK.format(context=context) + instructions + prompt_template.format(context=DOCUMENT_REFERENCE)
+            return prompt, DOCUMENT_FIRST_SYSTEM
+        return prompt_template.format(context=context), system_prompt
+
+    def prompt_overhead(self, prompt_template: str, system_prompt:str=None) -> int:
+        """
+        Tokens a request adds to its document (template and system prompt), the same for every document of a task,
+        so only a handful of counts are cached however many prompts are rendered (see `planner.plan_task`)
+        """
+        prompt, system_prompt = self.construct_prompt(prompt_template, "", system_prompt)
+        return sum(self.tokens.count_many([prompt, system_prompt or ""]))
+
+    def build_messages(self, prompt: str, system_prompt:str=None) -> list:
+        messages = []
+        if system_prompt:
+            messages.append({"role": "system", "content": system_prompt})
+        messages.append({"role": "user", "content": prompt})
+        return messages
 
     def calculate_cost(self, responses:list, input_token_price:int, output_token_price:int) -> list:
         """
@@ -58,7 +251,11 @@ class OpenAIPromptHandler:
         """
         def _calculate_individual_cost(response, input_token_price:int, output_token_price:int) -> tuple:
             usage = response.usage
-            return (usage.prompt_tokens * input_token_price) + (usage.completion_tokens * output_token_price), usage.prompt_tokens + usage.completion_tokens
+            if getattr(response, "from_cache", False):
+                return 0, usage.prompt_tokens + usage.completion_tokens
+            # Cached prompt tokens are billed at a discount
+            input_cost = (usage.prompt_tokens - cached_tokens(usage) * (1 - CACHED_INPUT_DISCOUNT)) * input_token_price
+            return input_cost + (usage.completion_tokens * output_token_price), usage.prompt_tokens + usage.completion_tokens
             
         costs = []
         for response in responses:
@@ -66,115 +263,517 @@ class OpenAIPromptHandler:
         return costs 
     
 
-    def load_existing_data(self, results_dir:str):
+    def load_existing_data(self, results_dir:str, data:pd.DataFrame=None):
         """
-        Takes in a task directory and checks if any saved results are available
+        Takes in a task directory and checks if any saved results are available.
+        Rows of the results sink get their content back from the documents in <data>; result CSVs written
+        before the sink existed are read as they are.
         """
         os.makedirs(results_dir, exist_ok=True)  # Ensure the directory exists
         existing_files = [f for f in os.listdir(results_dir) if f.endswith('.csv')]
-        return pd.concat([pd.read_csv(os.path.join(results_dir, f)) for f in existing_files], ignore_index=True) if existing_files else pd.DataFrame()
+        frames = [pd.read_csv(os.path.join(results_dir, f)) for f in existing_files]
+        sink_rows, _ = read_results(os.path.join(results_dir, RESULTS_FILE))
+        if not sink_rows.empty:
+            frames.append(attach_content(sink_rows, data) if data is not None else sink_rows.reindex(columns=RESULT_COLUMNS))
+        if not frames:
+            return pd.DataFrame()
+        # A document answered again by `retry_failed` keeps only its latest result
+        return pd.concat(frames, ignore_index=True).drop_duplicates(subset=["url", "content"], keep="last", ignore_index=True)
 
-    
-    @async_retry(retries=4, backoff_factor=2.0)
-    async def send_prompt(self, prompt: str, system_prompt:str=None):
+    async def send_prompt(self, prompt: str, system_prompt:str=None, retries:int=DEFAULT_RETRIES, backoff_factor:float=DEFAULT_BACKOFF_FACTOR,
+                          affinity:str=None, output_tokens:int=EXPECTED_OUTPUT_TOKENS, prompt_tokens:int=None):
         """
         Send the prepared prompt to the OpenAI API for generating abbreviations using futures.
 
         Args:
             prompt (str): The prompt text to send.
+            retries (int), backoff_factor (float): Retry policy, the last error is raised once <retries> are exhausted.
+            affinity (str): Requests with the same key are routed to the same deployment when possible.
+            output_tokens (int): Expected completion length (see `planner.estimate_output_tokens`), which sizes the
+                request's deadline and its rate-limiter reservation.
+            prompt_tokens (int): Size of the prompt, document plus `prompt_overhead`, the rendered prompt is encoded
+                (without being cached) when it is not given.
 
         Returns:
             dict: Response content from the OpenAI API with generated abbreviations.
         """
-        
-        messages = []
-        if system_prompt:
-            messages.append({"role": "system", "content": system_prompt})
-        messages.append({"role": "user", "content": prompt})
+        return await async_retry(retries=retries, backoff_factor=backoff_factor)(self._send_hedged)(prompt, system_prompt, affinity, output_tokens, prompt_tokens)
 
-        # Define a function to make the request synchronously
-        def make_request():
-            chat_completion_zero = self.client.chat.completions.create(
-                model=self.deployment_name,
-                messages=messages,
-                temperature=0.0
-            )
-            return chat_completion_zero
-
-        # Use ThreadPoolExecutor to run the request in a separate thread
-        loop = asyncio.get_event_loop()
-        with concurrent.futures.ThreadPoolExecutor() as executor:
-            future = loop.run_in_executor(executor, make_request)
-            try:
-                response = await future
+    async def _send_hedged(self, prompt: str, system_prompt:str=None, affinity:str=None, output_tokens:int=EXPECTED_OUTPUT_TOKENS,
+                           prompt_tokens:int=None):
+        """
+        One attempt of `send_prompt`. If it is still running once the hedging policy considers it slow,
+        a duplicate is sent (possibly to another deployment) and whichever copy answers first is used.
+        """
+        # Identical requests from previous runs are answered from disk without touching the network
+        if self.cache is not None:
+            cached = self.cache.get(ResponseCache.make_key(self.deployment_name, system_prompt, prompt, self.temperature))
+            if cached is not None:
+                response = ChatCompletion.model_validate_json(cached)
+                # Answers from the cache were paid for by an earlier run
+                response.from_cache = True
                 return response
+
+        # Rendered prompts are unique per document and task, so they are not worth a row in the token count cache
+        if prompt_tokens is None:
+            prompt_tokens = len(self.encoding.encode(prompt)) + len(self.encoding.encode(system_prompt or ""))
+        deadline = request_deadline(prompt_tokens, output_tokens, self.deadline_scale) if self.deadline_scale else None
+        hedge_delay = self.hedging.delay(deadline) if self.hedging is not None else None
+
+        sent = asyncio.Event()
+        attempts = [asyncio.ensure_future(self._send_prompt_once(prompt, system_prompt, prompt_tokens, output_tokens, deadline, affinity, sent))]
+        try:
+            if hedge_delay is None:
+                return await attempts[0]
+            # The hedge timer starts once the request is on the wire, time queued for quota or a slot does not count
+            waiter = asyncio.ensure_future(sent.wait())
+            await asyncio.wait([attempts[0], waiter], return_when=asyncio.FIRST_COMPLETED)
+            waiter.cancel()
+            done, _ = await asyncio.wait(attempts, timeout=hedge_delay)
+            if not done:
+                self.stats.hedges += 1
+                attempts.append(asyncio.ensure_future(self._send_prompt_once(prompt, system_prompt, prompt_tokens, output_tokens, deadline, affinity)))
+
+            pending, error = set(attempts), None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for attempt in done:
+                    if attempt.exception() is None:
+                        if attempt is not attempts[0]:
+                            self.stats.hedge_wins += 1
+                        return attempt.result()
+                    error = attempt.exception()
+            # Both copies failed, the retry policy of `send_prompt` takes over
+            raise error
+        finally:
+            for attempt in attempts:
+                if not attempt.done():
+                    attempt.cancel()
+
+    async def _send_prompt_once(self, prompt: str, system_prompt:str, prompt_tokens:int, output_tokens:int=EXPECTED_OUTPUT_TOKENS,
+                                deadline:float=None, affinity:str=None, sent:asyncio.Event=None):
+        """
+        Sends a single request for the prompt, aborting it after <deadline> seconds. <sent> is set once the
+        request has cleared the rate limiter and concurrency controller and goes out.
+        """
+        messages = self.build_messages(prompt, system_prompt)
+        cache_key = ResponseCache.make_key(self.deployment_name, system_prompt, prompt, self.temperature) if self.cache is not None else None
+
+        # Route the attempt to the deployment with the most headroom, a retry after a failure is routed again
+        deployment = choose_deployment(self.deployments, affinity)
+
+        # Reserve quota for this attempt, the estimate is corrected with the real usage below
+        reserved_tokens = await deployment.rate_limiter.acquire(prompt_tokens + output_tokens)
+
+        await deployment.concurrency.acquire()
+        try:
+            # Checked right before sending, so only requests already in flight can overshoot the budget
+            await self.budget.check()
+            started_at = self.stats.start()
+            if sent is not None:
+                sent.set()
+            try:
+                raw_response = await deployment.create_completion(messages, self.temperature, timeout=deadline)
+            except asyncio.CancelledError:
+                # The other copy of a hedged request answered first
+                self.stats.finish(started_at, cancelled=True)
+                raise
             except Exception as e:
-                logging.error(f"Failed to send prompt: {traceback.print_exc()}")
+                self.stats.finish(started_at, failed=True, timed_out=isinstance(e, APITimeoutError))
                 raise
+            self.stats.finish(started_at)
+            if self.hedging is not None:
+                self.hedging.observe(time.monotonic() - started_at, deadline)
+            deployment.concurrency.on_success()
+            deployment.mark_success()
+        except BudgetExceeded:
+            deployment.rate_limiter.settle(reserved_tokens, 0)
+            raise
+        except (OVERLOAD_ERRORS + UNHEALTHY_ERRORS) as e:
+            # A timed-out request may still be generating, only requests that consumed nothing are refunded,
+            # so a 429 is not paid for twice by the local bucket on top of the cut and the retry-after pause
+            if isinstance(e, REJECTED_ERRORS) and not isinstance(e, APITimeoutError):
+                deployment.rate_limiter.settle(reserved_tokens, 0)
+            if isinstance(e, OVERLOAD_ERRORS):
+                deployment.concurrency.on_overload(retry_after_seconds(e))
+                logging.warning(f"{deployment} overloaded ({type(e).__name__}), concurrency limit down to {int(deployment.concurrency.limit)}")
+            if isinstance(e, UNHEALTHY_ERRORS) and not isinstance(e, APITimeoutError):
+                deployment.mark_failure()
+            raise
+        except Exception as e:
+            logging.error(f"Failed to send prompt: {e}")
+            raise
+        finally:
+            await deployment.concurrency.release()
+        deployment.rate_limiter.observe_remaining(remaining_requests=header_int(raw_response.headers, "x-ratelimit-remaining-requests"),
+                                                  remaining_tokens=header_int(raw_response.headers, "x-ratelimit-remaining-tokens"))
+        response = raw_response.parse()
+        self.stats.record_tokens(response.usage.prompt_tokens, cached_tokens(response.usage))
+        deployment.rate_limiter.settle(reserved_tokens, response.usage.total_tokens)
+        self.budget.record(*self.calculate_cost(responses=[response], input_token_price=INPUT_TOKEN_PRICE, output_token_price=OUTPUT_TOKEN_PRICE)[0])
+        if cache_key is not None and not failed_answer(response):
+            self.cache.put(cache_key, response.model_dump_json())
+        return response
+
+    async def close(self) -> None:
+        """
+        Releases the pooled connections and worker threads held by the handler
+        """
+        for deployment in self.deployments:
+            await deployment.close()
+        if self.cache is not None:
+            self.cache.close()
             
     async def send_prompts_async(self, tasks):
         responses = await asyncio.gather(*tasks, return_exceptions=True)
         return responses
     
-    async def process_batch_task(self, batch_data:pd.DataFrame, task_prompt:str, system_prompt:str)-> tuple:
+    def result_row(self, row, task:str, response, input_token_price:float=INPUT_TOKEN_PRICE, output_token_price:float=OUTPUT_TOKEN_PRICE) -> dict:
         """
-        Takes in existing data and the current batch to check for new information. If it exists, it generates tasks and executes them.
-        Returns a tuple containing the responses and costs
+        Adapts a response for the document in <row> to the results schema
         """
-        
-        # List to store tasks for the current batch
-        tasks = []
-        # Create tasks for the current batch
-        for content in batch_data['content']:
-            prompt = self.construct_prompt(task_prompt, content)
-            task = asyncio.create_task(self.send_prompt(prompt, system_prompt=system_prompt))
-            tasks.append(task)
+        cost, total_tokens = self.calculate_cost(responses=[response], input_token_price=input_token_price, output_token_price=output_token_price)[0]
+        return {"url": row.url,
+                "source": row.source,
+                "content": row.content,
+                "task": task,
+                "total_tokens": total_tokens,
+                "generated_text": (response.choices[0].message.content or "") if hasattr(response,"choices") else "",
+                "costs": cost}
 
-        # Wait for all tasks in the current batch to complete and calculate costs
-        responses = await asyncio.gather(*tasks, return_exceptions=True)
-        costs = self.calculate_cost(responses=responses, input_token_price=0.15e-6, output_token_price=0.6e-6)
+    async def process_row(self, row, task:str, task_prompt:str, system_prompt:str, chunk_tokens:int=None, chunk_overlap:int=0,
+                          retries:int=DEFAULT_RETRIES, backoff_factor:float=DEFAULT_BACKOFF_FACTOR) -> dict:
+        """
+        Sends the prompt for a single document and adapts the response to the results schema.
+        Documents longer than <chunk_tokens> are split into overlapping windows whose prompts are sent concurrently,
+        and the chunk outputs are merged into one answer for the document (see `chunking.merge_outputs`).
+        Returns None when the budget ran out before the request was sent. Raises the last error when the retries are
+        exhausted, or EmptyResponse when a request got no answer (see `failed_answer`), so the document can go to the
+        dead-letter store. Empty answers that finished normally are results like any other.
+        """
+        chunks = self.document_chunks(row.content, chunk_tokens, chunk_overlap)
+        # With the document-first layout, every task of a document goes to the deployment holding its cached prefix
+        affinity = content_hash(row.content) if self.prompt_layout == "document-first" else None
+        # Prompt sizes are the cached chunk counts plus the task's overhead, rendered prompts are never counted
+        overhead_tokens = self.prompt_overhead(task_prompt, system_prompt)
+        chunk_sizes = self.tokens.count_many(chunks)
+        try:
+            # Deadlines and quota reservations follow the task's expected answer length, rewrites grow with the chunk
+            responses = await asyncio.gather(*[self.send_prompt(*self.construct_prompt(task_prompt, chunk, system_prompt),
+                                                                retries=retries, backoff_factor=backoff_factor, affinity=affinity,
+                                                                output_tokens=estimate_output_tokens(task, size),
+                                                                prompt_tokens=overhead_tokens + size)
+                                               for chunk, size in zip(chunks, chunk_sizes)])
+        except BudgetExceeded:
+            return None
+        if any(map(failed_answer, responses)):
+            raise EmptyResponse(f"No answer for {row.url}")
+        return self.result_row(row, task, responses[0]) if len(responses) == 1 else self.chunked_result_row(row, task, responses)
 
-        return responses, costs
-    
-    async def execute_task(self, results_dir:str, data:pd.DataFrame, task:str,task_prompt:str, system_prompt:str = None, batch_size:int=20):
+    def document_chunks(self, content:str, chunk_tokens:int=None, chunk_overlap:int=0) -> list:
+        """
+        Windows of <content> sent as separate requests, the document itself when it fits in <chunk_tokens>
+        """
+        # Documents that fit in one window are sent as they are without being encoded again
+        if chunk_tokens and self.tokens.count(content) > chunk_tokens:
+            return split_text(content, self.encoding, chunk_tokens, chunk_overlap)
+        return [content]
+
+    def chunked_result_row(self, row, task:str, responses:list, input_token_price:float=INPUT_TOKEN_PRICE, output_token_price:float=OUTPUT_TOKEN_PRICE) -> dict:
+        """
+        Adapts the responses for the chunks of the document in <row> to a single row of the results schema,
+        adding up their tokens and costs
         """
-        Takes in the integrity of documents and generates questions.
+        costs = self.calculate_cost(responses=responses, input_token_price=input_token_price, output_token_price=output_token_price)
+        outputs = [(response.choices[0].message.content or "") if hasattr(response, "choices") else "" for response in responses]
+        return {"url": row.url,
+                "source": row.source,
+                "content": row.content,
+                "task": task,
+                "total_tokens": sum(tokens for _, tokens in costs),
+                "generated_text": merge_outputs(task, outputs),
+                "costs": sum(cost for cost, _ in costs)}
+
+    def plan_task(self, results_dir:str, data:pd.DataFrame, task:str, task_prompt:str, system_prompt:str = None,
+                  chunk_tokens:int=None, chunk_overlap:int=0) -> dict:
+        """
+        Dry run of `execute_task`: projects tokens, cost and wall-clock time for the documents still pending
+        under the handler's RPM/TPM limits and logs the projection, without sending anything.
+        """
+        data = self.pending_data(data, self.load_journal(os.path.join(results_dir, "processed"), task), task)
+        plan = plan_task(data['content'], task, task_prompt, system_prompt, self.tokens,
+                         requests_per_minute=self.requests_per_minute,
+                         tokens_per_minute=self.tokens_per_minute,
+                         input_token_price=INPUT_TOKEN_PRICE, output_token_price=OUTPUT_TOKEN_PRICE,
+                         chunk_tokens=chunk_tokens, chunk_overlap=chunk_overlap)
+        log_plan(plan)
+        return plan
+
+    def load_journal(self, processed_dir:str, task:str) -> ResumeJournal:
+        """
+        Opens the resume journal of a task directory, migrating result CSVs written before it existed
+        """
+        os.makedirs(processed_dir, exist_ok=True)
+        journal_path = os.path.join(processed_dir, "journal.jsonl")
+        journal_exists = os.path.exists(journal_path)
+        journal = ResumeJournal(journal_path)
+        if not journal_exists:
+            journal.bootstrap(processed_dir, task)
+        return journal
+
+    def pending_data(self, data:pd.DataFrame, journal:ResumeJournal, task:str) -> pd.DataFrame:
+        """
+        Drops the documents of <data> that the journal already records as done for <task>
+        """
+        if not len(journal):
+            return data
+        data = data[[not journal.is_done(task, url, content) for url, content in zip(data['url'], data['content'])]]
+        logging.info(f"{len(data)} documents left after resume journal verification")
+        return data
+
+    def save_results(self, processed_dir:str, journal:ResumeJournal, rows:list, dead_letters:DeadLetterStore=None) -> None:
+        """
+        Appends result rows to the task's results sink and marks them as done in the journal,
+        removing them from the dead-letter store if they had failed before
+        """
+        ResultSink(os.path.join(processed_dir, RESULTS_FILE)).write(rows)
+        items = [(row["task"], row["url"], row["content"]) for row in rows]
+        journal.mark_done(items)
+        if dead_letters is not None:
+            dead_letters.resolve(items)
+
+    def load_dead_letters(self, processed_dir:str) -> DeadLetterStore:
+        return DeadLetterStore(os.path.join(processed_dir, DEAD_LETTER_FILE))
+
+    async def execute_task(self, results_dir:str, data:pd.DataFrame, task:str,task_prompt:str, system_prompt:str = None, batch_size:int=20,
+                           chunk_tokens:int=None, chunk_overlap:int=0):
+        """
+        Runs <task_prompt> over every document in <data> that has not been processed yet.
+        The next document starts as soon as a request finishes; how many are in flight is decided by the handler's
+        adaptive concurrency controller and pacing by its RPM/TPM rate limiter. Results are saved every <batch_size> documents.
+        Completed documents are tracked in a resume journal keyed by (task, url, content hash), so re-runs skip them
+        without reading the stored results. Documents that still fail after every retry, or get no answer (see `failed_answer`),
+        go to the dead-letter store (processed/dead_letter.jsonl) instead, see `retry_failed`.
+        With <chunk_tokens>, longer documents are processed in overlapping windows of that size instead of in one call.
+        """
+        results = await self.execute_tasks([{"results_dir": results_dir,
+                                             "data": data,
+                                             "task": task,
+                                             "task_prompt": task_prompt,
+                                             "system_prompt": system_prompt,
+                                             "batch_size": batch_size,
+                                             "chunk_tokens": chunk_tokens,
+                                             "chunk_overlap": chunk_overlap}])
+        return results[task]
+
+    async def execute_tasks(self, jobs:list, concurrency:int=None, group_by_document:bool=None) -> dict:
+        """
+        Runs several tasks at once through a single scheduler, so they share the handler's rate limiters and
+        concurrency controllers and the whole run takes about as long as its largest task.
+        Documents of the different tasks are interleaved, every task keeps its own results directory and journal.
+
+        Args:
+            jobs (list): Dicts with the `execute_task` arguments: results_dir, data, task, task_prompt and
+                optionally system_prompt, batch_size, chunk_tokens and chunk_overlap. Jobs can also set their retry
+                policy (retries, backoff_factor) and skip the resume journal (ignore_journal).
+            concurrency (int): Documents in flight at once, defaults to what the deployments allow.
+            group_by_document (bool): Send all tasks of a document back-to-back: the first one alone, to populate the
+                provider's prompt cache, then the others together. Defaults to True with the document-first layout.
+
+        Returns:
+            dict: The `execute_task` result of every job, keyed by task name.
+        """
+        states = []
+        for job in jobs:
+            processed_dir = os.path.join(job["results_dir"], "processed")
+            journal = self.load_journal(processed_dir, job["task"])
+            states.append({"job": job,
+                           "processed_dir": processed_dir,
+                           "journal": journal,
+                           "dead_letters": self.load_dead_letters(processed_dir),
+                           "data": job["data"] if job.get("ignore_journal") else self.pending_data(job["data"], journal, job["task"]),
+                           "pending": []})
+        progress = tqdm(total=sum(len(state["data"]) for state in states))
+
+        async def process_item(state, row):
+            job = state["job"]
+            try:
+                result = await self.process_row(row, job["task"], job["task_prompt"], job.get("system_prompt"),
+                                                chunk_tokens=job.get("chunk_tokens"), chunk_overlap=job.get("chunk_overlap", 0),
+                                                retries=job.get("retries", DEFAULT_RETRIES),
+                                                backoff_factor=job.get("backoff_factor", DEFAULT_BACKOFF_FACTOR))
+            except Exception as e:
+                # Failed documents are kept out of the results and the journal, so they are not taken as done
+                state["dead_letters"].record(job["task"], row.url, row.content, e)
+                progress.update(1)
+                return
+            if result is None:
+                return
+            state["pending"].append(result)
+            progress.update(1)
+            if len(state["pending"]) >= job.get("batch_size", 20):
+                self.save_results(state["processed_dir"], state["journal"], state["pending"], state["dead_letters"])
+                state["pending"].clear()
+
+        async def worker(group):
+            await process_item(*group[0])
+            if len(group) > 1:
+                await asyncio.gather(*(process_item(state, row) for state, row in group[1:]))
+
+        # Round-robin over the tasks so none of them waits for another one to finish
+        per_task = [[(state, row) for row in state["data"].itertuples(index=False)] for state in states]
+        items = [item for group in itertools.zip_longest(*per_task) for item in group if item is not None]
+        if group_by_document if group_by_document is not None else self.prompt_layout == "document-first":
+            groups = {}
+            for state, row in items:
+                groups.setdefault((str(row.url), content_hash(row.content)), []).append((state, row))
+            items = list(groups.values())
+        else:
+            items = [[item] for item in items]
+        # Stop handing out documents once the budget is exhausted, requests in flight still complete
+        items = itertools.takewhile(lambda _: not self.budget.exhausted, items)
+        await run_pipeline(items, worker, concurrency=concurrency or self.max_concurrency)
+
+        for state in states:
+            if state["pending"]:
+                self.save_results(state["processed_dir"], state["journal"], state["pending"], state["dead_letters"])
+            state["dead_letters"].log_summary(state["job"]["task"])
+        progress.close()
+        # Figures since the handler was created, so every run reports its hedges, timeouts and tail latency
+        self.stats.log_stats()
+        self.tokens.log_stats()
+        if self.cache is not None:
+            self.cache.log_stats()
+
+        # Results of previous and current runs are only read back once, to hand them over to the caller
+        return {state["job"]["task"]: [self.load_existing_data(results_dir=state["processed_dir"], data=state["job"]["data"])]
+                for state in states}
+
+    async def retry_failed(self, results_dir:str, data:pd.DataFrame, task:str, task_prompt:str, system_prompt:str = None, batch_size:int=20,
+                           chunk_tokens:int=None, chunk_overlap:int=0, concurrency:int=8, retries:int=6, backoff_factor:float=3.0):
+        """
+        Sends again only the documents of <data> in the task's dead-letter store, with a separate, more patient retry
+        policy and a lower concurrency than regular runs. Documents that succeed replace their previous result.
+        Stored empty answers are results (see `failed_answer`) and are not sent again.
+        """
+        processed_dir = os.path.join(results_dir, "processed")
+        dead_letters = self.load_dead_letters(processed_dir)
+
+        failed = dead_letters.select(data, task)
+        logging.info(f"Retrying {len(failed)} failed documents of {task} ({len(dead_letters.entries(task))} in the dead-letter store)")
+        results = await self.execute_tasks([{"results_dir": results_dir,
+                                             "data": failed,
+                                             "task": task,
+                                             "task_prompt": task_prompt,
+                                             "system_prompt": system_prompt,
+                                             "batch_size": batch_size,
+                                             "chunk_tokens": chunk_tokens,
+                                             "chunk_overlap": chunk_overlap,
+                                             "retries": retries,
+                                             "backoff_factor": backoff_factor,
+                                             "ignore_journal": True}],
+                                           concurrency=concurrency)
+        return [self.load_existing_data(results_dir=processed_dir, data=data)]
+
+    def prepare_batch_files(self, results_dir:str, data:pd.DataFrame, task:str, task_prompt:str, system_prompt:str = None,
+                            chunk_tokens:int=None, chunk_overlap:int=0) -> list:
+        """
+        Renders the prompt of every pending document into sharded batch input files under <results_dir>/batch
+        instead of calling the API. Documents longer than <chunk_tokens> get one request per window, as in
+        `process_row`, with the chunk number appended to their custom_id. A manifest maps each custom_id back to its
+        document and chunk for `ingest_batch_results`.
+
+        Returns:
+            list: Paths of the request shards to upload as batch jobs.
         """
-        all_responses = []
-        
-        # # Load existing processed data if available
         processed_dir = os.path.join(results_dir, "processed")
-        existing_data = self.load_existing_data(results_dir=processed_dir)
-        all_responses.append(existing_data) # Append existing data 
+        batch_dir = os.path.join(results_dir, "batch")
+        os.makedirs(batch_dir, exist_ok=True)
+        data = self.pending_data(data, self.load_journal(processed_dir, task), task)
 
-        # Calculate the number of batches
-        num_batches = (len(data) + batch_size - 1) // batch_size
+        with open(os.path.join(batch_dir, "manifest.jsonl"), "w", encoding="utf-8") as manifest:
+            def requests():
+                seen = set()
+                for row in data.itertuples(index=False):
+                    hashed_content = content_hash(row.content)
+                    document_id = f"{task}-{content_hash(f'{row.url}|{hashed_content}')}"
+                    if document_id in seen:
+                        continue
+                    seen.add(document_id)
+                    chunks = self.document_chunks(row.content, chunk_tokens, chunk_overlap)
+                    for chunk_number, chunk in enumerate(chunks):
+                        custom_id = document_id if len(chunks) == 1 else f"{document_id}-{chunk_number}"
+                        manifest.write(json.dumps({"custom_id": custom_id, "url": str(row.url), "content_hash": hashed_content,
+                                                   "chunk": chunk_number, "chunks": len(chunks)}) + "\n")
+                        yield batch_request(custom_id, self.deployment_name, self.build_messages(*self.construct_prompt(task_prompt, chunk, system_prompt)),
+                                            self.temperature)
 
-        for i in tqdm(range(num_batches)):
-            # Slice the DataFrame to get the current batch
-            batch_data = data.iloc[i * batch_size:(i + 1) * batch_size]
+            shard_paths = write_request_shards(requests(), batch_dir)
+        logging.info(f"Wrote batch requests for {len(data)} {task} documents into {len(shard_paths)} files under {batch_dir}")
+        return shard_paths
 
-            if not existing_data.empty:
-                batch_data = batch_data[~batch_data['url'].isin(existing_data['url'])]
-                if batch_data.empty:
-                    logging.info("Batch data is empty after existing url verification, skipping batch...")
-                    continue    
-            
-            responses, costs = await self.process_batch_task(batch_data, task_prompt, system_prompt)
-            # Adapts response to schema 
-            current_data = (batch_data[["url","source","content"]]
-                            .assign(task=task)
-                            .assign(total_tokens = [cost[1] for cost in costs])
-                            .assign(generated_text = [response.choices[0].message.content if hasattr(response,"choices") else "" for response in responses])
-                            .assign(costs = [cost[0] for cost in costs])
-                            )
-
-            # Save and append data
-            all_responses.append(current_data)
-            current_data.to_csv(os.path.join(processed_dir,f"{uuid.uuid4().hex[:5]}.csv"),index=False)
-            time.sleep(random.uniform(45,60))
-
-        return all_responses
+    def ingest_batch_results(self, results_dir:str, data:pd.DataFrame, task:str, result_paths:list = None) -> list:
+        """
+        Joins batch output files (<results_dir>/batch/results_*.jsonl by default) back to the documents in <data>
+        and stores them with the same schema and resume journal as `execute_task`. The chunk answers of a document
+        are merged with `chunking.merge_outputs` once all of them are in; documents with some chunks still missing are
+        left pending. Failed requests and withheld answers (see `failed_answer`) go to the dead-letter store, so preparing the batch files
+        again (or `retry_failed`) only sends those. Documents the journal already records are skipped, so ingesting is idempotent.
+        """
+        processed_dir = os.path.join(results_dir, "processed")
+        batch_dir = os.path.join(results_dir, "batch")
+        journal = self.load_journal(processed_dir, task)
+        dead_letters = self.load_dead_letters(processed_dir)
+        with open(os.path.join(batch_dir, "manifest.jsonl"), "r", encoding="utf-8") as f:
+            manifest = {entry["custom_id"]: entry for entry in map(json.loads, f)}
+        documents = {(str(row.url), content_hash(row.content)): row for row in data.itertuples(index=False)}
+
+        # Chunk answers (or the first error) of every document, keyed like `documents`
+        answers, errors = {}, {}
+        for custom_id, body, error in read_batch_results(result_paths or find_result_files(batch_dir)):
+            entry = manifest.get(custom_id)
+            key = (entry["url"], entry["content_hash"]) if entry else None
+            if key not in documents:
+                logging.warning(f"Batch result {custom_id} does not match any document, skipping it")
+                continue
+            if error:
+                logging.warning(f"Batch request {custom_id} failed: {error}")
+                errors.setdefault(key, error)
+                continue
+            answers.setdefault(key, {})[entry.get("chunk", 0)] = (entry.get("chunks", 1), ChatCompletion.model_validate(body))
+
+        rows = []
+        failed = incomplete = skipped = 0
+        for key in {**answers, **errors}:
+            row = documents[key]
+            # Ingesting the same result files again leaves the documents already stored as they are
+            if journal.is_done(task, row.url, row.content):
+                skipped += 1
+                continue
+            if key in errors:
+                failed += 1
+                dead_letters.record(task, row.url, row.content, BatchRequestError(errors[key]))
+                continue
+            chunks = answers[key]
+            if len(chunks) < next(iter(chunks.values()))[0]:
+                incomplete += 1
+                continue
+            responses = [response for _, (_, response) in sorted(chunks.items())]
+            if any(map(failed_answer, responses)):
+                failed += 1
+                dead_letters.record(task, row.url, row.content, EmptyResponse(f"No answer for {row.url}"))
+                continue
+            prices = dict(input_token_price=INPUT_TOKEN_PRICE * BATCH_DISCOUNT, output_token_price=OUTPUT_TOKEN_PRICE * BATCH_DISCOUNT)
+            result = (self.result_row(row, task, responses[0], **prices) if len(responses) == 1
+                      else self.chunked_result_row(row, task, responses, **prices))
+            rows.append(result)
+
+        if rows:
+            self.save_results(processed_dir, journal, rows, dead_letters)
+        if incomplete:
+            logging.warning(f"{incomplete} {task} documents are missing chunk results and stay pending")
+        logging.info(f"Ingested {len(rows)} batch results for {task}, {failed} failed, {skipped} already stored")
+        return [self.load_existing_data(results_dir=processed_dir, data=data)]
     
 
     def store_total_result(self, results:list[pd.DataFrame], store_dir:str, task_name:str) -> None: